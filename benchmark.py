@@ -0,0 +1,708 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import time
+import urllib.request
+import zlib
+
+import yuanbao_openai_api as api
+
+print("=== Deepseek API 服务性能测试 ===")
+print("==============================\n")
+
+
+def timeit(func, repeat: int = 5) -> float:
+    """运行多次取最快的一次，返回毫秒"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+# ---------------------------------------------------------------------------
+# tool call 解析：模糊测试语料与性能对比
+# ---------------------------------------------------------------------------
+
+def legacy_parse_tool_call(response_text: str) -> dict:
+    """旧版基于正则的解析（只能提取一个 tool call），用于性能对比"""
+    try:
+        text = response_text.strip()
+        if '```' in text:
+            code_block_match = re.search(r'```(?:json)?\s*\n?(.*?)\n?```', text, re.DOTALL)
+            if code_block_match:
+                text = code_block_match.group(1).strip()
+        json_match = re.search(r'\{[^{}]*"type"\s*:\s*"tool_call"[^{}]*\}', text, re.DOTALL)
+        if not json_match:
+            json_match = re.search(r'\{.*"type"\s*:\s*"tool_call".*\}', text, re.DOTALL)
+        if json_match:
+            text = json_match.group(0)
+        data = json.loads(text)
+        if isinstance(data, dict) and data.get('type') == 'tool_call':
+            return data
+    except (json.JSONDecodeError, ValueError, RecursionError):
+        pass
+    return None
+
+
+def reference_tool_calls(text: str) -> list:
+    """参考实现：从每个 { 尝试 raw_decode，结果作为模糊测试的标准答案"""
+    decoder = json.JSONDecoder()
+    result = []
+    pos = text.find('{')
+    while pos >= 0:
+        try:
+            data, end = decoder.raw_decode(text, pos)
+        except ValueError:
+            data, end = None, pos + 1
+        if isinstance(data, dict) and data.get('type') == 'tool_call':
+            result.append(data)
+            pos = text.find('{', end)
+        else:
+            pos = text.find('{', pos + 1)
+    return result
+
+
+PROSE = [
+    "好的，我来帮你执行这个命令。",
+    "Let me check the files first.",
+    "根据执行结果，目录中有 3 个文件。",
+    "注意：参数里可以包含 \"引号\" 和 {花括号}。",
+    "The set {a, b} is small.",
+    "下面是配置示例：",
+    "```\nplain code block\n```",
+]
+
+
+def random_string(rng: random.Random) -> str:
+    alphabet = "abc xyz 中文 {}[]:,\"\\/\n\t"
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 20)))
+
+
+def random_tool_call(rng: random.Random) -> dict:
+    return {
+        "type": "tool_call",
+        "tool": rng.choice(["exec", "read", "write"]),
+        "command": random_string(rng),
+        "comment": random_string(rng),
+        "args": [random_string(rng) for _ in range(rng.randint(0, 3))],
+    }
+
+
+def random_piece(rng: random.Random) -> str:
+    kind = rng.randint(0, 6)
+    if kind == 0:
+        return rng.choice(PROSE)
+    if kind == 1:
+        return json.dumps(random_tool_call(rng), ensure_ascii=rng.random() < 0.5)
+    if kind == 2:
+        return f"```json\n{json.dumps(random_tool_call(rng), ensure_ascii=False, indent=2)}\n```"
+    if kind == 3:
+        return json.dumps({"calls": [random_tool_call(rng)], "meta": {"n": 1}}, ensure_ascii=False)
+    if kind == 4:
+        return json.dumps({"type": "text", "msg": random_string(rng)}, ensure_ascii=False)
+    if kind == 5:
+        return json.dumps({"data": [1, 2, {"k": random_string(rng)}]}, ensure_ascii=False)
+    return random_string(rng).replace('"', '').replace('\\', '')
+
+
+def truncated_tool_call(rng: random.Random) -> str:
+    """损坏的 JSON：流被截断时末尾不完整的 tool call"""
+    broken = json.dumps(random_tool_call(rng), ensure_ascii=False)
+    return broken[:rng.randint(1, len(broken) - 1)]
+
+
+def build_corpus(size: int = 2000, seed: int = 20240425) -> list:
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        text = ' '.join(random_piece(rng) for _ in range(rng.randint(1, 8)))
+        if rng.random() < 0.2:
+            text += ' ' + truncated_tool_call(rng)
+        corpus.append(text)
+    return corpus
+
+
+def fuzz_tool_call_scanner(corpus: list) -> bool:
+    print("测试 1: tool call 扫描器模糊测试")
+    mismatches = 0
+    rng = random.Random(7)
+    for text in corpus:
+        expected = reference_tool_calls(text)
+        actual = [data for data in api.parse_tool_calls(text) if data]
+        # 同一段文本随机切块增量输入，结果必须一致
+        scanner = api.ToolCallScanner()
+        pos = 0
+        while pos < len(text):
+            step = rng.randint(1, 16)
+            scanner.feed(text[pos:pos + step])
+            pos += step
+        scanner.finish()
+        incremental = [api._normalize_tool_call(data) for data in scanner.tool_calls]
+        if [api._normalize_tool_call(data) for data in expected] != actual or actual != incremental:
+            mismatches += 1
+            if mismatches <= 3:
+                print(f"  不一致: {text[:120]!r}")
+    if mismatches:
+        print(f"❌ {mismatches}/{len(corpus)} 个样本结果与参考实现不一致")
+        return False
+    print(f"✅ {len(corpus)} 个样本全部与参考实现一致（含增量输入）")
+    return True
+
+
+def benchmark_tool_call_parsing() -> bool:
+    print("\n测试 2: tool call 解析性能（毫秒，越小越好）")
+    filler = "这是一段很长的回答内容，包含一些说明文字。" * 50
+    call = json.dumps({"type": "tool_call", "tool": "exec", "command": "ls -la", "args": ["/tmp"]}, ensure_ascii=False)
+    samples = {
+        "纯文本 100KB": filler * 40,
+        "文本 + 末尾 tool call": filler * 40 + call,
+        "代码块 tool call": f"```json\n{call}\n```",
+        "未闭合的 tool call 片段 x1000": '{"type":"tool_call","x":' * 1000,
+    }
+    print(f"  {'样本':<28}{'旧版正则':>10}{'新扫描器':>10}")
+    for name, text in samples.items():
+        legacy = timeit(lambda: legacy_parse_tool_call(text), repeat=3)
+        scanner = timeit(lambda: api.parse_tool_calls(text), repeat=3)
+        print(f"  {name:<28}{legacy:>10.2f}{scanner:>10.2f}")
+    return True
+
+
+# ---------------------------------------------------------------------------
+# token 计数：增量计数器开销
+# ---------------------------------------------------------------------------
+
+def benchmark_token_counter() -> bool:
+    print("\n测试 3: 流式 token 计数（毫秒，越小越好）")
+    tokenizer = api.get_tokenizer()
+    print(f"  分词器: {api.TOKENIZER_PATH if tokenizer else '未加载，按字符估算'}")
+    text = "这是一段很长的回答内容，包含一些说明文字。Some English words mixed in. " * 2000
+    chunks = [text[i:i + 8] for i in range(0, len(text), 8)]
+
+    def incremental():
+        counter = api.TokenCounter()
+        for chunk in chunks:
+            counter.feed(chunk)
+        return counter.total
+
+    expected = api._count_tokens_uncached(text)
+    actual = incremental()
+    elapsed = timeit(incremental, repeat=3)
+    print(f"  {len(chunks)} 个 chunk / {len(text)} 字符: {elapsed:.2f} ms，平均每个 chunk {elapsed * 1000 / len(chunks):.2f} µs")
+    if actual != expected:
+        print(f"❌ 增量计数 {actual} 与整段计数 {expected} 不一致")
+        return False
+    print(f"✅ 增量计数与整段计数一致: {actual} tokens")
+
+    # 没有空白和标点的中文长回答：开销应与长度成线性
+    def cjk_only(repeat: int):
+        cjk_text = "我们今天讨论的问题是如何在不影响吞吐的前提下统计输出长度" * repeat
+        counter = api.TokenCounter()
+        for i in range(0, len(cjk_text), 4):
+            counter.feed(cjk_text[i:i + 4])
+        return counter.total
+
+    small = timeit(lambda: cjk_only(500), repeat=3)
+    large = timeit(lambda: cjk_only(2000), repeat=3)
+    print(f"  无切分点的中文回答: 1 倍长度 {small:.2f} ms，4 倍长度 {large:.2f} ms")
+    if large > small * 6:
+        print("❌ 无切分点时增量计数的开销不是线性的")
+        return False
+    print("✅ 无切分点时增量计数的开销为线性")
+    return True
+
+
+# ---------------------------------------------------------------------------
+# 流式响应内存：500 个并发长回答的峰值 RSS
+# ---------------------------------------------------------------------------
+
+class FakeStreamResponse:
+    """模拟元宝的长 R1 回答：逐行生成，不预先保存内容"""
+    status_code = 200
+
+    def __init__(self, think_events: int, text_events: int):
+        self.think_events = think_events
+        self.text_events = text_events
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+    def json(self):
+        return {}
+
+    def iter_lines(self):
+        for i in range(self.think_events):
+            yield ('data: ' + json.dumps({"type": "think", "content": f"思考第{i}步，分析这个问题" + ("。" if i % 10 == 9 else "")}, ensure_ascii=False)).encode()
+        for i in range(self.text_events):
+            yield ('data: ' + json.dumps({"type": "text", "msg": f"这是回答的第{i}段内容，"}, ensure_ascii=False)).encode()
+
+
+def peak_rss_mb() -> float:
+    # Linux 下 ru_maxrss 单位为 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_concurrent_streams(concurrency: int, with_tool_result: bool) -> dict:
+    """在当前进程中并发跑 concurrency 个流式请求，返回 RSS 和输出统计"""
+    api.UPSTREAM_SESSION.post = lambda url, **kwargs: FakeStreamResponse(500, 500)
+    # 逐行日志会淹没内存和耗时的差异
+    api.logger.setLevel(logging.WARNING)
+    messages = [{"role": "user", "content": "请详细解释一下"}]
+    if with_tool_result:
+        messages.append({"role": "tool", "content": "执行结果"})
+
+    async def one_stream() -> int:
+        request = api.ChatCompletionRequest(model="deepseek_r1", messages=messages, stream=True)
+        response = await api.openai_chat_completion(request)
+        size = 0
+        async for chunk in response.body_iterator:
+            size += len(chunk)
+        return size
+
+    async def main():
+        return await asyncio.gather(*(one_stream() for _ in range(concurrency)))
+
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    sizes = asyncio.run(main())
+    return {
+        "baseline_mb": baseline,
+        "peak_mb": peak_rss_mb(),
+        "seconds": time.perf_counter() - start,
+        "output_mb": sum(sizes) / 1024 / 1024
+    }
+
+
+def benchmark_stream_memory(concurrency: int = 500) -> bool:
+    print(f"\n测试 4: {concurrency} 个并发流式长回答的峰值 RSS")
+    ok = True
+    for mode, label in (("buffered", "检测 tool call（缓存原始文本）"), ("passthrough", "已有工具结果（直接透传）")):
+        # 每种模式在独立进程中运行，峰值 RSS 互不影响
+        result = subprocess.run(
+            [sys.executable, __file__, "stream-rss", mode, str(concurrency)],
+            capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            print(f"❌ {label}: 运行失败\n{result.stderr[-500:]}")
+            ok = False
+            continue
+        stats = json.loads(result.stdout.strip().splitlines()[-1])
+        per_stream_kb = (stats["peak_mb"] - stats["baseline_mb"]) * 1024 / concurrency
+        print(f"  {label}: 峰值 {stats['peak_mb']:.1f} MB（基线 {stats['baseline_mb']:.1f} MB，"
+              f"每个流约 {per_stream_kb:.1f} KB），输出 {stats['output_mb']:.1f} MB，耗时 {stats['seconds']:.1f} 秒")
+    return ok
+
+
+# ---------------------------------------------------------------------------
+# 响应压缩：传输字节数与每个响应的 CPU 耗时
+# ---------------------------------------------------------------------------
+
+def sample_r1_response() -> bytes:
+    """一个非流式 R1 回答：几十 KB 的思考过程加正文"""
+    think = ''.join(f"思考第{i}步：先分析用户的问题，再检查上一步的结论是否成立。" for i in range(300))
+    answer = ''.join(f"这是回答的第{i}段内容，包含一些说明文字。" for i in range(200))
+    return json.dumps({
+        "id": "chatcmpl-benchmark",
+        "object": "chat.completion",
+        "created": 1714000000,
+        "model": "deepseek_r1",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": f"<think>\n{think}\n</think>\n{answer}"}, "finish_reason": "stop"}],
+        "usage": api.usage_block(20, 6000)
+    }, ensure_ascii=False).encode("utf-8")
+
+
+def sample_sse_chunks() -> list:
+    """流式回答的 SSE 消息，每个 token 一条"""
+    chunks = [api.format_stream_chunk("chatcmpl-benchmark", "deepseek_r1", {"content": f"第{i}个词"}) for i in range(2000)]
+    chunks.append(api.format_stream_end("chatcmpl-benchmark", "deepseek_r1", "stop"))
+    return [chunk.encode("utf-8") for chunk in chunks]
+
+
+def decompress(encoding: str, data: bytes) -> bytes:
+    if encoding == "gzip":
+        return zlib.decompress(data, 31)
+    return api.get_zstandard().ZstdDecompressor().decompressobj().decompress(data)
+
+
+def benchmark_compression() -> bool:
+    print("\n测试 5: 响应压缩（传输字节数与每个响应的 CPU 耗时）")
+    encodings = ["gzip", "zstd"] if api.get_zstandard() else ["gzip"]
+    if not api.get_zstandard():
+        print("  未安装 zstandard，只测试 gzip")
+    body = sample_r1_response()
+    chunks = sample_sse_chunks()
+    raw_stream = b''.join(chunks)
+    ok = True
+    print(f"  {'响应':<20}{'编码':<10}{'字节数':>10}{'压缩率':>10}{'CPU ms':>10}")
+    print(f"  {'非流式 R1 回答':<20}{'identity':<10}{len(body):>10}{'100.0%':>10}{0:>10.2f}")
+    for encoding in encodings:
+        compressed = api.StreamCompressor(encoding).compress(body, final=True)
+        cpu = timeit(lambda: api.StreamCompressor(encoding).compress(body, final=True))
+        ok = ok and decompress(encoding, compressed) == body
+        print(f"  {'非流式 R1 回答':<20}{encoding:<10}{len(compressed):>10}{len(compressed) / len(body):>10.1%}{cpu:>10.2f}")
+
+    print(f"  {f'SSE {len(chunks)} 条':<20}{'identity':<10}{len(raw_stream):>10}{'100.0%':>10}{0:>10.2f}")
+    for encoding in encodings:
+        def stream():
+            compressor = api.StreamCompressor(encoding)
+            # 与中间件相同：每条消息压缩后立即 flush
+            return b''.join(compressor.compress(chunk, final=i == len(chunks) - 1) for i, chunk in enumerate(chunks))
+        compressed = stream()
+        cpu = timeit(stream)
+        ok = ok and decompress(encoding, compressed) == raw_stream
+        print(f"  {f'SSE {len(chunks)} 条':<20}{encoding:<10}{len(compressed):>10}{len(compressed) / len(raw_stream):>10.1%}{cpu:>10.2f}"
+              f"（每条 {cpu * 1000 / len(chunks):.1f} µs）")
+    if not ok:
+        print("❌ 解压结果与原始响应不一致")
+        return False
+    print("✅ 解压结果与原始响应一致")
+    return True
+
+
+# ---------------------------------------------------------------------------
+# 近似重复提示词缓存：命中率、误命中和 100 万条目时的查询耗时
+# ---------------------------------------------------------------------------
+
+def random_prompt(rng: random.Random, words: list) -> str:
+    return "User: " + " ".join(rng.choice(words) for _ in range(60)) + f"\n当前时间 2024-04-25 {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00"
+
+
+def near_duplicate(rng: random.Random, prompt: str, words: list) -> str:
+    """改动时间戳、空白，并替换一个词"""
+    tokens = prompt.split(" ")
+    tokens[rng.randrange(1, len(tokens) - 2)] = rng.choice(words)
+    return re.sub(r"\d{2}:\d{2}:00", "08:30:15", "  ".join(tokens))
+
+
+def benchmark_prompt_cache(entries: int = 1_000_000, samples: int = 2000) -> bool:
+    print(f"\n测试 7: 近似重复提示词缓存（阈值 {api.PROMPT_CACHE_THRESHOLD}）")
+    rng = random.Random(20240425)
+    words = [random_string(rng) for _ in range(500)]
+    scope = (None, "deepseek_v3")
+    cache = api.PromptCache(api.PROMPT_CACHE_THRESHOLD, entries, 1 << 40, api.PROMPT_CACHE_BANDS, api.PROMPT_CACHE_ROWS)
+    prompts = [random_prompt(rng, words) for _ in range(samples)]
+    for i, prompt in enumerate(prompts):
+        cache.put(scope, prompt, str(i))
+    near_hits = sum(cache.get(scope, near_duplicate(rng, prompt, words)) == str(i) for i, prompt in enumerate(prompts))
+    wrong_hits = sum(cache.get(scope, random_prompt(rng, words)) is not None for _ in range(samples))
+    print(f"  近似重复命中率:   {near_hits / samples:.1%}")
+    print(f"  无关提示词误命中: {wrong_hits}/{samples}")
+
+    # 其余条目直接写入随机签名，只测索引规模对查询耗时的影响
+    start = time.perf_counter()
+    for i in range(entries - samples):
+        cache.insert(scope, i.to_bytes(16, "little"), rng.randbytes(cache.slots * 4), "x")
+    print(f"  填充到 {len(cache._entries)} 条耗时 {time.perf_counter() - start:.1f}s，估算内存 {cache.nbytes / 1024 / 1024:.0f} MB")
+    queries = [cache.signature(near_duplicate(rng, prompt, words)) for prompt in prompts]
+    latencies = []
+    for digest, signature in queries:
+        start = time.perf_counter()
+        cache.lookup(scope, digest, signature)
+        latencies.append((time.perf_counter() - start) * 1_000_000)
+    latencies.sort()
+    p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+    signature_ms = timeit(lambda: cache.signature(prompts[0]), repeat=50)
+    print(f"  查询耗时 p50 {p50:.1f} µs，p99 {p99:.1f} µs（另需计算签名 {signature_ms:.2f} ms）")
+    print(f"  统计: {json.dumps(cache.stats())}")
+    del cache
+    if p99 >= 1000 or wrong_hits:
+        print("❌ 查询超过 1 ms 或出现误命中")
+        return False
+    print("✅ 100 万条目时查询耗时低于 1 ms，无误命中")
+    return True
+
+
+# ---------------------------------------------------------------------------
+# 请求解码与提示词构建：1 MB 的 Agent 对话请求体
+# ---------------------------------------------------------------------------
+
+def agent_transcript_body(size: int = 1024 * 1024, seed: int = 20240425) -> bytes:
+    """生成约 size 字节的 /v1/chat/completions 请求体：数百条消息，多数 content 为数组"""
+    rng = random.Random(seed)
+    messages = [{"role": "system", "content": "你是一个编程助手，可以调用工具读取和修改文件。"}]
+    length = 0
+    while length < size:
+        role = rng.choice(["user", "assistant", "tool"])
+        if role == "assistant":
+            content = "好的，我先查看相关文件。" + "def handler(event):\n    return event\n" * rng.randint(1, 40)
+        else:
+            content = [{"type": "text", "text": ("运行结果:\n" if role == "tool" else "请继续修改 ") + "line %d ok\n" * rng.randint(10, 200)},
+                       {"type": "text", "text": "（完）"}]
+        messages.append({"role": role, "content": content})
+        length += len(json.dumps(messages[-1], ensure_ascii=False).encode("utf-8"))
+    return json.dumps({"model": "deepseek_v3", "messages": messages, "stream": True}, ensure_ascii=False).encode("utf-8")
+
+
+def legacy_build_chat_prompt(messages: list, model: str) -> str:
+    """旧版提示词构建（逐条格式化、整体扫描 "User:" 后再拼接），用于性能对比"""
+    entries = []
+    has_tool_result = False
+    for msg in messages:
+        content = msg.content
+        if isinstance(content, list):
+            text_parts = []
+            for item in content:
+                if isinstance(item, dict) and item.get('type') == 'text':
+                    text_parts.append(item.get('text', ''))
+            content_text = ' '.join(text_parts)
+        elif isinstance(content, str):
+            content_text = content
+        else:
+            content_text = str(content)
+        if content_text and msg.role in api.ROLE_PREFIXES:
+            entries.append((msg.role, content_text))
+            has_tool_result = has_tool_result or msg.role == 'tool'
+    entries = api.apply_prompt_budget(entries, model)
+    conversation_history = [f"{api.ROLE_PREFIXES[role]}: {text}" for role, text in entries]
+    if not any('User:' in msg for msg in conversation_history):
+        raise ValueError("No user message found")
+    if has_tool_result:
+        conversation_history.append("\n[System指令: 上面是工具执行的结果。请根据执行结果给用户一个友好的总结回复，不要再次执行相同的命令。]")
+    return '\n'.join(conversation_history)
+
+
+def benchmark_request_decode() -> bool:
+    print("\n测试 8: 请求解码与提示词构建（1 MB 请求体）")
+    body = agent_transcript_body()
+    # 只比较解码和拼接本身，不触发提示词预算压缩
+    budget = api.PROMPT_BUDGET_TOKENS, api.TOOL_RESULT_MAX_TOKENS
+    api.PROMPT_BUDGET_TOKENS = api.TOOL_RESULT_MAX_TOKENS = 1 << 30
+
+    def legacy():
+        # 原来的路径：FastAPI 用标准库 json 解析，pydantic 校验整个请求
+        request = api.ChatCompletionRequest.model_validate(json.loads(body))
+        return legacy_build_chat_prompt(request.messages, request.model)
+
+    def fast():
+        request = api.decode_chat_request(body)
+        return api.build_chat_prompt(request.messages, request.model)[0]
+
+    try:
+        request = api.decode_chat_request(body)
+        same = legacy() == fast()
+        decode_ms = timeit(lambda: api.decode_chat_request(body), repeat=20)
+        build_ms = timeit(lambda: api.build_chat_prompt(request.messages, request.model), repeat=20)
+        legacy_ms = timeit(legacy, repeat=20)
+        fast_ms = timeit(fast, repeat=20)
+    finally:
+        api.PROMPT_BUDGET_TOKENS, api.TOOL_RESULT_MAX_TOKENS = budget
+    print(f"  请求体 {len(body) / 1024 / 1024:.2f} MB，{len(request.messages)} 条消息")
+    print(f"  原实现（json + pydantic 校验 + 逐条格式化拼接）: {legacy_ms:.2f} ms")
+    print(f"  新实现（解码 {decode_ms:.2f} ms + 拼接 {build_ms:.2f} ms）: {fast_ms:.2f} ms")
+    print(f"  加速比: {legacy_ms / fast_ms:.2f}x")
+    if not same:
+        print("❌ 两种实现构建的提示词不一致")
+        return False
+    print("✅ 两种实现构建的提示词一致")
+    return True
+
+
+# ---------------------------------------------------------------------------
+# 请求日志中间件：每个请求、每个流式 chunk 的额外开销
+# ---------------------------------------------------------------------------
+
+async def legacy_log_requests(request, call_next):
+    """旧版基于 BaseHTTPMiddleware 的请求日志（读出整个请求体后再交给接口），用于性能对比"""
+    start_time = time.time()
+    api.logger.info("\n=== 收到请求 ===")
+    api.logger.info(f"请求方法: {request.method}")
+    api.logger.info(f"请求路径: {request.url.path}")
+    api.logger.info(f"完整URL: {request.url}")
+    api.logger.info(f"查询参数: {dict(request.query_params)}")
+    api.logger.info(f"请求头: {dict(request.headers)}")
+    api.logger.info(f"客户端IP: {request.client.host if request.client else '未知'}")
+    api.logger.info(f"用户代理: {request.headers.get('user-agent', '未知')}")
+    body = await request.body()
+    if body:
+        api.logger.info(f"原始请求体: {body.decode('utf-8')}")
+    request._body = body
+    response = await call_next(request)
+    api.logger.info(f"处理时间: {time.time() - start_time:.2f}秒")
+    api.logger.info(f"响应状态: {response.status_code}")
+    api.logger.info(f"响应头: {dict(response.headers)}")
+    api.logger.info("=== 请求处理完成 ===")
+    return response
+
+
+def instrumentation_apps(chunks: int) -> dict:
+    """同一个 Starlette 应用分别不加中间件、加旧版日志中间件、加新的 ASGI 中间件"""
+    from starlette.applications import Starlette
+    from starlette.middleware import Middleware
+    from starlette.middleware.base import BaseHTTPMiddleware
+    from starlette.responses import JSONResponse, StreamingResponse
+    from starlette.routing import Route
+
+    async def chat(request):
+        await request.body()
+        return JSONResponse({"choices": [{"message": {"content": "ok"}}]})
+
+    async def stream(request):
+        await request.body()
+
+        async def events():
+            for i in range(chunks):
+                yield f"data: {i}\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    routes = [Route("/chat", chat, methods=["POST"]), Route("/stream", stream, methods=["POST"])]
+    return {
+        "无中间件": Starlette(routes=routes),
+        "BaseHTTPMiddleware": Starlette(routes=routes, middleware=[Middleware(BaseHTTPMiddleware, dispatch=legacy_log_requests)]),
+        "InstrumentationMiddleware": Starlette(routes=routes, middleware=[Middleware(api.InstrumentationMiddleware)]),
+    }
+
+
+async def call_asgi(app, path: str, body: bytes) -> int:
+    """不经过网络直接调用 ASGI 应用，返回收到的 body 消息数"""
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+             "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"", "client": ("127.0.0.1", 1234),
+             "server": ("127.0.0.1", 9999), "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]}
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    received = 0
+
+    async def receive():
+        return messages.pop() if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal received
+        received += message["type"] == "http.response.body"
+
+    await app(scope, receive, send)
+    return received
+
+
+def benchmark_instrumentation(requests_count: int = 2000, chunks: int = 200) -> bool:
+    print(f"\n测试 9: 请求日志中间件开销（{requests_count} 个请求，流式响应 {chunks} 块）")
+    apps = instrumentation_apps(chunks)
+    body = json.dumps({"model": "deepseek_v3", "messages": [{"role": "user", "content": "你好" * 200}]}).encode()
+    level = api.logger.level
+    # 只比较中间件本身，日志输出（写文件/控制台）的开销对两者相同，这里关闭
+    api.logger.setLevel(logging.WARNING)
+
+    async def run(app, path, count):
+        start = time.perf_counter()
+        for _ in range(count):
+            await call_asgi(app, path, body)
+        return (time.perf_counter() - start) / count * 1_000_000
+
+    try:
+        results = {}
+        for name, app in apps.items():
+            asyncio.run(run(app, "/chat", 100))
+            results[name] = (asyncio.run(run(app, "/chat", requests_count)), asyncio.run(run(app, "/stream", requests_count // 10)))
+    finally:
+        api.logger.setLevel(level)
+    base_json, base_stream = results["无中间件"]
+    print(f"  {'':<28}{'普通请求 µs':>12}{'额外 µs':>10}{'流式请求 µs':>12}{'每块额外 µs':>12}")
+    for name, (json_us, stream_us) in results.items():
+        print(f"  {name:<28}{json_us:>12.1f}{json_us - base_json:>10.1f}{stream_us:>12.1f}{(stream_us - base_stream) / chunks:>12.2f}")
+    new_json, new_stream = results["InstrumentationMiddleware"]
+    old_json, old_stream = results["BaseHTTPMiddleware"]
+    if new_json - base_json >= old_json - base_json or new_stream >= old_stream:
+        print("❌ 新中间件的开销没有低于 BaseHTTPMiddleware")
+        return False
+    print("✅ 新中间件的每请求、每块开销均低于 BaseHTTPMiddleware")
+    return True
+
+
+# ---------------------------------------------------------------------------
+# 启动耗时：进程启动到第一次 /health 成功、第一次完成对话
+# ---------------------------------------------------------------------------
+
+def serve_for_startup_benchmark(port: int):
+    """benchmark_startup 的子进程入口：用模拟的上游启动服务，不做预热，不写日志文件"""
+    import uvicorn
+    api.UPSTREAM_SESSION.post = lambda url, **kwargs: FakeStreamResponse(5, 5)
+    app = api.create_app({"WARMUP_CONNECTIONS": 0, "WARMUP_CONVERSATIONS": 0, "IDEMPOTENCY_DB": ""}, log_file="")
+    api.logger.setLevel(logging.WARNING)
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def wait_until(func, timeout: float = 30) -> bool:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            if func():
+                return True
+        except OSError:
+            pass
+        time.sleep(0.005)
+    return False
+
+
+def measure_startup(port: int) -> dict:
+    base_url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, __file__, "startup-server", str(port)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        if not wait_until(lambda: urllib.request.urlopen(f"{base_url}/health", timeout=1).status == 200):
+            raise RuntimeError(proc.stderr.read().decode()[-500:] if proc.poll() is not None else "等待 /health 超时")
+        health = time.perf_counter() - start
+        body = json.dumps({"model": "deepseek_v3", "messages": [{"role": "user", "content": "你好"}]}).encode()
+        request = urllib.request.Request(f"{base_url}/v1/chat/completions", data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            completed = response.status == 200 and bool(json.loads(response.read())["choices"])
+        return {"health": health, "completion": time.perf_counter() - start, "ok": completed}
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def benchmark_startup(rounds: int = 3) -> bool:
+    print("\n测试 6: 启动耗时（秒，取中位数）")
+    import_times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import yuanbao_openai_api"], check=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        import_times.append(time.perf_counter() - start)
+    results = [measure_startup(19990 + i) for i in range(rounds)]
+    median = lambda values: sorted(values)[len(values) // 2]
+    print(f"  进程启动并导入模块:        {median(import_times):.3f}")
+    print(f"  进程启动到 /health 成功:   {median([r['health'] for r in results]):.3f}")
+    print(f"  进程启动到首个对话完成:    {median([r['completion'] for r in results]):.3f}")
+    if not all(r["ok"] for r in results):
+        print("❌ 对话请求失败")
+        return False
+    print("✅ 服务启动后可以正常完成对话")
+    return True
+
+
+def run_benchmarks():
+    print("开始运行所有性能测试...\n")
+    corpus = build_corpus()
+    results = [
+        fuzz_tool_call_scanner(corpus),
+        benchmark_tool_call_parsing(),
+        benchmark_token_counter(),
+        benchmark_stream_memory(),
+        benchmark_compression(),
+        benchmark_startup(),
+        benchmark_prompt_cache(),
+        benchmark_request_decode(),
+        benchmark_instrumentation(),
+    ]
+    print("\n==============================")
+    print(f"性能测试完成: {sum(results)}/{len(results)} 项通过")
+    print("==============================")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "stream-rss":
+        # benchmark_stream_memory 的子进程入口
+        print(json.dumps(run_concurrent_streams(int(sys.argv[3]), sys.argv[2] == "passthrough")))
+    elif len(sys.argv) == 3 and sys.argv[1] == "startup-server":
+        serve_for_startup_benchmark(int(sys.argv[2]))
+    else:
+        run_benchmarks()
@@ -0,0 +1,238 @@
+"""
+图片/文件上传测试：在本地启动一个模拟的元宝上游（上传凭证、COS 上传、创建对话、对话接口），
+不需要真实账号即可验证上传流程、按内容哈希的缓存命中、TTL 过期和并发上传合并
+
+运行: python test_upload.py
+"""
+import base64
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fastapi.testclient import TestClient
+
+import yuanbao_openai_api as api
+
+print("=== 图片/文件上传测试（模拟上游） ===")
+print("==============================\n")
+
+# 模拟 COS 临时凭证
+MOCK_SECRET_ID = "mock-secret-id"
+MOCK_SECRET_KEY = "mock-secret-key"
+MOCK_SECURITY_TOKEN = "mock-security-token"
+
+
+class MockUpstream:
+    """
+    模拟的元宝上游：
+
+    - POST UPLOAD_INFO_PATH：返回 COS 临时凭证、存储位置和资源地址
+    - PUT /{location}：校验 COS 签名和临时 token，记录上传次数（可设置延迟，用于并发测试）
+    - POST /api/user/agent/conversation/v1/detail：创建对话
+    - POST /api/chat/{对话ID}：记录请求中的 multimedia，返回一段 SSE 回复
+    """
+    def __init__(self, put_delay: float = 0.0):
+        self.put_delay = put_delay
+        self.upload_infos = 0
+        self.uploads = []
+        self.rejected_uploads = 0
+        self.multimedia = []
+        self._lock = threading.Lock()
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _body(self) -> bytes:
+                return self.rfile.read(int(self.headers.get("content-length") or 0))
+
+            def _reply(self, status: int, body: bytes = b"{}", content_type: str = "application/json"):
+                self.send_response(status)
+                self.send_header("content-type", content_type)
+                self.send_header("content-length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self._body()
+                if self.path == api.UPLOAD_INFO_PATH:
+                    with upstream._lock:
+                        upstream.upload_infos += 1
+                        number = upstream.upload_infos
+                    file_name = json.loads(body)["fileName"]
+                    self._reply(200, json.dumps({
+                        "bucketName": "mock-bucket",
+                        "location": f"/uploads/{number}/{file_name}",
+                        "encryptTmpSecretId": MOCK_SECRET_ID,
+                        "encryptTmpSecretKey": MOCK_SECRET_KEY,
+                        "encryptToken": MOCK_SECURITY_TOKEN,
+                        "startTime": 1700000000,
+                        "expiredTime": 1700003600,
+                        "resourceID": f"resource-{number}",
+                        "resourceUrl": f"https://cdn.example.com/resource-{number}"
+                    }).encode())
+                elif self.path == "/api/user/agent/conversation/v1/detail":
+                    self._reply(200)
+                elif self.path.startswith("/api/chat/"):
+                    with upstream._lock:
+                        upstream.multimedia.append(json.loads(body)["multimedia"])
+                    self._reply(200, b'data: {"type":"text","msg":"ok"}\n\ndata: [DONE]\n\n', "text/event-stream")
+                else:
+                    self._reply(404)
+
+            def do_PUT(self):
+                body = self._body()
+                time.sleep(upstream.put_delay)
+                expected = api.cos_authorization(MOCK_SECRET_ID, MOCK_SECRET_KEY, "put", self.path,
+                                                 {"host": self.headers["host"]}, 1700000000, 1700003600)
+                if self.headers.get("authorization") != expected or self.headers.get("x-cos-security-token") != MOCK_SECURITY_TOKEN:
+                    with upstream._lock:
+                        upstream.rejected_uploads += 1
+                    self._reply(403)
+                    return
+                with upstream._lock:
+                    upstream.uploads.append((self.path, body))
+                self._reply(200)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def create_client(upstream: MockUpstream, **config) -> TestClient:
+    """按模拟上游的地址创建应用（不写日志文件、不使用幂等数据库）"""
+    app = api.create_app(dict({
+        "UPSTREAM_BASE_URL": upstream.base_url,
+        "UPLOAD_COS_ENDPOINT": upstream.base_url,
+        "IDEMPOTENCY_DB": ""
+    }, **config), log_file="")
+    api.logger.setLevel(logging.WARNING)
+    return TestClient(app)
+
+
+def png_bytes(width: int, height: int, salt: bytes = b"") -> bytes:
+    """只有文件头的 PNG（足够读取尺寸）"""
+    return (b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR" + width.to_bytes(4, "big") + height.to_bytes(4, "big")
+            + b"\x08\x02\x00\x00\x00" + salt)
+
+
+def chat_messages(image: bytes, turns: int) -> list:
+    """多轮对话：每轮都重发同一张图片，最后一条消息附带一个文本文件"""
+    image_url = "data:image/png;base64," + base64.b64encode(image).decode()
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": [
+            {"type": "text", "text": f"第 {i + 1} 个问题"},
+            {"type": "image_url", "image_url": {"url": image_url}}
+        ]})
+        messages.append({"role": "assistant", "content": f"第 {i + 1} 个回答"})
+    messages.append({"role": "user", "content": [
+        {"type": "text", "text": "总结一下附件"},
+        {"type": "file", "file": {"filename": "notes.txt", "file_data": base64.b64encode("附件内容".encode()).decode()}}
+    ]})
+    return messages
+
+
+# 测试 1: 上传与缓存命中
+def test_upload_cache_hit():
+    print("测试 1: 上传与缓存命中")
+    upstream = MockUpstream()
+    try:
+        client = create_client(upstream)
+        image = png_bytes(640, 480)
+        response = client.post("/v1/chat/completions", json={"model": "deepseek_v3", "messages": chat_messages(image, 3)})
+        assert response.status_code == 200, response.text
+        # 三轮重发的同一张图片只上传一次，加上一个文件
+        assert len(upstream.uploads) == 2, upstream.uploads
+        image_entry, file_entry = upstream.multimedia[-1]
+        assert image_entry["type"] == "image" and (image_entry["width"], image_entry["height"]) == (640, 480), image_entry
+        assert image_entry["url"] == "https://cdn.example.com/resource-1", image_entry
+        assert file_entry["type"] == "doc" and file_entry["fileName"] == "notes.txt", file_entry
+
+        # 下一个请求（流式）引用同样的内容：直接使用缓存的资源，不再上传
+        response = client.post("/v1/chat/completions", json={"model": "deepseek_v3", "stream": True, "messages": chat_messages(image, 4)})
+        assert response.status_code == 200, response.text
+        assert len(upstream.uploads) == 2, upstream.uploads
+        assert upstream.multimedia[-1] == upstream.multimedia[0]
+        stats = client.get("/api/usage").json()["uploads"]
+        assert stats["uploads"] == 2 and stats["hits"] == 2, stats
+        print(f"✅ 2 个请求共上传 {len(upstream.uploads)} 次，缓存命中 {stats['hits']} 次")
+    finally:
+        upstream.close()
+
+
+# 测试 2: 缓存过期后重新上传
+def test_upload_cache_ttl():
+    print("\n测试 2: 缓存过期后重新上传")
+    upstream = MockUpstream()
+    try:
+        create_client(upstream, UPLOAD_CACHE_TTL=0.5)
+        part = api._media_part("image/png", png_bytes(32, 32, b"ttl"))
+        headers = {"x-id": "mock-account"}
+        first = api.resolve_media([part], "account", headers)
+        second = api.resolve_media([part], "account", headers)
+        assert len(upstream.uploads) == 1 and first == second, upstream.uploads
+        time.sleep(0.6)
+        third = api.resolve_media([part], "account", headers)
+        assert len(upstream.uploads) == 2 and third[0]["url"] != first[0]["url"], upstream.uploads
+        # 不同账号的上传互不共用
+        api.resolve_media([part], "other-account", headers)
+        assert len(upstream.uploads) == 3, upstream.uploads
+        print("✅ 过期前命中缓存，过期后重新上传，不同账号分别上传")
+    finally:
+        upstream.close()
+
+
+# 测试 3: 并发上传同一内容只上传一次
+def test_concurrent_upload_dedup():
+    print("\n测试 3: 并发上传同一内容只上传一次")
+    upstream = MockUpstream(put_delay=0.3)
+    try:
+        create_client(upstream)
+        part = api._media_part("image/png", png_bytes(16, 16, b"concurrent"))
+        headers = {"x-id": "mock-account"}
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            urls = list(executor.map(lambda _: api.resolve_media([part], "account", headers)[0]["url"], range(8)))
+        stats = api.UPLOAD_CACHE.stats()
+        assert len(upstream.uploads) == 1 and len(set(urls)) == 1, upstream.uploads
+        assert stats["deduplicated"] == 7 and stats["inflight"] == 0, stats
+        print(f"✅ 8 个并发请求上传 {len(upstream.uploads)} 次，合并 {stats['deduplicated']} 次")
+    finally:
+        upstream.close()
+
+
+# 主测试函数
+def run_tests():
+    print("开始运行所有测试...\n")
+
+    tests = [
+        test_upload_cache_hit,
+        test_upload_cache_ttl,
+        test_concurrent_upload_dedup
+    ]
+
+    passed = 0
+    total = len(tests)
+
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__} 失败: {e!r}")
+
+    print("\n==============================")
+    print(f"测试完成: {passed}/{total} 测试通过")
+    print("==============================")
+    return passed == total
+
+if __name__ == "__main__":
+    raise SystemExit(0 if run_tests() else 1)
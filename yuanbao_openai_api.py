@@ -1,9 +1,8 @@
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from pydantic import BaseModel, ValidationError
 from typing import List, Optional, Dict, Any, Union, Generator
-import uvicorn
 import json
 import requests
 import urllib3
@@ -13,17 +12,91 @@ import logging
 import re
 import os
 import uuid
+import random
+import glob
+import itertools
+import threading
+import asyncio
+import signal
+import subprocess
+import select
+import sys
+import argparse
+import http.cookiejar
+import concurrent.futures
+import collections
+import hashlib
+import base64
+import contextvars
+import functools
+import sqlite3
+import array
+import traceback
+import tracemalloc
+import zlib
+import bisect
+import math
+import unicodedata
+import hmac
+import mimetypes
+import urllib.parse
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+import anyio
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders, QueryParams, URL
 
 # 禁用SSL警告
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_session_watcher()
+    start_conversation_cleaner()
+    start_loop_monitor()
+    start_health_prober()
+    # 预热在后台进行，完成后 /health/ready 才返回就绪，并通知 supervisor
+    threading.Thread(target=run_warmup, name="warmup", daemon=True).start()
+    yield
+    stop_session_watcher()
+    stop_conversation_cleaner()
+    stop_loop_monitor()
+    stop_health_prober()
 
-# 自定义异常处理器，提供更详细的验证错误信息
+class DeferredRouter:
+    """
+    记录接口定义，由 create_app 注册到 FastAPI 应用
+
+    注册接口时 FastAPI 会为每个接口分析参数并构建 pydantic 模型，开销较大，
+    放到创建应用时进行，只使用工具函数的导入方（测试、benchmark、脚本）无需付出这部分开销
+    """
+    def __init__(self):
+        self.routes = []
+
+    def _record(self, kind: str, path: str, **kwargs):
+        def decorator(endpoint):
+            self.routes.append((kind, path, endpoint, kwargs))
+            return endpoint
+        return decorator
+
+    def get(self, path: str, **kwargs):
+        return self._record("get", path, **kwargs)
+
+    def post(self, path: str, **kwargs):
+        return self._record("post", path, **kwargs)
+
+    def websocket(self, path: str, **kwargs):
+        return self._record("websocket", path, **kwargs)
+
+    def register(self, app: FastAPI):
+        for kind, path, endpoint, kwargs in self.routes:
+            getattr(app, kind)(path, **kwargs)(endpoint)
+
+router = DeferredRouter()
+
+# 自定义异常处理器，提供更详细的验证错误信息（由 create_app 注册）
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 
-@app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
     errors = []
     for error in exc.errors():
@@ -45,15 +118,6 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
         }
     )
 
-# 添加CORS中间件
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # 允许所有来源
-    allow_credentials=True,
-    allow_methods=["*"],  # 允许所有方法
-    allow_headers=["*"],  # 允许所有头部
-)
-
 # 定义支持的模型列表
 SUPPORTED_MODELS = [
     {
@@ -90,21 +154,32 @@ MODEL_TO_CHAT_ID = {
     "deepseek_public_r1": "deep_seek"
 }
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('yuanbao_api.log', mode='w', encoding='utf-8'),
-        logging.StreamHandler()  # 同时输出到控制台
-    ]
-)
+# 日志文件，为空时只输出到控制台
+LOG_FILE = os.environ.get("YUANBAO_LOG_FILE", "yuanbao_api.log")
 
 logger = logging.getLogger(__name__)
+_logging_configured = False
 
-# 添加测试日志
-logger.info("=== API服务启动 ===")
-logger.info(f"当前时间: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+def setup_logging(log_file: Optional[str] = None):
+    """配置日志输出（只在第一次调用时生效）；导入模块本身不会创建或清空日志文件"""
+    global _logging_configured
+    if _logging_configured:
+        return
+    _logging_configured = True
+    log_file = LOG_FILE if log_file is None else log_file
+    handlers = [logging.StreamHandler()]  # 同时输出到控制台
+    if log_file:
+        # 由 supervisor 启动的工作进程追加写入，避免重启时清空日志
+        handlers.insert(0, logging.FileHandler(log_file, mode='a' if os.environ.get("YUANBAO_READY_FD") else 'w', encoding='utf-8'))
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=handlers
+    )
+    
+    # 添加测试日志
+    logger.info("=== API服务启动 ===")
+    logger.info(f"当前时间: {time.strftime('%Y-%m-%d %H:%M:%S')}")
 
 class Message(BaseModel):
     role: str
@@ -128,6 +203,7 @@ class ChatCompletionRequest(BaseModel):
     temperature: Optional[float] = 0.7
     max_tokens: Optional[int] = 2000
     stream: Optional[bool] = False
+    stream_options: Optional[Dict[str, Any]] = None
 
 class ChatCompletionResponse(BaseModel):
     id: str
@@ -147,59 +223,519 @@ class ChatCompletionMessage(BaseModel):
     content: Optional[str] = None
     tool_calls: Optional[List[ToolCall]] = None
 
+class ResponsesRequest(BaseModel):
+    model: str = "deepseek_v3"
+    input: Optional[Union[str, List[Any]]] = None
+    instructions: Optional[str] = None
+    previous_response_id: Optional[str] = None
+    stream: Optional[bool] = False
+    store: Optional[bool] = True
+    max_output_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    # 兼容旧的 Chat Completions 风格请求
+    messages: Optional[List[Message]] = None
+
 # 模型配置存储（包含对应的 Headers）
 MODEL_SESSIONS = {}
+# 账号配置存储：账号ID -> Headers，每个配置文件对应一个账号
+ACCOUNT_SESSIONS = {}
 # 存储每个模型的对话ID
 MODEL_CONVERSATION_IDS = {}
+# 存储每个对话ID所属的账号
+CONVERSATION_ACCOUNTS = {}
+
+# 配置文件匹配模式，例如 yuanbao_model_sessions.txt、yuanbao_model_sessions_b.txt
+SESSIONS_FILE_PATTERN = os.environ.get("YUANBAO_SESSIONS_FILES", "yuanbao_model_sessions*.txt")
+# 配置文件轮询间隔（秒），小于等于 0 表示不自动监听
+SESSIONS_RELOAD_INTERVAL = float(os.environ.get("YUANBAO_SESSIONS_RELOAD_INTERVAL", "2"))
+
+# 极简默认Headers
+DEFAULT_HEADERS = {
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36 Edg/133.0.0.0",
+    "accept": "application/json, text/plain, */*",
+    "content-type": "application/json",
+    "origin": "https://tencent.yuanbao",
+    "referer": "https://tencent.yuanbao/",
+    "x-requested-with": "XMLHttpRequest"
+}
+
+_sessions_lock = threading.Lock()
+_sessions_fingerprint = {}
+_account_cursor = itertools.count()
+_sessions_watcher_stop = threading.Event()
+_sessions_watcher_thread = None
+# 配置文件在 create_app 或第一次请求元宝时才加载
+_sessions_loaded = threading.Event()
+
+def get_session_files() -> List[str]:
+    """返回所有匹配的配置文件路径（按文件名排序）"""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return sorted(glob.glob(os.path.join(script_dir, SESSIONS_FILE_PATTERN)))
+
+def get_account_id(config_path: str) -> str:
+    """由配置文件名得到账号ID：yuanbao_model_sessions.txt -> default，yuanbao_model_sessions_b.txt -> b"""
+    stem = os.path.splitext(os.path.basename(config_path))[0]
+    suffix = stem.replace("yuanbao_model_sessions", "", 1).strip("_-.")
+    return suffix or "default"
+
+def parse_session_file(config_path: str) -> dict:
+    """读取单个配置文件，返回合并默认值后的 Headers"""
+    headers = DEFAULT_HEADERS.copy()
+    with open(config_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                parts = line.split(':', 1)
+                if len(parts) == 2:
+                    key, val = parts[0].strip(), parts[1].strip()
+                    headers[key] = val
+    return headers
+
+def load_account_sessions() -> Dict[str, dict]:
+    """读取所有配置文件，返回 账号ID -> Headers"""
+    accounts = {}
+    for config_path in get_session_files():
+        try:
+            logger.info(f"正在加载配置: {config_path}")
+            headers = parse_session_file(config_path)
+            accounts[get_account_id(config_path)] = headers
+            logger.info(f"配置加载完成，共计 {len(headers)} 个 Header 字段")
+        except Exception as e:
+            logger.error(f"配置文件解析失败: {config_path}, {str(e)}")
+    return accounts
 
 # 读取模型配置
 def load_model_sessions():
-    """读取并合并配置文件中的 Headers"""
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    config_path = os.path.join(script_dir, 'yuanbao_model_sessions.txt')
-    
-    if not os.path.exists(config_path):
-        logger.error(f"配置文件不存在: {config_path}")
+    """读取并合并配置文件中的 Headers（默认账号）"""
+    accounts = load_account_sessions()
+    if not accounts:
+        logger.error(f"配置文件不存在: {SESSIONS_FILE_PATTERN}")
         return {}
+    headers = next(iter(accounts.values()))
+    return {model: headers.copy() for model in MODEL_TO_CHAT_ID.keys()}
 
-    # 极简默认Headers
-    headers = {
-        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36 Edg/133.0.0.0",
-        "accept": "application/json, text/plain, */*",
-        "content-type": "application/json",
-        "origin": "https://tencent.yuanbao",
-        "referer": "https://tencent.yuanbao/",
-        "x-requested-with": "XMLHttpRequest"
+def _get_sessions_fingerprint() -> Dict[str, tuple]:
+    fingerprint = {}
+    for config_path in get_session_files():
+        try:
+            stat = os.stat(config_path)
+            fingerprint[config_path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            continue
+    return fingerprint
+
+def reload_sessions(reason: str = "手动触发") -> dict:
+    """
+    重新加载配置文件并原子替换账号 Headers
+
+    正在进行的请求已持有旧 Headers 的副本，不受影响；新请求使用新 Headers。
+    被移除或 x-id 发生变化的账号视为已吊销，其对话ID会被清除。
+    """
+    global ACCOUNT_SESSIONS, MODEL_SESSIONS, _sessions_fingerprint
+    with _sessions_lock:
+        fingerprint = _get_sessions_fingerprint()
+        accounts = load_account_sessions()
+        if not accounts and ACCOUNT_SESSIONS:
+            # 文件被删除或正在写入时保留旧配置，避免所有请求失败
+            logger.error(f"重新加载配置失败（{reason}），继续使用旧配置")
+            return {"status": "error", "message": "未读取到任何有效配置，继续使用旧配置", "accounts": sorted(ACCOUNT_SESSIONS)}
+
+        old_accounts = ACCOUNT_SESSIONS
+        revoked = [
+            account_id for account_id, headers in old_accounts.items()
+            if account_id not in accounts or accounts[account_id].get("x-id") != headers.get("x-id")
+        ]
+        updated = [
+            account_id for account_id, headers in accounts.items()
+            if account_id in old_accounts and account_id not in revoked and old_accounts[account_id] != headers
+        ]
+
+        # 整体替换（而非原地修改），保证读取方总是看到一致的快照
+        ACCOUNT_SESSIONS = accounts
+        MODEL_SESSIONS = {model: next(iter(accounts.values())).copy() for model in MODEL_TO_CHAT_ID.keys()} if accounts else {}
+        _sessions_fingerprint = fingerprint
+        _sessions_loaded.set()
+
+        invalidated = invalidate_account_conversations(revoked) if revoked else 0
+
+    sync_account_auth(updated + revoked)
+    logger.info(f"配置已重新加载（{reason}）: 账号 {sorted(accounts)}，更新 {updated}，吊销 {revoked}，清除对话 {invalidated} 个")
+    return {
+        "status": "ok",
+        "accounts": sorted(accounts),
+        "updated": updated,
+        "revoked": revoked,
+        "invalidated_conversations": invalidated
     }
-    
+
+def invalidate_account_conversations(account_ids: List[str]) -> int:
+    """清除属于指定账号的对话ID，返回清除数量"""
+    count = 0
+    for model, conversation_id in list(MODEL_CONVERSATION_IDS.items()):
+        if CONVERSATION_ACCOUNTS.get(conversation_id) in account_ids:
+            MODEL_CONVERSATION_IDS.pop(model, None)
+            CONVERSATION_ACCOUNTS.pop(conversation_id, None)
+            logger.info(f"账号已吊销，清除对话ID: {model} -> {conversation_id}")
+            count += 1
+    for model, pool in PREWARMED_CONVERSATIONS.items():
+        kept = [cid for cid in pool if CONVERSATION_ACCOUNTS.get(cid) not in account_ids]
+        count += len(pool) - len(kept)
+        PREWARMED_CONVERSATIONS[model] = kept
+    return count
+
+# 凭证失效的判断：元宝对 hy-token 过期的请求返回的状态码
+AUTH_FAILURE_STATUS_CODES = (401, 403)
+# 连续鉴权失败多少次后视为凭证已失效
+ACCOUNT_AUTH_FAILURE_THRESHOLD = int(os.environ.get("YUANBAO_ACCOUNT_AUTH_FAILURE_THRESHOLD", "1"))
+# token 预计过期前多久开始排空账号（秒）：不再分配新对话，进行中的请求继续完成
+ACCOUNT_DRAIN_BEFORE_EXPIRY = float(os.environ.get("YUANBAO_ACCOUNT_DRAIN_BEFORE_EXPIRY", "3600"))
+# 无法从 token 中解析过期时间时，按配置文件修改时间加该有效期（秒）估算；0 表示不估算
+ACCOUNT_TOKEN_TTL = float(os.environ.get("YUANBAO_ACCOUNT_TOKEN_TTL", "0"))
+# 账号状态变化时 POST 告警 JSON 到该地址，为空时只写日志
+ACCOUNT_ALERT_WEBHOOK = os.environ.get("YUANBAO_ACCOUNT_ALERT_WEBHOOK", "")
+
+# 账号ID -> {state: active|draining|expired, reason, expires_at, auth_failures, last_auth_failure_at, last_success_at, changed_at}
+ACCOUNT_AUTH = {}
+# 账号状态变化时调用的告警函数，参数为事件字典
+ACCOUNT_ALERT_HOOKS = []
+_account_auth_lock = threading.Lock()
+
+def _jwt_expiry(token: Optional[str]) -> Optional[float]:
+    """token 为 JWT 时返回其中的 exp（Unix 时间戳），否则返回 None"""
+    parts = (token or "").split(".")
+    if len(parts) != 3:
+        return None
     try:
-        logger.info(f"正在加载配置: {config_path}")
-        with open(config_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#'):
-                    parts = line.split(':', 1)
-                    if len(parts) == 2:
-                        key, val = parts[0].strip(), parts[1].strip()
-                        headers[key] = val
-        
-        # 只要文件读取成功，就为所有模型初始化 Headers
-        logger.info(f"配置加载完成，共计 {len(headers)} 个 Header 字段")
-        return {model: headers.copy() for model in MODEL_TO_CHAT_ID.keys()}
-            
-    except Exception as e:
-        logger.error(f"配置文件解析失败: {str(e)}")
-        return {}
+        payload = json.loads(base64.urlsafe_b64decode(parts[1] + "=" * (-len(parts[1]) % 4)))
+    except ValueError:
+        return None
+    exp = payload.get("exp") if isinstance(payload, dict) else None
+    return float(exp) if isinstance(exp, (int, float)) else None
+
+def estimate_token_expiry(headers: dict, config_mtime: Optional[float] = None) -> Optional[float]:
+    """
+    估算账号凭证的过期时间：优先解析 x-token 或 cookie 中 hy_token 的 JWT exp，
+    否则在设置了 ACCOUNT_TOKEN_TTL 时按配置文件修改时间估算；无法估算时返回 None
+    """
+    tokens = [headers.get("x-token")]
+    for item in headers.get("cookie", "").split(";"):
+        name, _, value = item.strip().partition("=")
+        if name == "hy_token":
+            tokens.append(value)
+    for token in tokens:
+        expires_at = _jwt_expiry(token)
+        if expires_at:
+            return expires_at
+    if ACCOUNT_TOKEN_TTL > 0 and config_mtime:
+        return config_mtime + ACCOUNT_TOKEN_TTL
+    return None
+
+def _set_account_state(account_id: str, info: dict, state: str, reason: str) -> Optional[dict]:
+    """修改账号状态（调用方持有 _account_auth_lock），状态有变化时返回告警事件"""
+    if info["state"] == state:
+        return None
+    event = {
+        "account_id": account_id,
+        "previous": info["state"],
+        "state": state,
+        "reason": reason,
+        "expires_at": info["expires_at"],
+        "time": time.time()
+    }
+    info.update(state=state, reason=reason, changed_at=event["time"])
+    return event
+
+def fire_account_alerts(events: List[Optional[dict]]):
+    """记录账号状态变化并在后台调用告警函数和 webhook，不阻塞请求"""
+    events = [event for event in events if event]
+    if not events:
+        return
+    for event in events:
+        logger.warning(f"账号状态变化: {event['account_id']} {event['previous']} -> {event['state']}，原因: {event['reason']}")
+
+    def deliver():
+        for event in events:
+            for hook in list(ACCOUNT_ALERT_HOOKS):
+                try:
+                    hook(event)
+                except Exception as e:
+                    logger.error(f"账号告警回调出错: {str(e)}")
+            if ACCOUNT_ALERT_WEBHOOK:
+                try:
+                    requests.post(ACCOUNT_ALERT_WEBHOOK, json=event, timeout=5).raise_for_status()
+                except Exception as e:
+                    logger.error(f"发送账号告警失败: {str(e)}")
 
-MODEL_SESSIONS = load_model_sessions()
+    threading.Thread(target=deliver, name="account-alert", daemon=True).start()
 
-def create_conversation(model: str) -> str:
+def _expiry_state(info: dict, now: float) -> str:
+    if info["expires_at"] and info["expires_at"] - now <= ACCOUNT_DRAIN_BEFORE_EXPIRY:
+        return "draining"
+    return "active"
+
+def _expiry_reason(info: dict, now: float) -> str:
+    return f"凭证预计 {max(info['expires_at'] - now, 0) / 60:.0f} 分钟后过期"
+
+def sync_account_auth(refreshed: List[str] = ()):
+    """配置重新加载后同步账号状态：新账号和更换了凭证的账号重新开始计算，已移除的账号删除"""
+    mtimes = {}
+    for config_path in get_session_files():
+        try:
+            mtimes[get_account_id(config_path)] = os.stat(config_path).st_mtime
+        except OSError:
+            continue
+    events = []
+    now = time.time()
+    with _account_auth_lock:
+        for account_id in list(ACCOUNT_AUTH):
+            if account_id not in ACCOUNT_SESSIONS:
+                ACCOUNT_AUTH.pop(account_id)
+        for account_id, headers in ACCOUNT_SESSIONS.items():
+            previous = ACCOUNT_AUTH.get(account_id)
+            if previous is not None and account_id not in refreshed:
+                continue
+            info = {
+                "state": previous["state"] if previous else "active",
+                "reason": None,
+                "expires_at": estimate_token_expiry(headers, mtimes.get(account_id)),
+                "auth_failures": 0,
+                "last_auth_failure_at": None,
+                "last_success_at": None,
+                "changed_at": now
+            }
+            ACCOUNT_AUTH[account_id] = info
+            state = _expiry_state(info, now)
+            events.append(_set_account_state(account_id, info, state, _expiry_reason(info, now) if state == "draining" else "凭证已更新"))
+    fire_account_alerts(events)
+
+def account_state(account_id: Optional[str]) -> str:
+    """账号当前状态；到达预计过期时间前 ACCOUNT_DRAIN_BEFORE_EXPIRY 秒时转为 draining"""
+    info = ACCOUNT_AUTH.get(account_id)
+    if info is None:
+        return "active"
+    event = None
+    if info["state"] == "active" and _expiry_state(info, time.time()) == "draining":
+        with _account_auth_lock:
+            event = _set_account_state(account_id, info, "draining", _expiry_reason(info, time.time()))
+    fire_account_alerts([event])
+    return info["state"]
+
+def record_account_auth(account_id: Optional[str], ok: bool, status_code: Optional[int] = None, source: str = "请求"):
+    """根据上游响应或健康探测结果更新账号的鉴权状态"""
+    info = ACCOUNT_AUTH.get(account_id)
+    if info is None:
+        return
+    event = None
+    now = time.time()
+    with _account_auth_lock:
+        if ok:
+            info["auth_failures"] = 0
+            info["last_success_at"] = now
+            if info["state"] == "expired":
+                event = _set_account_state(account_id, info, _expiry_state(info, now), f"{source}鉴权恢复")
+        else:
+            info["auth_failures"] += 1
+            info["last_auth_failure_at"] = now
+            if info["auth_failures"] >= ACCOUNT_AUTH_FAILURE_THRESHOLD:
+                event = _set_account_state(account_id, info, "expired", f"{source}返回 {status_code}")
+    fire_account_alerts([event])
+
+def is_auth_failure(error: Exception) -> Optional[int]:
+    """上游请求因凭证失效失败时返回状态码，否则返回 None"""
+    response = getattr(error, "response", None)
+    status_code = getattr(response, "status_code", None)
+    return status_code if status_code in AUTH_FAILURE_STATUS_CODES else None
+
+def select_account() -> Optional[str]:
+    """
+    轮询选择一个账号用于创建新对话
+
+    排空中和凭证失效的账号不再分配新对话；没有正常账号时依次退而使用排空中的账号、任意账号
+    """
+    accounts = list(ACCOUNT_SESSIONS)
+    if not accounts:
+        return None
+    states = {account_id: account_state(account_id) for account_id in accounts}
+    for allowed in (("active",), ("active", "draining")):
+        candidates = [account_id for account_id in accounts if states[account_id] in allowed]
+        if candidates:
+            return candidates[next(_account_cursor) % len(candidates)]
+    return accounts[next(_account_cursor) % len(accounts)]
+
+def get_conversation_headers(conversation_id: str, model: str) -> Optional[dict]:
+    """返回对话所属账号的 Headers 副本"""
+    headers = ACCOUNT_SESSIONS.get(CONVERSATION_ACCOUNTS.get(conversation_id)) or MODEL_SESSIONS.get(model)
+    return headers.copy() if headers else None
+
+def _watch_session_files():
+    """后台轮询配置文件，文件内容稳定后自动重新加载"""
+    pending = None
+    while not _sessions_watcher_stop.wait(SESSIONS_RELOAD_INTERVAL):
+        try:
+            fingerprint = _get_sessions_fingerprint()
+            if fingerprint == _sessions_fingerprint:
+                pending = None
+                continue
+            # 连续两次轮询结果一致才重新加载，避免读到写了一半的文件
+            if fingerprint == pending:
+                reload_sessions("配置文件变更")
+                pending = None
+            else:
+                pending = fingerprint
+        except Exception as e:
+            logger.error(f"监听配置文件出错: {str(e)}")
+
+def start_session_watcher():
+    global _sessions_watcher_thread
+    if SESSIONS_RELOAD_INTERVAL <= 0 or _sessions_watcher_thread is not None:
+        return
+    _sessions_watcher_stop.clear()
+    _sessions_watcher_thread = threading.Thread(target=_watch_session_files, name="sessions-watcher", daemon=True)
+    _sessions_watcher_thread.start()
+    logger.info(f"已启动配置文件监听，间隔 {SESSIONS_RELOAD_INTERVAL} 秒")
+
+def stop_session_watcher():
+    global _sessions_watcher_thread
+    _sessions_watcher_stop.set()
+    if _sessions_watcher_thread is not None:
+        _sessions_watcher_thread.join(timeout=5)
+        _sessions_watcher_thread = None
+
+# 上游服务地址
+UPSTREAM_HOST = "yuanbao.tencent.com"
+UPSTREAM_BASE_URL = f"https://{UPSTREAM_HOST}"
+# 上游连接池大小
+UPSTREAM_POOL_SIZE = int(os.environ.get("YUANBAO_UPSTREAM_POOL_SIZE", "20"))
+# DNS 缓存有效期（秒）
+DNS_CACHE_TTL = float(os.environ.get("YUANBAO_DNS_CACHE_TTL", "300"))
+# 启动预热：预先建立的连接数、每个模型/账号预创建的对话数、总时间预算（秒）
+WARMUP_CONNECTIONS = int(os.environ.get("YUANBAO_WARMUP_CONNECTIONS", "4"))
+WARMUP_CONVERSATIONS = int(os.environ.get("YUANBAO_WARMUP_CONVERSATIONS", "1"))
+WARMUP_BUDGET = float(os.environ.get("YUANBAO_WARMUP_BUDGET", "10"))
+
+def create_upstream_session() -> requests.Session:
+    """创建复用 TCP/TLS 连接的上游 Session（不保存 Cookie，避免多账号互相串用）"""
+    session = requests.Session()
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_POOL_SIZE)
+    session.mount("https://", adapter)
+    return session
+
+# 连接在第一次请求时才建立；create_app 会按配置的连接池大小重新挂载 adapter
+UPSTREAM_SESSION = create_upstream_session()
+
+_dns_cache = {}
+_original_getaddrinfo = socket.getaddrinfo
+
+def _cached_getaddrinfo(host, *args, **kwargs):
+    """只对上游域名缓存 DNS 解析结果，其它域名直接解析"""
+    if host != UPSTREAM_HOST:
+        return _original_getaddrinfo(host, *args, **kwargs)
+    key = (host, args, tuple(sorted(kwargs.items())))
+    cached = _dns_cache.get(key)
+    if cached and cached[0] > time.time():
+        return cached[1]
+    result = _original_getaddrinfo(host, *args, **kwargs)
+    _dns_cache[key] = (time.time() + DNS_CACHE_TTL, result)
+    return result
+
+def install_dns_cache():
+    """替换 socket.getaddrinfo 以缓存上游域名解析（进程级副作用，由 create_app 调用）"""
+    socket.getaddrinfo = _cached_getaddrinfo
+
+# 预热状态，预热完成前 /health/ready 返回 503
+WARMUP_STATE = {
+    "ready": False,
+    "started_at": None,
+    "finished_at": None,
+    "dns": [],
+    "connections": 0,
+    "conversations": 0,
+    "errors": []
+}
+# 预创建、尚未使用的对话ID：模型 -> [对话ID]
+PREWARMED_CONVERSATIONS = {}
+
+def _warmup_resolve_dns():
+    infos = socket.getaddrinfo(UPSTREAM_HOST, 443, type=socket.SOCK_STREAM)
+    WARMUP_STATE["dns"] = sorted({info[4][0] for info in infos})
+    logger.info(f"预热：DNS 解析完成 {UPSTREAM_HOST} -> {WARMUP_STATE['dns']}")
+
+def _warmup_connections(deadline: float):
+    """并发发起轻量请求，让连接池中建立好 TCP/TLS 连接"""
+    def open_connection(_):
+        response = UPSTREAM_SESSION.head(UPSTREAM_BASE_URL, verify=False, timeout=max(deadline - time.time(), 0.1))
+        response.close()
+
+    count = min(WARMUP_CONNECTIONS, UPSTREAM_POOL_SIZE)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(count, 1)) as executor:
+        futures = [executor.submit(open_connection, i) for i in range(count)]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+                WARMUP_STATE["connections"] += 1
+            except Exception as e:
+                WARMUP_STATE["errors"].append(f"连接预热失败: {str(e)}")
+    logger.info(f"预热：已建立 {WARMUP_STATE['connections']}/{count} 个上游连接")
+
+def _warmup_conversations(deadline: float):
+    """为每个模型、每个账号预创建对话"""
+    for model in MODEL_TO_CHAT_ID:
+        for account_id in list(ACCOUNT_SESSIONS):
+            for _ in range(WARMUP_CONVERSATIONS):
+                if time.time() >= deadline:
+                    WARMUP_STATE["errors"].append("预热超出时间预算，跳过剩余对话")
+                    return
+                try:
+                    conversation_id = create_conversation(
+                        model, account_id=account_id, activate=False,
+                        timeout=max(deadline - time.time(), 0.1)
+                    )
+                    PREWARMED_CONVERSATIONS.setdefault(model, []).append(conversation_id)
+                    WARMUP_STATE["conversations"] += 1
+                except Exception as e:
+                    WARMUP_STATE["errors"].append(f"预创建对话失败 {model}/{account_id}: {str(e)}")
+    logger.info(f"预热：已预创建 {WARMUP_STATE['conversations']} 个对话")
+
+def run_warmup():
+    """启动预热：解析 DNS、建立连接池、预创建对话、加载分词器，总耗时受 WARMUP_BUDGET 限制"""
+    WARMUP_STATE["started_at"] = time.time()
+    deadline = WARMUP_STATE["started_at"] + WARMUP_BUDGET
+    steps = [
+        lambda: _warmup_resolve_dns(),
+        lambda: _warmup_connections(deadline),
+        lambda: _warmup_conversations(deadline),
+        lambda: get_tokenizer(),
+    ]
+    for step in steps:
+        if time.time() >= deadline:
+            WARMUP_STATE["errors"].append("预热超出时间预算")
+            break
+        try:
+            step()
+        except Exception as e:
+            WARMUP_STATE["errors"].append(str(e))
+            logger.error(f"预热步骤失败: {str(e)}")
+
+    WARMUP_STATE["finished_at"] = time.time()
+    WARMUP_STATE["ready"] = True
+    logger.info(f"预热完成，耗时 {WARMUP_STATE['finished_at'] - WARMUP_STATE['started_at']:.2f} 秒，错误 {len(WARMUP_STATE['errors'])} 个")
+    notify_supervisor_ready()
+
+def create_conversation(model: str, account_id: Optional[str] = None, activate: bool = True, timeout: Optional[float] = None) -> str:
     """
     创建新的对话
+
+    Args:
+        model: 模型名称
+        account_id: 指定账号，默认轮询选择
+        activate: 是否设为该模型当前使用的对话
+        timeout: 请求超时时间（秒）
     """
-    url = "https://yuanbao.tencent.com/api/user/agent/conversation/v1/detail"
+    url = f"{UPSTREAM_BASE_URL}/api/user/agent/conversation/v1/detail"
     
-    headers = MODEL_SESSIONS.get(model)
+    account_id = account_id or select_account()
+    headers = ACCOUNT_SESSIONS.get(account_id) or MODEL_SESSIONS.get(model)
     if not headers:
         raise ValueError(f"未找到模型 {model} 的配置")
     
@@ -213,21 +749,44 @@ def create_conversation(model: str) -> str:
     }
     
     try:
-        response = requests.post(url, headers=headers, json=payload, verify=False)
+        response = UPSTREAM_SESSION.post(url, headers=headers, json=payload, verify=False, timeout=timeout)
         response.raise_for_status()
         
         result = response.json()
-        logger.info(f"创建对话成功: {conversation_id}")
+        logger.info(f"创建对话成功: {conversation_id} (账号: {account_id})")
         
-        # 保存对话ID
-        MODEL_CONVERSATION_IDS[model] = conversation_id
+        # 保存对话ID及所属账号
+        CONVERSATION_ACCOUNTS[conversation_id] = account_id
+        if activate:
+            MODEL_CONVERSATION_IDS[model] = conversation_id
         
         return conversation_id
     except Exception as e:
         logger.error(f"创建对话失败: {str(e)}")
+        status_code = is_auth_failure(e)
+        if status_code:
+            record_account_auth(account_id, False, status_code, "创建对话")
         raise
 
 
+def take_prewarmed_conversation(model: str) -> Optional[str]:
+    """取出一个预创建的对话（跳过已吊销账号的对话）"""
+    pool = PREWARMED_CONVERSATIONS.get(model) or []
+    while pool:
+        try:
+            conversation_id = pool.pop()
+        except IndexError:
+            break
+        account_id = CONVERSATION_ACCOUNTS.get(conversation_id)
+        if account_id in ACCOUNT_SESSIONS and account_state(account_id) == "active":
+            return conversation_id
+        # 排空中账号的预创建对话不再使用，交给后台清理在上游删除
+        if account_id in ACCOUNT_SESSIONS:
+            with _conversations_lock:
+                RETIRED_CONVERSATIONS.setdefault(conversation_id, time.time())
+    return None
+
+
 def get_or_create_conversation(model: str, force_create: bool = False) -> str:
     """
     获取或创建对话ID
@@ -235,22 +794,522 @@ def get_or_create_conversation(model: str, force_create: bool = False) -> str:
     # 检查是否已有对话ID且不需要强制创建
     if not force_create and model in MODEL_CONVERSATION_IDS:
         conversation_id = MODEL_CONVERSATION_IDS[model]
-        logger.info(f"复用现有对话ID: {conversation_id}")
-        return conversation_id
+        account_id = CONVERSATION_ACCOUNTS.get(conversation_id)
+        state = account_state(account_id)
+        if state == "active" or not any(account_state(other) == "active" for other in ACCOUNT_SESSIONS):
+            logger.info(f"复用现有对话ID: {conversation_id}")
+            return conversation_id
+        # 账号排空中或凭证失效：新请求换用其它账号的对话，进行中的请求继续完成
+        retire_conversation(model, conversation_id, f"账号 {account_id} 状态为 {state}")
     
-    # 如果需要强制创建，先清除旧的对话ID
+    # 如果需要强制创建，先退役旧对话（稍后在上游删除）
     if force_create and model in MODEL_CONVERSATION_IDS:
-        old_id = MODEL_CONVERSATION_IDS[model]
-        logger.info(f"强制创建新对话，清除旧对话ID: {old_id}")
-        del MODEL_CONVERSATION_IDS[model]
+        retire_conversation(model, MODEL_CONVERSATION_IDS[model], "强制创建新对话")
+    
+    # 优先使用启动时预创建的对话
+    conversation_id = take_prewarmed_conversation(model)
+    if conversation_id:
+        logger.info(f"使用预创建的对话ID: {conversation_id}")
+        MODEL_CONVERSATION_IDS[model] = conversation_id
+        return conversation_id
     
     # 创建新的对话
     return create_conversation(model)
 
-def parse_tool_call(response_text: str, has_tool_result_in_history: bool = False) -> Optional[dict]:
+# 对话轮换阈值：达到任一条件即退役并换用新对话
+CONVERSATION_MAX_TURNS = int(os.environ.get("YUANBAO_CONVERSATION_MAX_TURNS", "20"))
+CONVERSATION_MAX_PROMPT_BYTES = int(os.environ.get("YUANBAO_CONVERSATION_MAX_PROMPT_BYTES", str(256 * 1024)))
+# 首包延迟（平滑值）超过该对话前几轮基线的倍数时退役
+CONVERSATION_LATENCY_FACTOR = float(os.environ.get("YUANBAO_CONVERSATION_LATENCY_FACTOR", "2.0"))
+CONVERSATION_LATENCY_MIN_TURNS = 3
+# 退役对话在上游删除前的等待时间（秒）以及清理间隔（秒）
+CONVERSATION_DELETE_DELAY = float(os.environ.get("YUANBAO_CONVERSATION_DELETE_DELAY", "60"))
+CONVERSATION_CLEANUP_INTERVAL = float(os.environ.get("YUANBAO_CONVERSATION_CLEANUP_INTERVAL", "60"))
+# 上游删除对话的接口（按网页版抓包得到，元宝调整接口后可通过环境变量修改）
+CONVERSATION_DELETE_PATH = os.environ.get("YUANBAO_CONVERSATION_DELETE_PATH", "/api/user/agent/conversation/v1/clear")
+# 每个模型、每个账号最多保留的备用对话数（对话退役时在后台补充）
+CONVERSATION_SPARES_PER_ACCOUNT = int(os.environ.get("YUANBAO_CONVERSATION_SPARES_PER_ACCOUNT", "1"))
+
+# 对话统计：对话ID -> {model, turns, prompt_bytes, latency, baseline_latency, in_flight, created_at}
+CONVERSATION_STATS = {}
+# 已退役、等待在上游删除的对话：对话ID -> 退役时间
+RETIRED_CONVERSATIONS = {}
+# 被 /v1/responses 存储引用的对话，由存储淘汰时退役，不参与自动轮换
+PINNED_CONVERSATIONS = set()
+# 正在后台创建的备用对话：(模型, 账号)
+_spares_creating = set()
+# 上游删除的结果统计（/api/conversations 查看）
+CONVERSATION_CLEANUP_STATS = collections.Counter()
+_conversations_lock = threading.Lock()
+_conversation_cleaner_stop = threading.Event()
+_conversation_cleaner_thread = None
+
+def _get_conversation_stats(conversation_id: str, model: str) -> dict:
+    stats = CONVERSATION_STATS.get(conversation_id)
+    if stats is None:
+        stats = {
+            "model": model,
+            "turns": 0,
+            "prompt_bytes": 0,
+            "latency": None,
+            "baseline_latency": None,
+            "in_flight": 0,
+            "created_at": time.time()
+        }
+        CONVERSATION_STATS[conversation_id] = stats
+    return stats
+
+def begin_conversation_turn(conversation_id: str, model: str, prompt: str):
+    """记录一轮对话开始：累计轮数和提示词字节数"""
+    with _conversations_lock:
+        stats = _get_conversation_stats(conversation_id, model)
+        stats["turns"] += 1
+        stats["prompt_bytes"] += len(prompt.encode("utf-8"))
+        stats["in_flight"] += 1
+
+def end_conversation_turn(conversation_id: str, model: str, latency: Optional[float] = None):
+    """记录一轮对话结束，必要时退役该对话"""
+    with _conversations_lock:
+        stats = _get_conversation_stats(conversation_id, model)
+        stats["in_flight"] = max(stats["in_flight"] - 1, 0)
+        if latency is not None:
+            stats["latency"] = latency if stats["latency"] is None else 0.7 * stats["latency"] + 0.3 * latency
+            if stats["turns"] <= CONVERSATION_LATENCY_MIN_TURNS:
+                # 前几轮的最小延迟作为基线
+                stats["baseline_latency"] = min(stats["baseline_latency"] or latency, latency)
+        reason = get_retire_reason(stats) if conversation_id not in PINNED_CONVERSATIONS else None
+    if reason:
+        retire_conversation(model, conversation_id, reason)
+
+def get_retire_reason(stats: dict) -> Optional[str]:
+    """判断对话是否需要退役，返回原因"""
+    if stats["turns"] >= CONVERSATION_MAX_TURNS:
+        return f"轮数达到 {stats['turns']}"
+    if stats["prompt_bytes"] >= CONVERSATION_MAX_PROMPT_BYTES:
+        return f"累计提示词 {stats['prompt_bytes']} 字节"
+    if (stats["turns"] > CONVERSATION_LATENCY_MIN_TURNS and stats["baseline_latency"]
+            and stats["latency"] > stats["baseline_latency"] * CONVERSATION_LATENCY_FACTOR):
+        return f"首包延迟 {stats['latency']:.2f}s 超过基线 {stats['baseline_latency']:.2f}s 的 {CONVERSATION_LATENCY_FACTOR} 倍"
+    return None
+
+def retire_conversation(model: str, conversation_id: str, reason: str):
+    """退役对话：新请求不再使用它，后台补充一个新对话，稍后在上游删除"""
+    with _conversations_lock:
+        if conversation_id in RETIRED_CONVERSATIONS:
+            return
+        RETIRED_CONVERSATIONS[conversation_id] = time.time()
+    if MODEL_CONVERSATION_IDS.get(model) == conversation_id:
+        MODEL_CONVERSATION_IDS.pop(model, None)
+    logger.info(f"对话退役: {model} -> {conversation_id}，原因: {reason}")
+    account_id = select_account()
+    with _conversations_lock:
+        # 该账号已有足够的备用对话（或正在创建）时不再补充，避免频繁退役时对话数无限增长
+        spares = sum(1 for cid in PREWARMED_CONVERSATIONS.get(model, []) if CONVERSATION_ACCOUNTS.get(cid) == account_id)
+        if (model, account_id) in _spares_creating or spares >= CONVERSATION_SPARES_PER_ACCOUNT:
+            return
+        _spares_creating.add((model, account_id))
+    threading.Thread(target=_create_spare_conversation, args=(model, account_id), daemon=True).start()
+
+def _create_spare_conversation(model: str, account_id: str):
+    """预先创建一个备用对话，下次请求无需等待创建"""
+    try:
+        conversation_id = create_conversation(model, account_id=account_id, activate=False)
+        PREWARMED_CONVERSATIONS.setdefault(model, []).append(conversation_id)
+    except Exception as e:
+        logger.error(f"创建备用对话失败: {str(e)}")
+    finally:
+        with _conversations_lock:
+            _spares_creating.discard((model, account_id))
+
+def delete_conversations_upstream(account_id: str, conversation_ids: List[str]):
+    """在上游批量删除对话"""
+    headers = ACCOUNT_SESSIONS.get(account_id)
+    if not headers:
+        return
+    response = UPSTREAM_SESSION.post(
+        f"{UPSTREAM_BASE_URL}{CONVERSATION_DELETE_PATH}",
+        headers=headers,
+        json={"conversationIds": conversation_ids},
+        verify=False,
+        timeout=10
+    )
+    response.raise_for_status()
+    # 元宝的业务错误以 200 + 非零 code 返回
+    try:
+        result = response.json()
+    except ValueError:
+        result = None
+    if isinstance(result, dict) and result.get("code") not in (None, 0, "0"):
+        raise RuntimeError(f"上游返回错误: code={result.get('code')} msg={result.get('msg') or result.get('message')}")
+
+def cleanup_retired_conversations() -> int:
+    """删除已退役且没有进行中请求的对话，返回删除数量"""
+    now = time.time()
+    by_account = {}
+    with _conversations_lock:
+        for conversation_id, retired_at in list(RETIRED_CONVERSATIONS.items()):
+            stats = CONVERSATION_STATS.get(conversation_id, {})
+            if now - retired_at < CONVERSATION_DELETE_DELAY:
+                continue
+            # 仍有进行中的请求时暂不删除（超过 10 分钟视为计数丢失）
+            if stats.get("in_flight") and now - retired_at < CONVERSATION_DELETE_DELAY + 600:
+                continue
+            by_account.setdefault(CONVERSATION_ACCOUNTS.get(conversation_id), []).append(conversation_id)
+
+    deleted = 0
+    for account_id, conversation_ids in by_account.items():
+        try:
+            delete_conversations_upstream(account_id, conversation_ids)
+            CONVERSATION_CLEANUP_STATS["deleted"] += len(conversation_ids)
+            logger.info(f"已在上游删除退役对话 {len(conversation_ids)} 个（账号: {account_id}）")
+        except Exception as e:
+            CONVERSATION_CLEANUP_STATS["failures"] += 1
+            status_code = getattr(getattr(e, "response", None), "status_code", None)
+            if status_code in (404, 405):
+                # 删除接口不存在：重试没有意义，放弃并提示检查配置
+                logger.error(f"上游删除接口不可用（{CONVERSATION_DELETE_PATH} 返回 {status_code}），"
+                             f"{len(conversation_ids)} 个退役对话需要手动删除，请检查 YUANBAO_CONVERSATION_DELETE_PATH")
+            else:
+                logger.error(f"删除退役对话失败（账号: {account_id}）: {str(e)}")
+                # 账号已不存在或凭证失效时无法再删除，放弃这些对话；其它错误下次重试
+                if account_id in ACCOUNT_SESSIONS and account_state(account_id) != "expired":
+                    continue
+            CONVERSATION_CLEANUP_STATS["abandoned"] += len(conversation_ids)
+        with _conversations_lock:
+            for conversation_id in conversation_ids:
+                RETIRED_CONVERSATIONS.pop(conversation_id, None)
+                CONVERSATION_STATS.pop(conversation_id, None)
+                CONVERSATION_ACCOUNTS.pop(conversation_id, None)
+        deleted += len(conversation_ids)
+    return deleted
+
+def _run_conversation_cleaner():
+    while not _conversation_cleaner_stop.wait(CONVERSATION_CLEANUP_INTERVAL):
+        try:
+            cleanup_retired_conversations()
+        except Exception as e:
+            logger.error(f"清理退役对话出错: {str(e)}")
+
+def start_conversation_cleaner():
+    global _conversation_cleaner_thread
+    if CONVERSATION_CLEANUP_INTERVAL <= 0 or _conversation_cleaner_thread is not None:
+        return
+    _conversation_cleaner_stop.clear()
+    _conversation_cleaner_thread = threading.Thread(target=_run_conversation_cleaner, name="conversation-cleaner", daemon=True)
+    _conversation_cleaner_thread.start()
+
+def stop_conversation_cleaner():
+    global _conversation_cleaner_thread
+    _conversation_cleaner_stop.set()
+    if _conversation_cleaner_thread is not None:
+        _conversation_cleaner_thread.join(timeout=5)
+        _conversation_cleaner_thread = None
+
+# 账号健康探测间隔（秒），0 表示关闭；/health/ready 只读取缓存的探测结果，不会同步请求上游
+HEALTH_PROBE_INTERVAL = float(os.environ.get("YUANBAO_HEALTH_PROBE_INTERVAL", "30"))
+HEALTH_PROBE_TIMEOUT = float(os.environ.get("YUANBAO_HEALTH_PROBE_TIMEOUT", "5"))
+# 至少有几个账号探测正常才算就绪
+READY_MIN_HEALTHY_ACCOUNTS = int(os.environ.get("YUANBAO_READY_MIN_HEALTHY_ACCOUNTS", "1"))
+# 排队等待元宝并发名额的请求数达到该值时视为饱和、暂不就绪；0 表示不按排队数判断
+READY_MAX_QUEUED = int(os.environ.get("YUANBAO_READY_MAX_QUEUED", "0"))
+
+# 账号ID -> 最近一次探测结果 {ok, status_code, latency_ms, checked_at, error, consecutive_failures}
+ACCOUNT_HEALTH = {}
+HEALTH_PROBE_STATE = {"last_probe_at": None, "probes": 0}
+_health_prober_stop = threading.Event()
+_health_prober_thread = None
+
+def probe_account(account_id: str, headers: dict) -> dict:
     """
-    解析 AI 响应，检查是否是 tool call 格式
-    返回 tool call 字典或 None
+    用一次轻量请求验证账号：查询一个随机对话ID的详情，不会创建对话或产生对话内容
+
+    hy-token 过期时元宝返回 401/403
+    """
+    start = time.monotonic()
+    result = {"ok": False, "status_code": None, "error": None}
+    try:
+        response = UPSTREAM_SESSION.post(
+            f"{UPSTREAM_BASE_URL}/api/user/agent/conversation/v1/detail",
+            headers=headers,
+            json={"conversationId": str(uuid.uuid4()), "limit": 1, "offset": 0},
+            verify=False,
+            timeout=HEALTH_PROBE_TIMEOUT
+        )
+        result["status_code"] = response.status_code
+        response.raise_for_status()
+        response.json()
+        result["ok"] = True
+    except Exception as e:
+        result["error"] = str(e)[:200]
+    finally:
+        result["latency_ms"] = round((time.monotonic() - start) * 1000, 1)
+        result["checked_at"] = time.time()
+    return result
+
+def run_health_probe():
+    """探测所有账号并更新缓存的结果"""
+    global ACCOUNT_HEALTH
+    accounts = dict(ACCOUNT_SESSIONS)
+    if accounts:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(accounts), 8)) as executor:
+            results = dict(zip(accounts, executor.map(lambda item: probe_account(*item), accounts.items())))
+    else:
+        results = {}
+    for account_id, result in results.items():
+        previous = ACCOUNT_HEALTH.get(account_id) or {}
+        result["consecutive_failures"] = 0 if result["ok"] else previous.get("consecutive_failures", 0) + 1
+        if previous.get("ok", True) and not result["ok"]:
+            logger.warning(f"账号探测失败: {account_id}，状态码 {result['status_code']}，{result['error']}")
+        elif previous.get("ok") is False and result["ok"]:
+            logger.info(f"账号探测恢复: {account_id}")
+        if result["ok"] or result["status_code"] in AUTH_FAILURE_STATUS_CODES:
+            record_account_auth(account_id, result["ok"], result["status_code"], "健康探测")
+        account_state(account_id)
+    # 整体替换（而非原地修改），读取方总是看到一致的快照，已移除的账号不再出现在结果中
+    ACCOUNT_HEALTH = results
+    HEALTH_PROBE_STATE["last_probe_at"] = time.time()
+    HEALTH_PROBE_STATE["probes"] += 1
+
+def _run_health_prober():
+    while True:
+        try:
+            run_health_probe()
+        except Exception as e:
+            logger.error(f"账号健康探测出错: {str(e)}")
+        if _health_prober_stop.wait(HEALTH_PROBE_INTERVAL):
+            break
+
+def start_health_prober():
+    global _health_prober_thread
+    if HEALTH_PROBE_INTERVAL <= 0 or _health_prober_thread is not None:
+        return
+    _health_prober_stop.clear()
+    _health_prober_thread = threading.Thread(target=_run_health_prober, name="health-prober", daemon=True)
+    _health_prober_thread.start()
+
+def stop_health_prober():
+    global _health_prober_thread
+    _health_prober_stop.set()
+    if _health_prober_thread is not None:
+        _health_prober_thread.join(timeout=HEALTH_PROBE_TIMEOUT + 1)
+        _health_prober_thread = None
+
+def readiness_report() -> dict:
+    """根据预热状态、缓存的账号探测结果和并发名额占用情况判断是否就绪（只读内存状态）"""
+    reasons = []
+    if not WARMUP_STATE["ready"]:
+        reasons.append("warming_up")
+    if SERVER_STATE["draining"]:
+        reasons.append("draining")
+    account_health = ACCOUNT_HEALTH
+    # 凭证已失效的账号即使探测成功也不计入
+    healthy = sorted(account_id for account_id, result in account_health.items() if result["ok"] and account_state(account_id) != "expired")
+    if HEALTH_PROBE_INTERVAL > 0:
+        last_probe_at = HEALTH_PROBE_STATE["last_probe_at"]
+        if last_probe_at is None:
+            reasons.append("probe_pending")
+        elif time.time() - last_probe_at > HEALTH_PROBE_INTERVAL * 3 + HEALTH_PROBE_TIMEOUT:
+            reasons.append("probe_stale")
+        elif len(healthy) < READY_MIN_HEALTHY_ACCOUNTS:
+            reasons.append("no_healthy_accounts")
+    queued = UPSTREAM_SCHEDULER.queued()
+    saturated = READY_MAX_QUEUED > 0 and queued >= READY_MAX_QUEUED
+    if saturated:
+        reasons.append("saturated")
+    return {
+        "ready": not reasons,
+        "reasons": reasons,
+        "accounts": {
+            "healthy": healthy,
+            "unhealthy": sorted(account_id for account_id in account_health if account_id not in healthy),
+            "last_probe_at": HEALTH_PROBE_STATE["last_probe_at"],
+            "details": account_health,
+            "auth": {account_id: dict(info) for account_id, info in ACCOUNT_AUTH.items()}
+        },
+        "pool": {
+            "active": UPSTREAM_SCHEDULER.active,
+            "capacity": UPSTREAM_SCHEDULER.capacity,
+            "queued": queued,
+            "utilization": round(UPSTREAM_SCHEDULER.active / UPSTREAM_SCHEDULER.capacity, 3) if UPSTREAM_SCHEDULER.capacity else None,
+            "saturated": saturated,
+            "in_flight": SERVER_STATE["in_flight"]
+        }
+    }
+
+def _end_turn_after_stream(chunks, conversation_id: str, model: str, latency: float):
+    """流式响应结束（包括客户端断开）后记录本轮对话"""
+    try:
+        yield from chunks
+    finally:
+        end_conversation_turn(conversation_id, model, latency)
+
+# 对象内需要关注的结构字符，其余字符由正则引擎跳过
+_JSON_STRUCT_CHARS = re.compile(r'[{}\[\]":,]')
+# 字符串内需要关注的字符
+_JSON_STRING_CHARS = re.compile(r'["\\]')
+
+class ToolCallScanner:
+    """
+    线性时间扫描文本中的 JSON 对象，提取所有 "type": "tool_call" 的对象
+
+    - 一次扫描，不回溯；只有确认包含 "type": "tool_call" 的对象才会调用 json.loads
+    - 代码块（```json ... ```）和正文中的对象同样处理，可以提取多个（并行）tool call
+    - 支持增量输入：每次 feed 一段流式文本，返回这段文本中新完成的 tool call
+    """
+    # 单个未闭合对象最多缓存的字符数，超出后放弃该对象
+    MAX_OBJECT_CHARS = 1 << 20
+    # 识别 key/value 时只需要比较很短的字符串
+    MAX_TOKEN_CHARS = 16
+    # finish 时对未闭合的对象最多重新扫描的次数
+    MAX_RESCANS = 3
+
+    def __init__(self):
+        self.tool_calls = []
+        self._found_starts = set()  # 已提取对象的起始偏移，finish 重新扫描时去重
+        self._reset()
+
+    def _reset(self):
+        self._chunks = []           # 自最外层未闭合对象起始处开始的文本
+        self._base = 0              # _chunks 第一个字符在全文中的偏移
+        self._pos = getattr(self, "_pos", 0)
+        self._stack = []            # 未闭合对象：[起始偏移, 是否为 tool_call]
+        self._in_string = False
+        self._escape = False
+        self._token = ""            # 当前字符串的前若干字符，过长时为 None
+        self._pending_key = None
+        self._colon = False
+
+    def _buffer_text(self) -> str:
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    def _close_string(self):
+        value = self._token
+        if self._colon and self._pending_key == "type":
+            if value == "tool_call":
+                self._stack[-1][1] = True
+            self._pending_key = None
+        else:
+            self._pending_key = value
+        self._colon = False
+
+    def _close_object(self, end: int, found: List[dict]):
+        start, is_tool_call = self._stack.pop()
+        if is_tool_call and start not in self._found_starts:
+            candidate = self._buffer_text()[start - self._base:end + 1 - self._base]
+            try:
+                data = json.loads(candidate)
+            except ValueError:
+                data = None
+            if isinstance(data, dict) and data.get('type') == 'tool_call':
+                self._found_starts.add(start)
+                found.append(data)
+        if not self._stack:
+            self._chunks = []
+
+    def feed(self, text: str) -> List[dict]:
+        """扫描一段文本，返回其中新完成的 tool call 原始对象"""
+        found = []
+        if not text:
+            return found
+        offset = self._pos
+        if self._stack:
+            self._chunks.append(text)
+        i, n = 0, len(text)
+        while i < n:
+            if not self._stack:
+                # 对象外只关心 {，正文中的引号等字符全部忽略
+                j = text.find('{', i)
+                if j < 0:
+                    break
+                self._chunks = [text[j:]]
+                self._base = offset + j
+                self._stack.append([offset + j, False])
+                self._pending_key = None
+                self._colon = False
+                i = j + 1
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                    if self._token is not None:
+                        self._token = None if len(self._token) >= self.MAX_TOKEN_CHARS else self._token + text[i]
+                    i += 1
+                    continue
+                m = _JSON_STRING_CHARS.search(text, i)
+                j = m.start() if m else n
+                if self._token is not None and j > i:
+                    piece = text[i:j]
+                    self._token = self._token + piece if len(self._token) + len(piece) <= self.MAX_TOKEN_CHARS else None
+                if not m:
+                    break
+                if text[j] == '\\':
+                    self._escape = True
+                else:
+                    self._in_string = False
+                    self._close_string()
+                i = j + 1
+                continue
+
+            m = _JSON_STRUCT_CHARS.search(text, i)
+            if not m:
+                break
+            j = m.start()
+            ch = text[j]
+            i = j + 1
+            if ch == '"':
+                self._in_string = True
+                self._token = ""
+            elif ch == ':':
+                self._colon = self._pending_key is not None
+            elif ch == '{':
+                self._stack.append([offset + j, False])
+                self._pending_key = None
+            elif ch == '}':
+                self._pending_key = None
+                self._close_object(offset + j, found)
+            else:
+                self._pending_key = None
+
+        self._pos = offset + n
+        if self._stack and self._pos - self._stack[0][0] > self.MAX_OBJECT_CHARS:
+            logger.warning("JSON 对象过长或未闭合，放弃当前对象")
+            self._reset()
+        self.tool_calls.extend(found)
+        return found
+
+    def finish(self) -> List[dict]:
+        """
+        输入结束：如果最外层有未闭合的对象（例如正文中单独的 { 或引号），
+        从它之后重新扫描一次，返回新找到的 tool call
+        """
+        found = []
+        rescans = 0
+        while self._stack and rescans < self.MAX_RESCANS:
+            rescans += 1
+            text = self._buffer_text()
+            start = self._stack[0][0]
+            relative = start - self._base
+            self._reset()
+            # 保持全文偏移不变，已提取过的对象不会重复返回
+            self._pos = start + 1
+            found.extend(self.feed(text[relative + 1:]))
+        return found
+
+
+def _normalize_tool_call(data: dict) -> dict:
+    return {
+        'tool': data.get('tool', ''),
+        'command': data.get('command', ''),
+        'comment': data.get('comment', ''),
+        'args': data.get('args', [])
+    }
+
+def parse_tool_calls(response_text: str, has_tool_result_in_history: bool = False) -> List[dict]:
+    """
+    解析 AI 响应中的所有 tool call（支持代码块、正文中的 JSON 和多个并行调用）
     
     Args:
         response_text: AI 的响应文本
@@ -259,46 +1318,91 @@ def parse_tool_call(response_text: str, has_tool_result_in_history: bool = False
     # 如果已经有 tool 执行结果，不应该再返回 tool call（防止死循环）
     if has_tool_result_in_history:
         logger.info("对话历史中已有 tool 执行结果，跳过 tool call 检测")
-        return None
+        return []
     
-    try:
-        text = response_text.strip()
-        
-        # 方法1: 检查是否是 Markdown 代码块格式
-        if '```' in text:
-            # 提取代码块内容
-            code_block_match = re.search(r'```(?:json)?\s*\n?(.*?)\n?```', text, re.DOTALL)
-            if code_block_match:
-                text = code_block_match.group(1).strip()
-                logger.info(f"从代码块提取的JSON: {text[:100]}")
-        
-        # 方法2: 从文本中提取 JSON 对象（处理前面有额外文本的情况）
-        # 查找 { 开始和 } 结束的完整 JSON 对象
-        json_match = re.search(r'\{[^{}]*"type"\s*:\s*"tool_call"[^{}]*\}', text, re.DOTALL)
-        if not json_match:
-            # 尝试更宽松的匹配，支持嵌套对象
-            json_match = re.search(r'\{.*"type"\s*:\s*"tool_call".*\}', text, re.DOTALL)
-        
-        if json_match:
-            text = json_match.group(0)
-            logger.info(f"提取的JSON文本: {text[:100]}")
-        
-        # 尝试解析 JSON
-        data = json.loads(text)
-        
-        # 检查是否是 tool call 格式
-        if isinstance(data, dict) and data.get('type') == 'tool_call':
-            logger.info(f"成功解析 tool call: {data}")
-            return {
-                'tool': data.get('tool', ''),
-                'command': data.get('command', ''),
-                'comment': data.get('comment', ''),
-                'args': data.get('args', [])
+    scanner = ToolCallScanner()
+    scanner.feed(response_text)
+    scanner.finish()
+    tool_calls = [_normalize_tool_call(data) for data in scanner.tool_calls]
+    if tool_calls:
+        logger.info(f"成功解析 {len(tool_calls)} 个 tool call: {tool_calls}")
+    return tool_calls
+
+def parse_tool_call(response_text: str, has_tool_result_in_history: bool = False) -> Optional[dict]:
+    """
+    解析 AI 响应，检查是否是 tool call 格式
+    返回第一个 tool call 字典或 None
+    """
+    tool_calls = parse_tool_calls(response_text, has_tool_result_in_history)
+    return tool_calls[0] if tool_calls else None
+
+def build_tool_calls(tool_calls: List[dict], response_text: str, stream: bool = False) -> List[dict]:
+    """把解析出的 tool call 转换为 OpenAI 的 tool_calls 格式"""
+    result = []
+    for index, tool_call_data in enumerate(tool_calls):
+        # 构造 function 参数
+        function_args = {
+            "command": tool_call_data.get('command', ''),
+            "args": tool_call_data.get('args', [])
+        }
+        item = {
+            "id": f"call_{str(hash(response_text))}" if index == 0 else f"call_{str(hash(response_text))}_{index}",
+            "type": "function",
+            "function": {
+                "name": tool_call_data.get('tool', 'exec'),
+                "arguments": json.dumps(function_args, ensure_ascii=False)
             }
-    except (json.JSONDecodeError, ValueError) as e:
-        logger.debug(f"不是 tool call 格式: {str(e)}")
-    
-    return None
+        }
+        if stream:
+            item = {"index": index, **item}
+        result.append(item)
+    return result
+
+# 单个流式请求缓存原始输出的上限（UTF-8 字节），超出后放弃 tool call 检测并直接透传
+STREAM_BUFFER_MAX_BYTES = int(os.environ.get("YUANBAO_STREAM_BUFFER_MAX_BYTES", str(2 * 1024 * 1024)))
+
+class StreamBuffer:
+    """
+    流式输出的紧凑缓存：所有增量以 UTF-8 拼接在一个 bytearray 中，
+    另用 array 记录每个增量的结束位置，回放时按原来的切分输出
+    """
+    def __init__(self, max_bytes: int = STREAM_BUFFER_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._data = bytearray()
+        self._ends = array.array('Q')
+
+    def __len__(self) -> int:
+        return len(self._ends)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._data)
+
+    def append(self, text: str) -> bool:
+        """追加一个增量，超出上限时不追加并返回 False"""
+        encoded = text.encode('utf-8')
+        if self.max_bytes > 0 and len(self._data) + len(encoded) > self.max_bytes:
+            return False
+        self._data += encoded
+        self._ends.append(len(self._data))
+        return True
+
+    def deltas(self) -> Generator[str, None, None]:
+        start = 0
+        view = memoryview(self._data)
+        try:
+            for end in self._ends:
+                yield str(view[start:end], 'utf-8')
+                start = end
+        finally:
+            view.release()
+
+    def getvalue(self) -> str:
+        return self._data.decode('utf-8')
+
+    def clear(self):
+        self._data = bytearray()
+        self._ends = array.array('Q')
 
 def clean_chinese_text(text: str) -> str:
     """清理中文文本，保持良好的格式和段落结构"""
@@ -320,57 +1424,341 @@ def clean_chinese_text(text: str) -> str:
     
     return text
 
-def is_conversation_invalid_error(error_msg: str) -> bool:
-    """
-    判断错误是否是对话失效/不存在的错误
-    """
-    invalid_keywords = [
-        "conversation",
-        "not found",
-        "not exist",
-        "deleted",
-        "invalid",
-        "不存在",
-        "已删除",
-        "无效",
-        "找不到",
-        "404"
-    ]
-    error_lower = str(error_msg).lower()
-    return any(keyword in error_lower for keyword in invalid_keywords)
+# 多模态输入：消息中的图片和文件上传到元宝后通过 multimedia 字段发送
+# 上传凭证接口，返回 COS 临时密钥、存储位置和上传后的资源地址（按网页版抓包得到，元宝调整接口后可通过环境变量修改）
+UPLOAD_INFO_PATH = os.environ.get("YUANBAO_UPLOAD_INFO_PATH", "/api/resource/genUploadInfo")
+# COS 上传地址，默认按上传凭证中的存储桶拼接；测试时可以指向本地模拟服务
+UPLOAD_COS_ENDPOINT = os.environ.get("YUANBAO_UPLOAD_COS_ENDPOINT", "")
+UPLOAD_TIMEOUT = float(os.environ.get("YUANBAO_UPLOAD_TIMEOUT", "60"))
+# 单个图片/文件的大小上限，以及每个请求最多发送的个数（超出时保留最近的）
+MEDIA_MAX_BYTES = int(os.environ.get("YUANBAO_MEDIA_MAX_BYTES", str(20 * 1024 * 1024)))
+MEDIA_MAX_PER_REQUEST = int(os.environ.get("YUANBAO_MEDIA_MAX_PER_REQUEST", "10"))
+# 是否下载消息中的 http(s) 图片链接（由服务端访问客户端给出的地址），默认只接受 data URL
+MEDIA_FETCH_REMOTE = os.environ.get("YUANBAO_MEDIA_FETCH_REMOTE", "0") == "1"
+# 内容哈希 -> 上游资源的缓存条数和有效期（秒），有效期应短于元宝资源地址的有效期
+UPLOAD_CACHE_MAX_ENTRIES = int(os.environ.get("YUANBAO_UPLOAD_CACHE_MAX_ENTRIES", "1000"))
+UPLOAD_CACHE_TTL = float(os.environ.get("YUANBAO_UPLOAD_CACHE_TTL", "3600"))
 
+_DATA_URL_RE = re.compile(r"data:([^;,]*)((?:;[^;,]*)*),(.*)", re.DOTALL)
 
-def send_yuanbao_request_with_retry(prompt: str, stream: bool = False, model: str = "deepseek_v3", max_retries: int = 1) -> Union[str, Generator[str, None, None]]:
-    """
-    发送请求到元宝API，支持对话失效后自动重试
-    
-    Args:
-        prompt: 提示词
-        stream: 是否流式输出
-        model: 模型名称
-        max_retries: 最大重试次数（对话失效后重新创建对话的次数）
-    """
-    # 获取对应模型的配置
-    model_config = MODEL_SESSIONS.get(model)
-    if not model_config:
+
+def decode_data_url(url: str) -> tuple:
+    """解析 data URL，返回 (MIME 类型, 内容)"""
+    match = _DATA_URL_RE.fullmatch(url)
+    if not match:
+        raise HTTPException(status_code=400, detail="无效的 data URL")
+    mime, params, payload = match.groups()
+    try:
+        data = base64.b64decode(payload, validate=False) if ";base64" in params else urllib.parse.unquote_to_bytes(payload)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="data URL 中的 base64 内容无效")
+    return mime or "application/octet-stream", data
+
+
+def fetch_remote_media(url: str) -> tuple:
+    """下载图片链接，返回 (MIME 类型, 内容)，超过 MEDIA_MAX_BYTES 时报错"""
+    with requests.get(url, stream=True, timeout=(5, UPLOAD_TIMEOUT)) as response:
+        response.raise_for_status()
+        data = bytearray()
+        for chunk in response.iter_content(65536):
+            data += chunk
+            if len(data) > MEDIA_MAX_BYTES:
+                raise HTTPException(status_code=413, detail=f"图片超过 {MEDIA_MAX_BYTES} 字节")
+        mime = response.headers.get("content-type", "").split(";")[0].strip()
+    return mime or mimetypes.guess_type(urllib.parse.urlparse(url).path)[0] or "application/octet-stream", bytes(data)
+
+
+def image_size(data: bytes) -> tuple:
+    """从 PNG/GIF/JPEG/WebP 文件头读取 (宽, 高)，无法识别时返回 (0, 0)"""
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        return int.from_bytes(data[6:8], "little"), int.from_bytes(data[8:10], "little")
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP" and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b"VP8X":
+            return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+        if chunk == b"VP8L":
+            bits = int.from_bytes(data[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8 ":
+            return int.from_bytes(data[26:28], "little") & 0x3FFF, int.from_bytes(data[28:30], "little") & 0x3FFF
+    if data[:2] == b"\xff\xd8":
+        # 依次跳过各个段，直到 SOF 段（其中有图片尺寸）
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xFF:
+                i += 1
+                continue
+            marker = data[i + 1]
+            if marker in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+                return int.from_bytes(data[i + 7:i + 9], "big"), int.from_bytes(data[i + 5:i + 7], "big")
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                i += 2
+                continue
+            i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    return 0, 0
+
+
+def _media_part(mime: str, data: bytes, file_name: Optional[str] = None) -> dict:
+    if len(data) > MEDIA_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"文件超过 {MEDIA_MAX_BYTES} 字节")
+    digest = hashlib.sha256(data).hexdigest()
+    kind = "image" if mime.startswith("image/") else "doc"
+    if not file_name:
+        file_name = f"{digest[:16]}{mimetypes.guess_extension(mime) or ''}"
+    return {"kind": kind, "mime": mime, "data": data, "digest": digest, "file_name": file_name}
+
+
+def has_content_parts(messages: List[Message]) -> bool:
+    """是否有消息的 content 为内容数组（可能包含图片/文件）"""
+    return any(isinstance(msg.content, list) for msg in messages)
+
+
+def extract_media(messages: List[Message]) -> List[dict]:
+    """
+    取出消息中的图片（image_url）和文件（file）内容，按内容哈希去重
+
+    多轮对话中客户端每次都会重发历史消息里的图片，去重后同一图片只发送一次；
+    超过 MEDIA_MAX_PER_REQUEST 个时保留最近的
+    """
+    parts = {}
+    for msg in messages:
+        if not isinstance(msg.content, list):
+            continue
+        for item in msg.content:
+            if not isinstance(item, dict):
+                continue
+            if item.get("type") == "image_url":
+                image = item.get("image_url")
+                url = image.get("url") if isinstance(image, dict) else image
+                if not isinstance(url, str) or not url:
+                    continue
+                if url.startswith("data:"):
+                    part = _media_part(*decode_data_url(url))
+                elif MEDIA_FETCH_REMOTE and url.startswith(("http://", "https://")):
+                    part = _media_part(*fetch_remote_media(url))
+                else:
+                    logger.warning(f"忽略图片链接（未开启 YUANBAO_MEDIA_FETCH_REMOTE）: {url[:100]}")
+                    continue
+            elif item.get("type") == "file":
+                file = item.get("file") or {}
+                file_data = file.get("file_data")
+                if not isinstance(file_data, str) or not file_data:
+                    logger.warning(f"忽略没有 file_data 的文件: {file.get('filename') or file.get('file_id')}")
+                    continue
+                file_name = file.get("filename")
+                if file_data.startswith("data:"):
+                    mime, data = decode_data_url(file_data)
+                else:
+                    try:
+                        data = base64.b64decode(file_data)
+                    except ValueError:
+                        raise HTTPException(status_code=400, detail="file_data 不是有效的 base64")
+                    mime = mimetypes.guess_type(file_name or "")[0] or "application/octet-stream"
+                part = _media_part(mime, data, file_name)
+            else:
+                continue
+            parts.pop(part["digest"], None)
+            parts[part["digest"]] = part
+    return list(parts.values())[-MEDIA_MAX_PER_REQUEST:] if MEDIA_MAX_PER_REQUEST > 0 else []
+
+
+def cos_authorization(secret_id: str, secret_key: str, method: str, path: str, headers: dict, start: int, end: int) -> str:
+    """腾讯云 COS 请求签名（q-sign-algorithm=sha1）"""
+    key_time = f"{start};{end}"
+    sign_key = hmac.new(secret_key.encode(), key_time.encode(), hashlib.sha1).hexdigest()
+    names = sorted(name.lower() for name in headers)
+    header_string = "&".join(f"{name}={urllib.parse.quote(str(headers[name]), safe='')}" for name in names)
+    http_string = f"{method.lower()}\n{path}\n\n{header_string}\n"
+    string_to_sign = f"sha1\n{key_time}\n{hashlib.sha1(http_string.encode()).hexdigest()}\n"
+    signature = hmac.new(sign_key.encode(), string_to_sign.encode(), hashlib.sha1).hexdigest()
+    return (f"q-sign-algorithm=sha1&q-ak={secret_id}&q-sign-time={key_time}&q-key-time={key_time}"
+            f"&q-header-list={';'.join(names)}&q-url-param-list=&q-signature={signature}")
+
+
+def upload_media(part: dict, headers: dict) -> dict:
+    """申请上传凭证并把内容上传到 COS，返回 {resource_id, url}"""
+    info_headers = dict(headers, **{"content-type": "application/json"})
+    response = UPSTREAM_SESSION.post(
+        f"{UPSTREAM_BASE_URL}{UPLOAD_INFO_PATH}",
+        headers=info_headers,
+        json={"fileName": part["file_name"], "docFrom": "localDoc", "docOpenId": ""},
+        verify=False,
+        timeout=10
+    )
+    response.raise_for_status()
+    info = response.json()
+
+    path = "/" + info["location"].lstrip("/")
+    base = UPLOAD_COS_ENDPOINT.rstrip("/") or f"https://{info.get('accelerateDomain') or info['bucketName'] + '.cos.accelerate.myqcloud.com'}"
+    host = urllib.parse.urlparse(base).netloc
+    put_headers = {
+        "content-type": part["mime"],
+        "x-cos-security-token": info["encryptToken"],
+        "authorization": cos_authorization(info["encryptTmpSecretId"], info["encryptTmpSecretKey"], "put", path,
+                                           {"host": host}, info["startTime"], info["expiredTime"])
+    }
+    with trace_span("upload"):
+        UPSTREAM_SESSION.put(f"{base}{path}", data=part["data"], headers=put_headers, verify=False, timeout=UPLOAD_TIMEOUT).raise_for_status()
+    logger.info(f"上传文件成功: {part['file_name']}（{len(part['data'])} 字节）-> {info.get('resourceID')}")
+    return {"resource_id": info.get("resourceID"), "url": info.get("resourceUrl")}
+
+
+class UploadCache:
+    """
+    内容哈希 -> 上游资源的缓存：同一账号下相同内容只上传一次
+
+    条目按 TTL 过期并限制条数（LRU 淘汰）；多个请求同时上传同一内容时只有第一个真正上传，
+    其余等待它的结果（上传失败时一起失败，下次请求重新上传）
+    """
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # 键 -> (过期时间, 资源)
+        self._entries = collections.OrderedDict()
+        # 键 -> 正在进行的上传
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def get_or_upload(self, key, upload) -> dict:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry[1]
+            self._entries.pop(key, None)
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = concurrent.futures.Future()
+            else:
+                self._stats["deduplicated"] += 1
+        if not owner:
+            return future.result(timeout=UPLOAD_TIMEOUT * 2)
+
+        try:
+            resource = upload()
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+                self._stats["failures"] += 1
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, resource)
+            self._inflight.pop(key, None)
+            self._stats["uploads"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+        future.set_result(resource)
+        return resource
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), inflight=len(self._inflight))
+
+
+UPLOAD_CACHE = UploadCache(UPLOAD_CACHE_MAX_ENTRIES, UPLOAD_CACHE_TTL)
+
+
+def resolve_media(media: List[dict], account_id: Optional[str], headers: dict) -> List[dict]:
+    """把图片/文件转换为元宝的 multimedia 条目，已上传过的内容直接使用缓存的资源"""
+    entries = []
+    for part in media:
+        resource = UPLOAD_CACHE.get_or_upload((account_id, part["digest"]), lambda part=part: upload_media(part, headers))
+        entry = {
+            "type": part["kind"],
+            "docType": "image" if part["kind"] == "image" else (os.path.splitext(part["file_name"])[1].lstrip(".") or "txt"),
+            "url": resource["url"],
+            "fileName": part["file_name"],
+            "size": len(part["data"])
+        }
+        if part["kind"] == "image":
+            entry["width"], entry["height"] = image_size(part["data"])
+        entries.append(entry)
+    return entries
+
+
+def is_conversation_invalid_error(error_msg: str) -> bool:
+    """
+    判断错误是否是对话失效/不存在的错误
+    """
+    invalid_keywords = [
+        "conversation",
+        "not found",
+        "not exist",
+        "deleted",
+        "invalid",
+        "不存在",
+        "已删除",
+        "无效",
+        "找不到",
+        "404"
+    ]
+    error_lower = str(error_msg).lower()
+    return any(keyword in error_lower for keyword in invalid_keywords)
+
+
+def send_yuanbao_request_with_retry(prompt: str, stream: bool = False, model: str = "deepseek_v3", max_retries: int = 1, events: bool = False, conversation_id: Optional[str] = None, media: Optional[List[dict]] = None) -> Union[str, Generator[str, None, None]]:
+    """
+    发送请求到元宝API，支持对话失效后自动重试
+    
+    Args:
+        prompt: 提示词
+        stream: 是否流式输出
+        model: 模型名称
+        max_retries: 最大重试次数（对话失效后重新创建对话的次数）
+        events: 流式输出时直接产出 (类型, 内容) 事件，而不是 OpenAI 格式的 SSE 文本
+        conversation_id: 指定使用的对话ID（不会自动替换，失效时直接抛出异常）
+        media: extract_media 取出的图片/文件，按对话所属账号上传后放入 multimedia
+    """
+    # 获取对应模型的配置
+    model_config = MODEL_SESSIONS.get(model)
+    if not model_config:
         raise ValueError(f"未找到模型 {model} 的配置")
     
     retry_count = 0
     force_create = False
+    pinned_conversation_id = conversation_id
+    if pinned_conversation_id:
+        max_retries = 0
     
     while retry_count <= max_retries:
         # 获取或创建对话ID
         try:
-            conversation_id = get_or_create_conversation(model, force_create=force_create)
+            with trace_span("conversation_lease"):
+                conversation_id = pinned_conversation_id or get_or_create_conversation(model, force_create=force_create)
             logger.info(f"使用对话ID: {conversation_id} (尝试 {retry_count + 1}/{max_retries + 1})")
         except Exception as e:
             logger.error(f"获取/创建对话失败: {str(e)}")
             raise
         
-        url = f"https://yuanbao.tencent.com/api/chat/{conversation_id}"
+        url = f"{UPSTREAM_BASE_URL}/api/chat/{conversation_id}"
+        
+        # 使用对话所属账号的 Headers 快照，配置热重载不影响本次请求
+        headers = get_conversation_headers(conversation_id, model) or model_config.copy()
         
-        # 直接使用预合并的 Headers
-        headers = model_config.copy()
+        # 图片/文件上传到对话所属账号下，内容相同的只上传一次
+        try:
+            multimedia = resolve_media(media, CONVERSATION_ACCOUNTS.get(conversation_id), headers) if media else []
+        except requests.exceptions.HTTPError as e:
+            logger.error(f"上传文件失败: {str(e)}")
+            status_code = is_auth_failure(e)
+            if status_code:
+                record_account_auth(CONVERSATION_ACCOUNTS.get(conversation_id), False, status_code, "上传文件")
+                if retry_count < max_retries and not pinned_conversation_id:
+                    force_create = True
+                    retry_count += 1
+                    continue
+            raise
         
         # 特殊处理：发送请求时的 Content-Type
         headers["content-type"] = "text/plain;charset=UTF-8"
@@ -381,7 +1769,7 @@ def send_yuanbao_request_with_retry(prompt: str, stream: bool = False, model: st
             "supportFunctions": [""],
             "version": "v2",
             "docOpenid": "144115210554304601",
-            "multimedia": [],
+            "multimedia": multimedia,
             "plugin": "Adaptive",
             "supportHint": 1,
             "displayPromptType": 1,
@@ -397,20 +1785,43 @@ def send_yuanbao_request_with_retry(prompt: str, stream: bool = False, model: st
             "prompt": prompt
         }
         
+        begin_conversation_turn(conversation_id, model, prompt)
+        trace = CURRENT_TRACE.get()
+        if trace:
+            trace.attributes.update({"yuanbao.model": model, "yuanbao.conversation_id": conversation_id, "yuanbao.attempts": retry_count + 1})
         try:
-            response = requests.post(url, headers=headers, json=payload, verify=False, stream=True)
+            start_time = time.time()
+            with trace_span("connect"):
+                response = UPSTREAM_SESSION.post(url, headers=headers, json=payload, verify=False, stream=True)
             response.raise_for_status()
+            latency = time.time() - start_time
+            record_account_auth(CONVERSATION_ACCOUNTS.get(conversation_id), True)
+            record_usage(prompt_tokens=count_tokens(prompt))
             
             # 请求成功，处理响应
             if stream:
-                return _handle_stream_response(response, model)
+                chunks = iter_upstream_events(response) if events else _handle_stream_response(response, model)
+                return _end_turn_after_stream(chunks, conversation_id, model, latency)
             else:
-                return _handle_normal_response(response, model)
+                response_text = _handle_normal_response(response, model)
+                end_conversation_turn(conversation_id, model, latency)
+                return response_text
                 
         except requests.exceptions.HTTPError as e:
+            end_conversation_turn(conversation_id, model)
             error_msg = str(e)
             logger.error(f"HTTP错误: {error_msg}")
             
+            # 凭证失效：标记账号，换用其它账号的新对话重试
+            status_code = is_auth_failure(e)
+            if status_code:
+                record_account_auth(CONVERSATION_ACCOUNTS.get(conversation_id), False, status_code)
+                if retry_count < max_retries and not pinned_conversation_id:
+                    logger.warning("账号凭证失效，换用其它账号重试...")
+                    force_create = True
+                    retry_count += 1
+                    continue
+            
             # 检查是否是对话失效的错误
             if is_conversation_invalid_error(error_msg) and retry_count < max_retries:
                 logger.warning(f"对话可能已失效，准备重新创建对话并重试...")
@@ -421,6 +1832,7 @@ def send_yuanbao_request_with_retry(prompt: str, stream: bool = False, model: st
                 # 其他错误或重试次数已用完，抛出异常
                 raise
         except Exception as e:
+            end_conversation_turn(conversation_id, model)
             error_msg = str(e)
             logger.error(f"请求异常: {error_msg}")
             
@@ -437,160 +1849,150 @@ def send_yuanbao_request_with_retry(prompt: str, stream: bool = False, model: st
     raise Exception(f"请求失败，已重试 {max_retries} 次")
 
 
+def iter_upstream_events(response) -> Generator[tuple, None, None]:
+    """
+    增量解析元宝的流式响应，逐个产出 (类型, 内容)
+
+    类型为 think（思考过程）或 text（正文）
+    """
+    counter = TokenCounter()
+    trace = CURRENT_TRACE.get()
+    try:
+        if trace is None:
+            yield from _iter_upstream_lines(response, counter, None)
+            return
+        for kind, content in _iter_upstream_lines(response, counter, trace):
+            trace.mark("first_token")
+            if kind == 'text':
+                trace.mark("first_text_token")
+            trace.mark("last_token", overwrite=True)
+            # 挂起期间是调用方编码并下发这个事件的时间
+            suspended_at = time.perf_counter()
+            yield kind, content
+            trace.encode += time.perf_counter() - suspended_at
+    finally:
+        record_usage(completion_tokens=counter.total)
+        # 提前结束（客户端断开或取消）时关闭上游连接，停止接收剩余内容
+        response.close()
+
+
+def _iter_upstream_lines(response, counter: "TokenCounter", trace: Optional["RequestTrace"]) -> Generator[tuple, None, None]:
+    for line in response.iter_lines():
+        if trace:
+            trace.mark("first_byte")
+        if not line:
+            continue
+        line = line.decode('utf-8')
+        logger.info(f"原始响应行: {line}")
+        
+        # 跳过非JSON数据
+        if line in ['status', 'text']:
+            continue
+            
+        if not line.startswith('data: '):
+            continue
+        data = line[6:]
+        if not data:
+            continue
+        # 跳过非JSON标记行，元宝的 trace ID 和消息序号记录到当前请求的 trace 中
+        if data.startswith('[MSGINDEX:') or data.startswith('[TRACEID:') or data.startswith('[DONE]'):
+            logger.info(f"跳过标记行: {data}")
+            if trace and data.startswith('[TRACEID:'):
+                trace.upstream_trace_id = data[len('[TRACEID:'):].rstrip(']')
+            elif trace and data.startswith('[MSGINDEX:'):
+                trace.upstream_msg_index = data[len('[MSGINDEX:'):].rstrip(']')
+            continue
+        try:
+            json_data = json.loads(data)
+        except json.JSONDecodeError as e:
+            logger.error(f"JSON解析错误: {str(e)}")
+            continue
+        
+        if json_data.get('type') == 'think':
+            content = json_data.get('content', '')
+            if content:
+                counter.feed(content)
+                yield 'think', content
+        elif json_data.get('type') == 'text':
+            msg = json_data.get('msg', '')
+            if msg:
+                counter.feed(msg)
+                yield 'text', msg
+
+
+def iter_stream_deltas(events) -> Generator[str, None, None]:
+    """
+    把元宝的 (类型, 内容) 事件转换为 OpenAI 流式输出的 content 增量
+
+    思考过程用 <think> 标签包裹，并按句子合并后输出
+    """
+    current_thought = []
+    thinking_started = False
+    text_started = False
+    for kind, msg in events:
+        # 处理思考过程
+        if kind == 'think':
+            if not thinking_started:
+                # 第一次遇到思考内容时，发送思考开始标记
+                thinking_started = True
+                yield "<think>\n"
+            current_thought.append(msg)
+            # 当遇到句子结束标记时，发送完整的思考内容
+            if msg.strip() in ['。', '？', '！', '.', '?', '!']:
+                yield ''.join(current_thought) + "\n"
+                current_thought = []
+
+        # 处理普通文本消息
+        elif kind == 'text':
+            # 如果之前有未完成的思考内容，先发送出去
+            if current_thought:
+                yield ''.join(current_thought) + "\n"
+                current_thought = []
+            # 如果是第一个文本消息且之前有思考过程，添加思考结束标记和换行
+            if thinking_started and not text_started:
+                yield "</think>\n\n"
+            text_started = True
+            yield msg
+
+
+def format_stream_chunk(chunk_id: str, model: str, delta: dict, finish_reason: Optional[str] = None, **extra) -> str:
+    """格式化一个 OpenAI chat.completion.chunk SSE 消息"""
+    chunk = {
+        "id": chunk_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "delta": delta,
+                "finish_reason": finish_reason
+            }
+        ],
+        **extra
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+def format_stream_end(chunk_id: str, model: str, finish_reason: str = "stop") -> str:
+    """结束 chunk，带上元宝的 trace ID（如果有）"""
+    upstream_trace_id = current_upstream_trace_id()
+    extra = {"upstream_trace_id": upstream_trace_id} if upstream_trace_id else {}
+    return format_stream_chunk(chunk_id, model, {}, finish_reason, **extra)
+
+
 def _handle_stream_response(response, model: str):
-    """处理流式响应"""
+    """处理流式响应：逐个增量转发，不缓存已发送的内容"""
     def generate():
-        full_response = []
-        current_thought = []
-        thinking_started = False
-        
-        for line in response.iter_lines():
-            if line:
-                line = line.decode('utf-8')
-                logger.info(f"原始响应行: {line}")
-                
-                # 跳过非JSON数据
-                if line in ['status', 'text']:
-                    continue
-                    
-                if line.startswith('data: '):
-                    try:
-                        data = line[6:]
-                        if data:
-                            # 跳过非JSON标记行
-                            if data.startswith('[MSGINDEX:') or data.startswith('[TRACEID:') or data.startswith('[DONE]'):
-                                logger.info(f"跳过标记行: {data}")
-                                continue
-                            json_data = json.loads(data)
-                            # 处理思考过程
-                            if json_data.get('type') == 'think':
-                                msg = json_data.get('content', '')
-                                if msg:
-                                    if not thinking_started:
-                                        # 第一次遇到思考内容时，发送思考开始标记
-                                        chunk = {
-                                            "id": f"chatcmpl-{str(hash(''.join(full_response)))}",
-                                            "object": "chat.completion.chunk",
-                                            "created": int(time.time()),
-                                            "model": "deepseek_v3",
-                                            "choices": [
-                                                {
-                                                    "index": 0,
-                                                    "delta": {
-                                                        "role": "assistant" if len(full_response) == 0 else None,
-                                                        "content": "<think>\n"
-                                                    },
-                                                    "finish_reason": None
-                                                }
-                                            ]
-                                        }
-                                        thinking_started = True
-                                        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-                                    
-                                    current_thought.append(msg)
-                                    # 当遇到句子结束标记时，发送完整的思考内容
-                                    if msg.strip() in ['。', '？', '！', '.', '?', '!']:
-                                        thought_text = ''.join(current_thought)
-                                        chunk = {
-                                            "id": f"chatcmpl-{str(hash(''.join(full_response)))}",
-                                            "object": "chat.completion.chunk",
-                                            "created": int(time.time()),
-                                            "model": "deepseek_v3",
-                                            "choices": [
-                                                {
-                                                    "index": 0,
-                                                    "delta": {
-                                                        "content": thought_text + "\n"
-                                                    },
-                                                    "finish_reason": None
-                                                }
-                                            ]
-                                        }
-                                        current_thought = []
-                                        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-                            
-                            # 处理普通文本消息
-                            elif json_data.get('type') == 'text':
-                                msg = json_data.get('msg', '')
-                                if msg:
-                                    # 如果之前有未完成的思考内容，先发送出去
-                                    if current_thought:
-                                        thought_text = ''.join(current_thought)
-                                        chunk = {
-                                            "id": f"chatcmpl-{str(hash(''.join(full_response)))}",
-                                            "object": "chat.completion.chunk",
-                                            "created": int(time.time()),
-                                            "model": "deepseek_v3",
-                                            "choices": [
-                                                {
-                                                    "index": 0,
-                                                    "delta": {
-                                                        "content": thought_text + "\n"
-                                                    },
-                                                    "finish_reason": None
-                                                }
-                                            ]
-                                        }
-                                        current_thought = []
-                                        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-                                    
-                                    # 如果是第一个文本消息且之前有思考过程，添加思考结束标记和换行
-                                    if thinking_started and len(full_response) == 0:
-                                        chunk = {
-                                            "id": f"chatcmpl-{str(hash(''.join(full_response)))}",
-                                            "object": "chat.completion.chunk",
-                                            "created": int(time.time()),
-                                            "model": "deepseek_v3",
-                                            "choices": [
-                                                {
-                                                    "index": 0,
-                                                    "delta": {
-                                                        "content": "</think>\n\n"
-                                                    },
-                                                    "finish_reason": None
-                                                }
-                                            ]
-                                        }
-                                        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-                                    
-                                    # 发送实际的文本消息
-                                    chunk = {
-                                        "id": f"chatcmpl-{str(hash(''.join(full_response)))}",
-                                        "object": "chat.completion.chunk",
-                                        "created": int(time.time()),
-                                        "model": "deepseek_v3",
-                                        "choices": [
-                                            {
-                                                "index": 0,
-                                                "delta": {
-                                                    "role": "assistant" if len(full_response) == 0 and not thinking_started else None,
-                                                    "content": msg
-                                                },
-                                                "finish_reason": None
-                                            }
-                                        ]
-                                    }
-                                    full_response.append(msg)
-                                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-                    except json.JSONDecodeError as e:
-                        logger.error(f"JSON解析错误: {str(e)}")
-                        continue
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+        first = True
+        for content in iter_stream_deltas(iter_upstream_events(response)):
+            delta = {"role": "assistant", "content": content} if first else {"content": content}
+            first = False
+            yield format_stream_chunk(chunk_id, model, delta)
         
         # 发送结束标记
-        end_chunk = {
-            "id": f"chatcmpl-{str(hash(''.join(full_response)))}",
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": "deepseek_v3",
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {},
-                    "finish_reason": "stop"
-                }
-            ]
-        }
-        yield f"data: {json.dumps(end_chunk, ensure_ascii=False)}\n\n"
+        yield format_stream_end(chunk_id, model)
         yield "data: [DONE]\n\n"
     
     return generate()
@@ -602,46 +2004,19 @@ def _handle_normal_response(response, model: str):
     current_thought = []  # 用于收集当前思考过程的词组
     thinking_paragraphs = []  # 用于存储完整的思考段落
     
-    for line in response.iter_lines():
-        if line:
-            line = line.decode('utf-8')
-            logger.info(f"原始响应行: {line}")
-            
-            # 跳过非JSON数据
-            if line in ['status', 'text']:
-                continue
-                
-            if line.startswith('data: '):
-                try:
-                    data = line[6:]
-                    if data:
-                        # 跳过标记行
-                        if data.startswith('[MSGINDEX:') or data.startswith('[TRACEID:') or data.startswith('[DONE]'):
-                            logger.info(f"跳过标记行: {data}")
-                            continue
-                        
-                        json_data = json.loads(data)
-                        
-                        # 处理思考过程
-                        if json_data.get('type') == 'think':
-                            content = json_data.get('content', '')
-                            if content:
-                                current_thought.append(content)
-                                # 当遇到句子结束标记时，将当前思考段落保存
-                                if content.strip() in ['。', '？', '！', '.', '?', '!']:
-                                    thought_text = ''.join(current_thought)
-                                    thinking_paragraphs.append(thought_text)
-                                    current_thought = []
-                        
-                        # 处理普通文本消息
-                        elif json_data.get('type') == 'text':
-                            msg = json_data.get('msg', '')
-                            if msg:
-                                full_response.append(msg)
-                                
-                except json.JSONDecodeError as e:
-                    logger.error(f"JSON解析错误: {str(e)}")
-                    continue
+    for kind, content in iter_upstream_events(response):
+        # 处理思考过程
+        if kind == 'think':
+            current_thought.append(content)
+            # 当遇到句子结束标记时，将当前思考段落保存
+            if content.strip() in ['。', '？', '！', '.', '?', '!']:
+                thought_text = ''.join(current_thought)
+                thinking_paragraphs.append(thought_text)
+                current_thought = []
+        
+        # 处理普通文本消息
+        elif kind == 'text':
+            full_response.append(content)
     
     # 处理剩余的思考内容
     if current_thought:
@@ -658,76 +2033,85 @@ def _handle_normal_response(response, model: str):
     return response_text
 
 
-def send_yuanbao_request(prompt: str, stream: bool = False, model: str = "deepseek_v3") -> Union[str, Generator[str, None, None]]:
+def send_yuanbao_request(prompt: str, stream: bool = False, model: str = "deepseek_v3", events: bool = False, conversation_id: Optional[str] = None, media: Optional[List[dict]] = None) -> Union[str, Generator[str, None, None]]:
     """
     发送请求到元宝API（兼容旧接口，内部调用带重试的版本）
     """
-    return send_yuanbao_request_with_retry(prompt, stream=stream, model=model, max_retries=1)
+    if not _sessions_loaded.is_set():
+        reload_sessions("首次使用")
+    return send_yuanbao_request_with_retry(prompt, stream=stream, model=model, max_retries=1, events=events, conversation_id=conversation_id, media=media)
 
 
-async def create_chat_completion(request: ChatCompletionRequest):
-    try:
-        # 记录完整的请求内容
-        logger.info("\n=== 收到Dify请求 ===")
-        logger.info(f"完整请求内容: {request.model_dump_json(indent=2)}")
-        logger.info(f"当前模型对话ID缓存: {MODEL_CONVERSATION_IDS}")
-        
-        # 获取系统提示词
-        system_message = next((msg.content for msg in request.messages if msg.role == "system"), None)
-        logger.info(f"提取到的系统提示词: {system_message}")
-        
-        # 获取最后一条用户消息
-        user_message = next((msg.content for msg in reversed(request.messages) if msg.role == "user"), None)
-        logger.info(f"提取到的用户消息: {user_message}")
-        
-        if not user_message:
-            raise HTTPException(status_code=400, detail="No user message found")
+def ollama_timings(start_ns: int, first_token_ns: Optional[int], prompt: str, eval_count: int) -> dict:
+    """根据实际耗时生成 Ollama 最后一条消息中的统计字段（单位：纳秒）"""
+    end_ns = time.perf_counter_ns()
+    first_token_ns = first_token_ns or end_ns
+    return {
+        "total_duration": end_ns - start_ns,
+        "load_duration": 0,
+        "prompt_eval_count": count_tokens(prompt),
+        "prompt_eval_duration": first_token_ns - start_ns,
+        "eval_count": eval_count,
+        "eval_duration": end_ns - first_token_ns
+    }
 
-        # 如果有系统提示词，使用指令格式包装
-        if system_message:
-            # 使用指令格式，让元宝明白这是系统指令
-            user_message = f"[系统指令]\n{system_message}\n\n[用户输入]\n{user_message}\n\n请严格按照系统指令执行，不要返回问候语或其他无关内容。"
-            logger.info(f"合并后的完整提示词: {user_message}")
 
-        # 如果是流式请求
-        if request.stream:
-            return StreamingResponse(
-                send_yuanbao_request(user_message, stream=True),
-                media_type="text/event-stream"
-            )
+def ollama_stream(prompt: str, model: str, chat: bool = False) -> Generator[str, None, None]:
+    """
+    以 Ollama 的 NDJSON 格式流式输出
 
-        # 非流式请求
-        response_text = send_yuanbao_request(user_message)
-        logger.info(f"元宝API返回的响应: {response_text}")
-        logger.info("=== 请求处理完成 ===\n")
-
-        # 构建OpenAI格式的响应
-        response = ChatCompletionResponse(
-            id="chatcmpl-" + str(hash(response_text)),
-            created=int(time.time()),
-            model=request.model,
-            choices=[{
-                "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": response_text
-                },
-                "finish_reason": "stop"
-            }],
-            usage={
-                "prompt_tokens": len(user_message),
-                "completion_tokens": len(response_text),
-                "total_tokens": len(user_message) + len(response_text)
-            }
-        )
+    Args:
+        prompt: 提示词
+        model: 模型名称
+        chat: True 时使用 /api/chat 的 message 字段，否则使用 /api/generate 的 response 字段
+    """
+    def line(content: str, done: bool = False, **extra) -> str:
+        item = {"model": model, "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+        if chat:
+            item["message"] = {"role": "assistant", "content": content}
+        else:
+            item["response"] = content
+        item["done"] = done
+        item.update(extra)
+        return json.dumps(item, ensure_ascii=False) + "\n"
 
-        return response
+    start_ns = time.perf_counter_ns()
+    first_token_ns = None
+    # 只计数，不缓存已发送的内容
+    output_chars = 0
+    output_tokens = TokenCounter()
+    thinking = False
+    try:
+        for kind, content in send_yuanbao_request(prompt, stream=True, model=model, events=True):
+            if first_token_ns is None:
+                first_token_ns = time.perf_counter_ns()
+            # 与非流式响应一致，思考过程用 <think> 标签包裹
+            if kind == 'think' and not thinking:
+                thinking = True
+                content = "<think>\n" + content
+            elif kind == 'text' and thinking:
+                thinking = False
+                content = "\n</think>\n\n" + content
+            output_chars += len(content)
+            output_tokens.feed(content)
+            yield line(content)
     except Exception as e:
-        logger.error(f"处理请求时发生错误: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error(f"Ollama 流式请求失败: {str(e)}")
+        yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+        return
+
+    logger.info(f"Ollama 流式响应完成，共 {output_chars} 字符")
+    yield line("", done=True, done_reason="stop", **ollama_timings(start_ns, first_token_ns, prompt, output_tokens.total))
 
-@app.post("/api/generate")
+
+@router.post("/api/generate")
 async def generate(request: GenerateRequest):
+    if request.stream:
+        return StreamingResponse(
+            ollama_stream(request.prompt, request.model),
+            media_type="application/x-ndjson"
+        )
+
     try:
         try:
             response_text = send_yuanbao_request(request.prompt, model=request.model)
@@ -746,7 +2130,7 @@ async def generate(request: GenerateRequest):
             "done": True
         }
 
-@app.post("/api/chat")
+@router.post("/api/chat")
 async def chat(request: ChatRequest):
     try:
         # 获取系统提示词
@@ -772,6 +2156,12 @@ async def chat(request: ChatRequest):
             user_message = f"{system_message}\n\n用户问题：{user_message}"
             logger.info(f"合并后的完整提示词: {user_message}")
 
+        if request.stream:
+            return StreamingResponse(
+                ollama_stream(user_message, request.model, chat=True),
+                media_type="application/x-ndjson"
+            )
+
         try:
             response_text = send_yuanbao_request(user_message, model=request.model)
         except Exception as e:
@@ -798,34 +2188,134 @@ async def chat(request: ChatRequest):
             "done": True
         }
 
-@app.get("/api/clear_conversations")
-async def clear_conversations():
-    """清除所有对话缓存，强制创建新对话"""
-    global MODEL_CONVERSATION_IDS
-    MODEL_CONVERSATION_IDS = {}
+@router.get("/api/clear_conversations")
+async def clear_conversations(request: Request):
+    """清除所有对话缓存，强制创建新对话（旧对话退役后在上游删除）"""
+    require_admin(request)
+    for model, conversation_id in list(MODEL_CONVERSATION_IDS.items()):
+        retire_conversation(model, conversation_id, "手动清除")
     logger.info("已清除所有对话缓存")
     return {"status": "ok", "message": "所有对话缓存已清除"}
 
-@app.get("/api/tags")
+@router.get("/api/conversations")
+async def list_conversations(request: Request):
+    """查看当前对话、备用对话和待删除对话的状态"""
+    require_admin(request)
+    with _conversations_lock:
+        stats = {cid: dict(item, account=CONVERSATION_ACCOUNTS.get(cid)) for cid, item in CONVERSATION_STATS.items()}
+        retired = list(RETIRED_CONVERSATIONS)
+    return {
+        "active": dict(MODEL_CONVERSATION_IDS),
+        "prewarmed": {model: len(pool) for model, pool in PREWARMED_CONVERSATIONS.items()},
+        "retired": retired,
+        "cleanup": dict(CONVERSATION_CLEANUP_STATS),
+        "stats": stats
+    }
+
+@router.post("/api/reload_sessions")
+async def reload_sessions_endpoint(request: Request):
+    """重新加载配置文件（无需重启服务）"""
+    require_admin(request)
+    result = reload_sessions("接口触发")
+    if result["status"] != "ok":
+        return JSONResponse(status_code=500, content=result)
+    return result
+
+@router.get("/api/usage")
+async def get_usage():
+    """各租户用量统计（用于分账）；非管理员只能看到自己的用量"""
+    tenant = CURRENT_TENANT.get()
+    usage = {
+        name: dict(stats, queued=UPSTREAM_SCHEDULER.queued(name))
+        for name, stats in TENANT_USAGE.items()
+        if tenant is None or tenant["admin"] or name == tenant["name"]
+    }
+    return {
+        "tenants": usage,
+        "upstream": {
+            "active": UPSTREAM_SCHEDULER.active,
+            "capacity": UPSTREAM_SCHEDULER.capacity,
+            "queued": UPSTREAM_SCHEDULER.queued(),
+            "mode": UPSTREAM_SCHEDULER.mode,
+            "priorities": UPSTREAM_SCHEDULER.wait_metrics()
+        },
+        "prompt_cache": PROMPT_CACHE.stats() if PROMPT_CACHE_ENABLED else None,
+        "uploads": UPLOAD_CACHE.stats()
+    }
+
+@router.get("/api/traces")
+async def list_traces(request: Request, limit: int = 50):
+    """最近完成的请求耗时分解（最新的在前）"""
+    require_admin(request)
+    with _traces_lock:
+        traces = list(RECENT_TRACES.values())[-limit:]
+    return {"traces": [trace.to_dict() for trace in reversed(traces)]}
+
+@router.get("/api/traces/{request_id}")
+async def get_trace(request: Request, request_id: str):
+    require_admin(request)
+    with _traces_lock:
+        trace = RECENT_TRACES.get(request_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return trace.to_dict()
+
+@router.get("/api/tags")
 async def get_models():
     """返回支持的模型列表"""
     return {"models": SUPPORTED_MODELS}
 
-@app.get("/api/version")
+@router.get("/api/version")
 async def version():
     return {
         "version": "1.0.0"
     }
 
-@app.get("/health")
+@router.get("/health")
 async def health_check():
+    if SERVER_STATE["draining"]:
+        # 返回 503，让负载均衡器先把流量切走
+        return JSONResponse(
+            status_code=503,
+            content={"status": "draining", "in_flight": SERVER_STATE["in_flight"]}
+        )
     return {"status": "ok"}
 
-@app.get("/")
+@router.get("/health/live")
+async def liveness_check():
+    """存活检查：进程和事件循环正常即返回 200，不受账号状态和排空影响"""
+    return {"status": "alive", "draining": SERVER_STATE["draining"]}
+
+@router.get("/health/ready")
+async def readiness_check(request: Request):
+    """
+    就绪检查：预热完成、未在排空、后台探测到足够的可用账号且并发名额未饱和时返回 200，否则返回 503
+
+    只读取缓存的探测结果，不会同步请求上游；账号状态、探测错误和预热详情只返回给管理员
+    """
+    report = readiness_report()
+    if not is_admin(request):
+        return JSONResponse(status_code=200 if report["ready"] else 503, content={"ready": report["ready"], "reasons": report["reasons"]})
+    return JSONResponse(
+        status_code=200 if report["ready"] else 503,
+        content={
+            **report,
+            "warmup": {
+                "ready": WARMUP_STATE["ready"],
+                "duration": round(WARMUP_STATE["finished_at"] - WARMUP_STATE["started_at"], 3) if WARMUP_STATE["finished_at"] else None,
+                "dns": WARMUP_STATE["dns"],
+                "connections": WARMUP_STATE["connections"],
+                "conversations": WARMUP_STATE["conversations"],
+                "errors": WARMUP_STATE["errors"][-10:]
+            }
+        }
+    )
+
+@router.get("/")
 async def root():
     return {"message": "Yuanbao API is running"}
 
-@app.get("/v1/models")
+@router.get("/v1/models")
 async def list_models():
     """返回支持的模型列表（OpenAI兼容格式）"""
     return {
@@ -843,220 +2333,2069 @@ def get_ip():
     except:
         return "获取IP失败"
 
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    start_time = time.time()
-    
-    # 记录请求信息
-    logger.info("\n=== 收到请求 ===")
-    logger.info(f"请求方法: {request.method}")
-    logger.info(f"请求路径: {request.url.path}")
-    logger.info(f"完整URL: {request.url}")
-    logger.info(f"查询参数: {dict(request.query_params)}")
-    logger.info(f"请求头: {dict(request.headers)}")
-    logger.info(f"客户端IP: {request.client.host if request.client else '未知'}")
-    logger.info(f"用户代理: {request.headers.get('user-agent', '未知')}")
-    
-    # 记录请求体（所有方法都记录）
-    try:
-        body = await request.body()
-        if body:
-            logger.info(f"原始请求体: {body.decode('utf-8')}")
-        # Reset the request body so the endpoint can read it
-        request._body = body
-    except Exception as e:
-        logger.error(f"读取请求体时出错: {str(e)}")
-    
-    # 处理请求
-    response = await call_next(request)
-    
-    # 记录响应信息
-    process_time = time.time() - start_time
-    logger.info(f"处理时间: {process_time:.2f}秒")
-    logger.info(f"响应状态: {response.status_code}")
-    logger.info(f"响应头: {dict(response.headers)}")
-    logger.info("=== 请求处理完成 ===")
-    
-    return response
+# 服务运行状态：是否正在排空、排空期间是否拒绝新请求、正在处理的请求数
+SERVER_STATE = {"draining": False, "reject_new": False, "in_flight": 0}
+_server_state_lock = threading.Lock()
 
-@app.post("/v1/chat/completions")
-async def openai_chat_completion(request: ChatCompletionRequest):
-    try:
-        logger.info("\n=== 收到OpenAI兼容请求 ===")
-        logger.info(f"完整请求内容: {request.model_dump_json(indent=2)}")
-        
-        # 构建完整的对话历史
-        conversation_history = []
-        has_tool_call_in_history = False
-        has_tool_result_in_history = False
-        
-        for msg in request.messages:
-            role = msg.role
-            content = msg.content
-            
-            # 处理不同类型的content
-            if isinstance(content, list):
-                # 处理multimodal内容（数组）
-                text_parts = []
-                for item in content:
-                    if isinstance(item, dict) and item.get('type') == 'text':
-                        text_parts.append(item.get('text', ''))
-                content_text = ' '.join(text_parts)
-            elif isinstance(content, str):
-                content_text = content
-            else:
-                # 其他类型转换为字符串
-                content_text = str(content)
-            
-            if content_text:
-                if role == 'system':
-                    conversation_history.append(f"System: {content_text}")
-                elif role == 'user':
-                    conversation_history.append(f"User: {content_text}")
-                elif role == 'assistant':
-                    conversation_history.append(f"Assistant: {content_text}")
-                    # 检查 assistant 消息是否包含 tool_calls
-                    if content_text and '"tool_calls"' in content_text:
-                        has_tool_call_in_history = True
-                elif role == 'tool':
-                    # tool 角色的消息是工具执行结果
-                    conversation_history.append(f"Tool执行结果: {content_text}")
-                    has_tool_result_in_history = True
-        
-        # 确保有用户消息
-        if not any('User:' in msg for msg in conversation_history):
-            raise HTTPException(status_code=400, detail="No user message found")
-        
-        # 添加指令，防止死循环
-        if has_tool_result_in_history:
-            # 如果已经有 tool 执行结果，告诉 AI 这是执行结果，应该返回普通文本总结
-            conversation_history.append("\n[System指令: 上面是工具执行的结果。请根据执行结果给用户一个友好的总结回复，不要再次执行相同的命令。]")
-        
-        # 构建完整提示
-        user_message = '\n'.join(conversation_history)
+# 收到 SIGTERM 后等待进行中请求完成的最长时间（秒）
+DRAIN_TIMEOUT = float(os.environ.get("YUANBAO_DRAIN_TIMEOUT", "30"))
+# 独立运行时排空期间至少保持的时间（秒），让负载均衡器通过 /health 发现 draining 状态
+DRAIN_GRACE_PERIOD = float(os.environ.get("YUANBAO_DRAIN_GRACE_PERIOD", "5"))
+# 排空期间仍然放行的路径（健康检查需要返回 draining 状态）
+DRAIN_EXEMPT_PATHS = {"/health", "/health/live", "/health/ready"}
 
-        # 如果是流式请求
-        if request.stream:
-            # 对于流式请求，我们先收集完整响应，检查是否是 tool call
-            # 使用列表缓存所有 chunk，避免重复请求
-            async def stream_with_tool_call():
-                # 缓存所有 chunk
-                cached_chunks = []
-                full_response_parts = []
-                
-                # 发送流式请求并缓存所有 chunk
-                for chunk in send_yuanbao_request(user_message, stream=True, model=request.model):
-                    cached_chunks.append(chunk)
-                    
-                    # 解析 chunk 获取内容
-                    if chunk.startswith('data: ') and not chunk.startswith('data: [DONE]'):
-                        try:
-                            data = json.loads(chunk[6:])
-                            if 'choices' in data and len(data['choices']) > 0:
-                                delta = data['choices'][0].get('delta', {})
-                                content = delta.get('content', '')
-                                if content:
-                                    full_response_parts.append(content)
-                        except:
-                            pass
-                
-                # 合并完整响应
-                full_response_text = ''.join(full_response_parts)
-                
-                # 检查是否是 tool call（传入 has_tool_result_in_history 防止死循环）
-                tool_call_data = parse_tool_call(full_response_text, has_tool_result_in_history)
-                
-                if tool_call_data:
-                    # 是 tool call，返回单个包含 tool_calls 的 chunk
-                    logger.info(f"流式响应检测到 tool call: {tool_call_data}")
-                    tool_call_id = f"call_{str(hash(full_response_text))}"
-                    
-                    # 构造 function 参数
-                    function_args = {
-                        "command": tool_call_data.get('command', ''),
-                        "args": tool_call_data.get('args', [])
-                    }
-                    
-                    chunk = {
-                        "id": f"chatcmpl-{str(hash(full_response_text))}",
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": request.model,
-                        "choices": [
-                            {
-                                "index": 0,
-                                "delta": {
-                                    "role": "assistant",
-                                    "tool_calls": [
-                                        {
-                                            "index": 0,
-                                            "id": tool_call_id,
-                                            "type": "function",
-                                            "function": {
-                                                "name": tool_call_data.get('tool', 'exec'),
-                                                "arguments": json.dumps(function_args, ensure_ascii=False)
-                                            }
-                                        }
-                                    ]
-                                },
-                                "finish_reason": None
-                            }
-                        ]
-                    }
-                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-                    
-                    # 发送结束标记
-                    end_chunk = {
-                        "id": f"chatcmpl-{str(hash(full_response_text))}",
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": request.model,
-                        "choices": [
-                            {
-                                "index": 0,
-                                "delta": {},
-                                "finish_reason": "tool_calls"
-                            }
-                        ]
-                    }
-                    yield f"data: {json.dumps(end_chunk, ensure_ascii=False)}\n\n"
-                    yield "data: [DONE]\n\n"
-                else:
-                    # 普通文本响应，直接返回缓存的 chunks
-                    logger.info(f"普通流式响应，返回 {len(cached_chunks)} 个缓存 chunk")
-                    for chunk in cached_chunks:
-                        yield chunk
-            
-            return StreamingResponse(
-                stream_with_tool_call(),
-                media_type="text/event-stream"
+class DrainMiddleware:
+    """
+    ASGI 中间件：统计进行中的请求数（包括流式响应直到最后一个 chunk 发送完毕），
+    排空期间拒绝新请求
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if SERVER_STATE["reject_new"] and scope["path"] not in DRAIN_EXEMPT_PATHS:
+            response = JSONResponse(
+                status_code=503,
+                content={"detail": "服务正在重启，请稍后重试"},
+                headers={"Connection": "close", "Retry-After": "1"}
             )
-        
-        # 非流式请求
+            await response(scope, receive, send)
+            return
+
+        with _server_state_lock:
+            SERVER_STATE["in_flight"] += 1
         try:
-            response_text = send_yuanbao_request(user_message, model=request.model)
-        except Exception as e:
-            # 将错误信息作为正常响应返回
-            response_text = str(e)
-        
-        # 检查是否是 tool call（传入 has_tool_result_in_history 防止死循环）
-        tool_call_data = parse_tool_call(response_text, has_tool_result_in_history)
-        
-        if tool_call_data:
-            # 是 tool call，构造 tool_calls 格式的响应
-            logger.info(f"检测到 tool call: {tool_call_data}")
-            tool_call_id = f"call_{str(hash(response_text))}"
-            
-            # 构造 function 参数
-            function_args = {
-                "command": tool_call_data.get('command', ''),
-                "args": tool_call_data.get('args', [])
-            }
-            
-            response_data = {
-                "id": f"chatcmpl-{str(hash(response_text))}",
-                "object": "chat.completion",
-                "created": int(time.time()),
+            await self.app(scope, receive, send)
+        finally:
+            with _server_state_lock:
+                SERVER_STATE["in_flight"] -= 1
+
+def begin_drain(reject_new: bool = True):
+    """
+    进入排空状态，进行中的请求继续完成
+
+    Args:
+        reject_new: 新请求是否返回 503；监听 socket 已交给新进程时，已建立连接上的请求照常处理
+    """
+    SERVER_STATE["reject_new"] = reject_new
+    if not SERVER_STATE["draining"]:
+        SERVER_STATE["draining"] = True
+        logger.info(f"进入排空状态，进行中请求: {SERVER_STATE['in_flight']}，最长等待 {DRAIN_TIMEOUT} 秒")
+
+def wait_for_drain(timeout: Optional[float] = None, min_wait: float = 0) -> bool:
+    """等待进行中的请求全部完成（至少等待 min_wait 秒），超时（默认 DRAIN_TIMEOUT）返回 False"""
+    start = time.time()
+    deadline = start + (DRAIN_TIMEOUT if timeout is None else timeout)
+    while SERVER_STATE["in_flight"] > 0 or time.time() - start < min_wait:
+        if time.time() >= deadline:
+            logger.warning(f"排空超时，仍有 {SERVER_STATE['in_flight']} 个请求未完成")
+            return False
+        time.sleep(0.1)
+    logger.info("所有进行中的请求已完成")
+    return True
+
+# API Key 配置文件：存在时启用鉴权，每行格式 "API Key:名称,weight=2,rpm=60,tpm=200000,admin=1"
+API_KEYS_FILE = os.environ.get("YUANBAO_API_KEYS_FILE", "yuanbao_api_keys.txt")
+# 管理员 Key：可访问调试、重载配置、清除对话和请求追踪接口；未设置且未启用鉴权时这些接口只允许本机直接访问
+ADMIN_KEY = os.environ.get("YUANBAO_ADMIN_KEY", "")
+# 未单独配置时每个 Key 的默认限额（0 表示不限制）
+DEFAULT_TENANT_RPM = float(os.environ.get("YUANBAO_DEFAULT_RPM", "0"))
+DEFAULT_TENANT_TPM = float(os.environ.get("YUANBAO_DEFAULT_TPM", "0"))
+# 同时发往元宝的最大请求数，超出时按租户权重公平排队
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get("YUANBAO_UPSTREAM_MAX_CONCURRENCY", "8"))
+# 每个租户最多排队的请求数
+TENANT_MAX_QUEUE = int(os.environ.get("YUANBAO_TENANT_MAX_QUEUE", "100"))
+# 优先级（从高到低），请求通过 X-Priority 头指定，未指定时使用 API Key 配置的 priority（默认 normal）
+PRIORITY_CLASSES = ("interactive", "normal", "background")
+# 优先级调度方式：strict 严格按优先级；weighted 按 YUANBAO_PRIORITY_WEIGHTS 的权重分配
+PRIORITY_MODE = os.environ.get("YUANBAO_PRIORITY_MODE", "strict")
+PRIORITY_WEIGHTS = {
+    name.strip(): float(weight)
+    for name, _, weight in (item.partition(':') for item in os.environ.get("YUANBAO_PRIORITY_WEIGHTS", "interactive:8,normal:4,background:1").split(','))
+    if name.strip() in PRIORITY_CLASSES and weight
+}
+# 最低优先级不能占用的并发名额数，保证高优先级请求到达时不必等待后台任务结束
+PRIORITY_RESERVED_SLOTS = int(os.environ.get("YUANBAO_PRIORITY_RESERVED_SLOTS", "1"))
+# 需要排队并计入配额的接口（会调用元宝）
+UPSTREAM_PATHS = {"/v1/chat/completions", "/v1/responses", "/api/chat", "/api/generate"}
+
+# API Key -> 租户配置（create_app 时加载）
+API_KEYS = {}
+# 租户名 -> 用量统计
+TENANT_USAGE = collections.defaultdict(lambda: {
+    "requests": 0,
+    "rejected": 0,
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+    "queue_wait_seconds": 0.0
+})
+# 当前请求的租户与用量（流式响应在线程池中迭代时同样可见）
+CURRENT_TENANT = contextvars.ContextVar("current_tenant", default=None)
+CURRENT_USAGE = contextvars.ContextVar("current_usage", default=None)
+
+def load_api_keys() -> Dict[str, dict]:
+    """读取 API Key 配置，文件不存在时返回空字典（不启用鉴权）"""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    keys_path = os.path.join(script_dir, API_KEYS_FILE)
+    if not os.path.exists(keys_path):
+        return {}
+    keys = {}
+    with open(keys_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            api_key, _, spec = line.partition(':')
+            fields = [field.strip() for field in spec.split(',') if field.strip()]
+            tenant = {
+                "name": fields[0] if fields and '=' not in fields[0] else api_key.strip()[:8],
+                "weight": 1.0,
+                "rpm": DEFAULT_TENANT_RPM,
+                "tpm": DEFAULT_TENANT_TPM,
+                "admin": False,
+                "priority": "normal"
+            }
+            for field in fields:
+                key, sep, value = field.partition('=')
+                if not sep:
+                    continue
+                key = key.strip()
+                if key == "admin":
+                    tenant["admin"] = value.strip() in ("1", "true", "yes")
+                elif key in ("weight", "rpm", "tpm"):
+                    tenant[key] = float(value)
+                elif key == "priority" and value.strip() in PRIORITY_CLASSES:
+                    tenant["priority"] = value.strip()
+            keys[api_key.strip()] = tenant
+    logger.info(f"已加载 {len(keys)} 个 API Key，启用鉴权")
+    return keys
+
+
+class TokenBucket:
+    """令牌桶：rate 为每秒补充量，capacity 为桶容量；允许透支，透支期间拒绝新请求"""
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, amount: float) -> bool:
+        """桶内余量为正时扣除 amount（可能透支）并返回 True"""
+        if self.capacity <= 0:
+            return True
+        self._refill()
+        if self.tokens < min(amount, 1):
+            return False
+        self.tokens -= amount
+        return True
+
+    def adjust(self, amount: float):
+        """请求结束后按实际用量修正（正数为补扣，负数为退还）"""
+        if self.capacity <= 0:
+            return
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+    def retry_after(self) -> float:
+        if self.rate <= 0:
+            return 1.0
+        return max((1 - self.tokens) / self.rate, 1.0)
+
+_tenant_buckets = {}
+
+def get_tenant_buckets(tenant: dict) -> tuple:
+    buckets = _tenant_buckets.get(tenant["name"])
+    if buckets is None or buckets[0].capacity != tenant["rpm"] or buckets[1].capacity != tenant["tpm"]:
+        buckets = (TokenBucket(tenant["rpm"]), TokenBucket(tenant["tpm"]))
+        _tenant_buckets[tenant["name"]] = buckets
+    return buckets
+
+class FairScheduler:
+    """
+    按优先级分队列的加权公平调度：限制同时发往元宝的请求数，空闲时直接放行
+
+    - 优先级之间按 mode 调度：strict 总是先放行高优先级；weighted 按优先级权重分配名额
+    - 同一优先级内每次放行虚拟时间最小的租户，租户每被服务一次虚拟时间增加 1/weight
+    - 最低优先级最多占用 capacity - reserved 个名额，给后到的高优先级请求留出位置；
+      排队中的低优先级请求在高优先级请求到达后让位，已开始的请求不会被打断
+    """
+    def __init__(self, capacity: int, mode: str = "strict", priority_weights: Optional[Dict[str, float]] = None, reserved: int = 0):
+        self.capacity = capacity
+        self.mode = mode
+        self.priority_weights = priority_weights or {priority: 1.0 for priority in PRIORITY_CLASSES}
+        self.reserved = reserved
+        self.active = 0
+        self.active_by_priority = collections.Counter()
+        self.queues = {priority: collections.defaultdict(collections.deque) for priority in PRIORITY_CLASSES}
+        self.virtual_time = collections.defaultdict(float)
+        self._clock = 0.0
+        self.priority_time = collections.defaultdict(float)
+        self._priority_clock = 0.0
+        self.wait_stats = {priority: {"count": 0, "total": 0.0, "max": 0.0, "recent": collections.deque(maxlen=1000)}
+                           for priority in PRIORITY_CLASSES}
+
+    def queued(self, tenant: Optional[str] = None, priority: Optional[str] = None) -> int:
+        priorities = [priority] if priority else PRIORITY_CLASSES
+        if tenant is not None:
+            return sum(len(self.queues[p].get(tenant, ())) for p in priorities)
+        return sum(len(queue) for p in priorities for queue in self.queues[p].values())
+
+    def _limit(self, priority: str) -> int:
+        if priority == PRIORITY_CLASSES[-1]:
+            return max(self.capacity - self.reserved, 1)
+        return self.capacity
+
+    def _can_start(self, priority: str) -> bool:
+        return self.active < self.capacity and self.active_by_priority[priority] < self._limit(priority)
+
+    def _start(self, tenant: str, weight: float, priority: str):
+        # 新加入排队的租户从当前时钟开始，避免长期空闲的租户积累过多份额
+        start = max(self.virtual_time[tenant], self._clock)
+        self._clock = start
+        self.virtual_time[tenant] = start + 1.0 / max(weight, 0.01)
+        if self.mode == "weighted":
+            start = max(self.priority_time[priority], self._priority_clock)
+            self._priority_clock = start
+            self.priority_time[priority] = start + 1.0 / max(self.priority_weights.get(priority, 1.0), 0.01)
+        self.active += 1
+        self.active_by_priority[priority] += 1
+
+    def _record_wait(self, priority: str, seconds: float):
+        stats = self.wait_stats[priority]
+        stats["count"] += 1
+        stats["total"] += seconds
+        stats["max"] = max(stats["max"], seconds)
+        stats["recent"].append(seconds)
+
+    async def acquire(self, tenant: str, weight: float = 1.0, priority: str = "normal"):
+        queued_at = time.monotonic()
+        # 同级或更高优先级有人排队时不能插队
+        higher = PRIORITY_CLASSES[:PRIORITY_CLASSES.index(priority) + 1]
+        if self._can_start(priority) and not any(self.queued(priority=p) for p in higher):
+            self._start(tenant, weight, priority)
+            self._record_wait(priority, 0.0)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.queues[priority][tenant].append((future, weight))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 已经被放行但调用方取消时，归还并发名额
+            if future.done() and not future.cancelled():
+                self.release(priority)
+            raise
+        self._record_wait(priority, time.monotonic() - queued_at)
+
+    def release(self, priority: str = "normal"):
+        self.active -= 1
+        self.active_by_priority[priority] -= 1
+        self._dispatch()
+
+    def _next_priority(self) -> Optional[str]:
+        candidates = [p for p in PRIORITY_CLASSES if self.queued(priority=p) and self._can_start(p)]
+        if not candidates:
+            return None
+        if self.mode == "weighted":
+            return min(candidates, key=lambda p: max(self.priority_time[p], self._priority_clock))
+        return candidates[0]
+
+    def _dispatch(self):
+        while self.active < self.capacity:
+            priority = self._next_priority()
+            if priority is None:
+                return
+            queues = self.queues[priority]
+            tenant = min((name for name, queue in queues.items() if queue),
+                         key=lambda name: max(self.virtual_time[name], self._clock))
+            future, weight = queues[tenant].popleft()
+            if not queues[tenant]:
+                del queues[tenant]
+            if future.cancelled():
+                continue
+            self._start(tenant, weight, priority)
+            future.set_result(None)
+
+    def wait_metrics(self) -> dict:
+        """各优先级的排队等待时间统计（毫秒，百分位基于最近 1000 个请求）"""
+        def percentile(values: list, fraction: float) -> float:
+            return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+        metrics = {}
+        for priority, stats in self.wait_stats.items():
+            recent = sorted(stats["recent"])
+            metrics[priority] = {
+                "requests": stats["count"],
+                "active": self.active_by_priority[priority],
+                "queued": self.queued(priority=priority),
+                "avg_wait_ms": round(stats["total"] / stats["count"] * 1000, 2) if stats["count"] else 0.0,
+                "p50_wait_ms": round(percentile(recent, 0.5) * 1000, 2),
+                "p95_wait_ms": round(percentile(recent, 0.95) * 1000, 2),
+                "max_wait_ms": round(stats["max"] * 1000, 2)
+            }
+        return metrics
+
+UPSTREAM_SCHEDULER = FairScheduler(UPSTREAM_MAX_CONCURRENCY, PRIORITY_MODE, PRIORITY_WEIGHTS, PRIORITY_RESERVED_SLOTS)
+
+def identify_tenant(headers: dict) -> Optional[dict]:
+    """根据 Authorization: Bearer / x-api-key 识别租户；启用鉴权且 Key 无效时返回 None"""
+    api_key = headers.get("x-api-key", "")
+    authorization = headers.get("authorization", "")
+    if not api_key and authorization.lower().startswith("bearer "):
+        api_key = authorization[7:].strip()
+    if ADMIN_KEY and hmac.compare_digest(api_key.encode(), ADMIN_KEY.encode()):
+        return {"name": "admin", "weight": 1.0, "rpm": 0, "tpm": 0, "admin": True, "priority": "normal"}
+    if API_KEYS:
+        return API_KEYS.get(api_key)
+    # 未启用鉴权：按客户端提供的 Key 区分租户，没有 Key 的归为 anonymous
+    name = f"key-{hashlib.sha256(api_key.encode()).hexdigest()[:8]}" if api_key else "anonymous"
+    return {"name": name, "weight": 1.0, "rpm": DEFAULT_TENANT_RPM, "tpm": DEFAULT_TENANT_TPM, "admin": False, "priority": "normal"}
+
+def is_admin(request: Request) -> bool:
+    """
+    是否为管理员：admin=1 的 API Key 或 YUANBAO_ADMIN_KEY；
+    两者都未配置时本机直接访问视为管理员（经过网关或反向代理转发的请求不算）
+    """
+    tenant = identify_tenant(request.headers)
+    if tenant is not None and tenant["admin"]:
+        return True
+    if not ADMIN_KEY and not any(item["admin"] for item in API_KEYS.values()):
+        client_host = request.client.host if request.client else ""
+        if client_host in ("127.0.0.1", "::1") and "x-forwarded-for" not in request.headers and "forwarded" not in request.headers:
+            return True
+    return False
+
+def require_admin(request: Request):
+    """管理接口只允许管理员访问，其它调用方返回 403"""
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Admin API key required")
+
+def record_usage(prompt_tokens: int = 0, completion_tokens: int = 0):
+    """把用量计入当前请求（由 AdmissionMiddleware 在请求结束后汇总到租户）"""
+    usage = CURRENT_USAGE.get()
+    if usage is not None:
+        usage["prompt_tokens"] += prompt_tokens
+        usage["completion_tokens"] += completion_tokens
+
+class AdmissionRejected(Exception):
+    """超出租户限额或排队上限"""
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+@asynccontextmanager
+async def admitted(tenant: dict, estimated_tokens: int, priority: str = ""):
+    """
+    按租户令牌桶限流并获取元宝并发名额（HTTP 与 WebSocket 请求共用）
+
+    超限时抛出 AdmissionRejected；退出时归还名额，并按实际用量修正 token 配额
+    """
+    usage_stats = TENANT_USAGE[tenant["name"]]
+    request_bucket, token_bucket = get_tenant_buckets(tenant)
+    bucket = None
+    if not request_bucket.try_consume(1):
+        bucket = request_bucket
+    elif not token_bucket.try_consume(estimated_tokens):
+        request_bucket.adjust(-1)
+        bucket = token_bucket
+    if bucket is not None:
+        usage_stats["rejected"] += 1
+        raise AdmissionRejected(f"Rate limit exceeded for {tenant['name']}", int(bucket.retry_after()))
+    if UPSTREAM_SCHEDULER.queued(tenant["name"]) >= TENANT_MAX_QUEUE:
+        usage_stats["rejected"] += 1
+        request_bucket.adjust(-1)
+        token_bucket.adjust(-estimated_tokens)
+        raise AdmissionRejected("Too many queued requests")
+
+    if priority not in PRIORITY_CLASSES:
+        priority = tenant.get("priority", "normal")
+    trace = CURRENT_TRACE.get()
+    if trace:
+        trace.attributes["yuanbao.priority"] = priority
+    queued_at = time.monotonic()
+    with trace_span("queue_wait"):
+        await UPSTREAM_SCHEDULER.acquire(tenant["name"], tenant["weight"], priority)
+    usage_stats["queue_wait_seconds"] += time.monotonic() - queued_at
+    usage_stats["requests"] += 1
+
+    usage = {"prompt_tokens": 0, "completion_tokens": 0}
+    tenant_token = CURRENT_TENANT.set(tenant)
+    usage_token = CURRENT_USAGE.set(usage)
+    try:
+        yield usage
+    finally:
+        CURRENT_TENANT.reset(tenant_token)
+        CURRENT_USAGE.reset(usage_token)
+        UPSTREAM_SCHEDULER.release(priority)
+        usage_stats["prompt_tokens"] += usage["prompt_tokens"]
+        usage_stats["completion_tokens"] += usage["completion_tokens"]
+        token_bucket.adjust(usage["prompt_tokens"] + usage["completion_tokens"] - estimated_tokens)
+
+class AdmissionMiddleware:
+    """
+    ASGI 中间件：识别 API Key，按租户令牌桶限流（请求数与估算 token 数），
+    并通过加权公平队列获取元宝并发名额，直到响应（包括流式响应）发送完毕
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (scope["path"].startswith("/health") or scope["path"] in DRAIN_EXEMPT_PATHS):
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        tenant = identify_tenant(headers)
+        if tenant is None:
+            response = JSONResponse(status_code=401, content={"error": {"message": "Invalid API key", "type": "invalid_request_error", "code": "invalid_api_key"}})
+            await response(scope, receive, send)
+            return
+
+        if scope["path"] not in UPSTREAM_PATHS or scope["method"] != "POST":
+            token = CURRENT_TENANT.set(tenant)
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                CURRENT_TENANT.reset(token)
+            return
+
+        priority = headers.get("x-priority", "").strip().lower()
+        # 以请求体大小粗略估算输入 token，结束后按实际用量修正
+        estimated_tokens = int(headers.get("content-length") or 0) // 3
+        try:
+            async with admitted(tenant, estimated_tokens, priority):
+                await self.app(scope, receive, send)
+        except AdmissionRejected as e:
+            response = JSONResponse(status_code=429, content={"error": {"message": str(e), "type": "rate_limit_error"}},
+                                    headers={"Retry-After": str(e.retry_after)})
+            await response(scope, receive, send)
+
+# 最近完成的请求 trace 保留条数（/api/traces 查看）
+TRACE_HISTORY_SIZE = int(os.environ.get("YUANBAO_TRACE_HISTORY_SIZE", "200"))
+# 设置后把每个请求的 trace 以 OTLP JSON 格式追加写入该文件（每行一个 ExportTraceServiceRequest）
+TRACE_EXPORT_FILE = os.environ.get("YUANBAO_TRACE_EXPORT_FILE", "")
+
+CURRENT_TRACE = contextvars.ContextVar("current_trace", default=None)
+RECENT_TRACES = collections.OrderedDict()
+_traces_lock = threading.Lock()
+_trace_export_lock = threading.Lock()
+
+class RequestTrace:
+    """
+    单个请求的耗时分解
+
+    spans 记录区间（排队、获取对话、连接上游），marks 记录时间点（首字节、首个 token、最后一个 token），
+    encode 为逐个事件编码并下发给客户端的累计耗时；时间均为相对请求开始的秒数
+    """
+    def __init__(self, method: str, path: str):
+        self.request_id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.start_ns = time.time_ns()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.status_code = None
+        self.spans = []
+        self.marks = {}
+        self.encode = 0.0
+        self.upstream_trace_id = None
+        self.upstream_msg_index = None
+        self.attributes = {}
+
+    def now(self) -> float:
+        return time.perf_counter() - self.start
+
+    def mark(self, name: str, overwrite: bool = False):
+        if overwrite or name not in self.marks:
+            self.marks[name] = self.now()
+
+    @contextmanager
+    def span(self, name: str):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, self.now()))
+
+    def to_dict(self) -> dict:
+        def ms(seconds):
+            return round(seconds * 1000, 2) if seconds is not None else None
+        return {
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.start_ns / 1e9,
+            "duration_ms": ms(self.duration),
+            "status_code": self.status_code,
+            "upstream_trace_id": self.upstream_trace_id,
+            "upstream_msg_index": self.upstream_msg_index,
+            "attributes": self.attributes,
+            "spans": [{"name": name, "start_ms": ms(start), "duration_ms": ms(end - start)} for name, start, end in self.spans],
+            "marks_ms": {name: ms(offset) for name, offset in self.marks.items()},
+            "encode_ms": ms(self.encode)
+        }
+
+    def to_otlp(self) -> dict:
+        """转换为 OTLP/JSON（OpenTelemetry 文件导出格式），根 span 为整个请求，子 span 为各阶段"""
+        def nanos(offset: float) -> str:
+            return str(self.start_ns + int(offset * 1e9))
+
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {"key": key, "value": {"boolValue": value}}
+            if isinstance(value, int):
+                return {"key": key, "value": {"intValue": str(value)}}
+            if isinstance(value, float):
+                return {"key": key, "value": {"doubleValue": value}}
+            return {"key": key, "value": {"stringValue": str(value)}}
+
+        root_id = self.request_id[:16]
+        root_attributes = {"http.request.method": self.method, "url.path": self.path, "yuanbao.encode_ms": round(self.encode * 1000, 2), **self.attributes}
+        if self.status_code is not None:
+            root_attributes["http.response.status_code"] = self.status_code
+        if self.upstream_trace_id:
+            root_attributes["yuanbao.upstream_trace_id"] = self.upstream_trace_id
+        spans = [{
+            "traceId": self.request_id,
+            "spanId": root_id,
+            "name": f"{self.method} {self.path}",
+            "kind": 2,
+            "startTimeUnixNano": nanos(0),
+            "endTimeUnixNano": nanos(self.duration or self.now()),
+            "attributes": [attribute(key, value) for key, value in root_attributes.items() if value is not None],
+            "events": [{"timeUnixNano": nanos(offset), "name": name} for name, offset in self.marks.items()],
+            "status": {"code": 2 if (self.status_code or 0) >= 500 else 1}
+        }]
+        for index, (name, start, end) in enumerate(self.spans):
+            spans.append({
+                "traceId": self.request_id,
+                "spanId": f"{index + 1:016x}",
+                "parentSpanId": root_id,
+                "name": name,
+                "kind": 1,
+                "startTimeUnixNano": nanos(start),
+                "endTimeUnixNano": nanos(end)
+            })
+        return {"resourceSpans": [{
+            "resource": {"attributes": [attribute("service.name", "yuanbao-openai-api")]},
+            "scopeSpans": [{"scope": {"name": "yuanbao_openai_api"}, "spans": spans}]
+        }]}
+
+def trace_span(name: str):
+    """在当前请求的 trace 中记录一个区间，没有 trace 时什么也不做"""
+    trace = CURRENT_TRACE.get()
+    return trace.span(name) if trace else nullcontext()
+
+def current_upstream_trace_id() -> Optional[str]:
+    trace = CURRENT_TRACE.get()
+    return trace.upstream_trace_id if trace else None
+
+def finish_trace(trace: RequestTrace):
+    """保存已完成的 trace，并按配置导出到文件"""
+    trace.duration = trace.now()
+    with _traces_lock:
+        RECENT_TRACES[trace.request_id] = trace
+        while len(RECENT_TRACES) > TRACE_HISTORY_SIZE:
+            RECENT_TRACES.popitem(last=False)
+    if TRACE_EXPORT_FILE:
+        try:
+            line = json.dumps(trace.to_otlp(), ensure_ascii=False)
+            with _trace_export_lock, open(TRACE_EXPORT_FILE, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+        except Exception as e:
+            logger.error(f"导出 trace 失败: {str(e)}")
+
+class TracingMiddleware:
+    """
+    ASGI 中间件：为调用元宝的请求创建 trace，响应头返回 x-request-id，
+    非流式响应在响应头中带上元宝的 x-upstream-trace-id（流式响应在最后一个 chunk 中返回）
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in UPSTREAM_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(scope["method"], scope["path"])
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                trace.status_code = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-request-id", trace.request_id.encode()))
+                if trace.upstream_trace_id:
+                    headers.append((b"x-upstream-trace-id", trace.upstream_trace_id.encode("latin-1", "replace")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = CURRENT_TRACE.set(trace)
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            CURRENT_TRACE.reset(token)
+            finish_trace(trace)
+
+# 幂等请求（Idempotency-Key）结果保存时间（秒）和最多保存条数
+IDEMPOTENCY_TTL = float(os.environ.get("YUANBAO_IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get("YUANBAO_IDEMPOTENCY_MAX_ENTRIES", "1000"))
+# 单个响应超过该大小时不保存（重试会重新请求元宝）
+IDEMPOTENCY_MAX_RESPONSE_BYTES = int(os.environ.get("YUANBAO_IDEMPOTENCY_MAX_RESPONSE_BYTES", str(4 * 1024 * 1024)))
+# 结果存储的 SQLite 文件，多个 worker（包括重启后的新进程）共用；设为空时只保存在内存中
+IDEMPOTENCY_DB = os.environ.get("YUANBAO_IDEMPOTENCY_DB", "yuanbao_idempotency.db")
+# 其它 worker 正在处理同一个 Key 时，等待其结果的最长时间（秒）
+IDEMPOTENCY_WAIT_TIMEOUT = 600
+# 等待超时返回 409 时建议客户端重试的间隔（秒）
+IDEMPOTENCY_RETRY_AFTER = 5
+
+class IdempotencyStore:
+    """
+    已完成请求的原始响应（状态码、响应头、按原切分保存的响应体），按 TTL 过期并限制条数
+
+    path 为空时保存在内存中，否则保存在 SQLite 文件中
+    """
+    def __init__(self, path: str, ttl: float = IDEMPOTENCY_TTL, max_entries: int = IDEMPOTENCY_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if path and not os.path.isabs(path):
+            self.path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+        if self.path:
+            with self._connect() as db:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("""CREATE TABLE IF NOT EXISTS idempotency (
+                    key TEXT PRIMARY KEY, fingerprint TEXT, status INTEGER, headers TEXT,
+                    chunk_sizes TEXT, body BLOB, created_at REAL, pending INTEGER DEFAULT 0)""")
+                db.execute("CREATE INDEX IF NOT EXISTS idempotency_created ON idempotency(created_at)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def claim(self, key: str, fingerprint: str) -> bool:
+        """登记正在处理的 Key，供其它 worker 等待；已有未过期的记录时返回 False"""
+        if not self.path:
+            return True
+        with self._connect() as db:
+            # 处理中的登记超过等待时间视为 worker 已退出
+            db.execute("DELETE FROM idempotency WHERE created_at < ? OR (pending = 1 AND created_at < ?)",
+                       (time.time() - self.ttl, time.time() - IDEMPOTENCY_WAIT_TIMEOUT))
+            try:
+                db.execute("INSERT INTO idempotency (key, fingerprint, created_at, pending) VALUES (?, ?, ?, 1)",
+                           (key, fingerprint, time.time()))
+                return True
+            except sqlite3.IntegrityError:
+                return False
+
+    def release(self, key: str):
+        """请求没有可保存的结果时删除登记，之后的重试会重新执行"""
+        if self.path:
+            with self._connect() as db:
+                db.execute("DELETE FROM idempotency WHERE key = ? AND pending = 1", (key,))
+
+    def get(self, key: str) -> Optional[dict]:
+        """返回保存的结果；其它 worker 仍在处理时返回 {"pending": True, ...}"""
+        if not self.path:
+            with self._lock:
+                item = self._memory.get(key)
+                if item and item["created_at"] < time.time() - self.ttl:
+                    del self._memory[key]
+                    item = None
+                return item
+        with self._connect() as db:
+            row = db.execute("SELECT fingerprint, status, headers, chunk_sizes, body, created_at, pending FROM idempotency WHERE key = ?",
+                             (key,)).fetchone()
+        if row is None or row[5] < time.time() - self.ttl:
+            return None
+        fingerprint, status, headers, chunk_sizes, body, created_at, pending = row
+        if pending:
+            return {"pending": True, "fingerprint": fingerprint}
+        chunks, offset = [], 0
+        for size in json.loads(chunk_sizes):
+            chunks.append(body[offset:offset + size])
+            offset += size
+        return {
+            "pending": False,
+            "fingerprint": fingerprint,
+            "status": status,
+            "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in json.loads(headers)],
+            "chunks": chunks,
+            "created_at": created_at
+        }
+
+    def put(self, key: str, fingerprint: str, status: int, headers: list, chunks: List[bytes]):
+        now = time.time()
+        if not self.path:
+            with self._lock:
+                self._memory[key] = {"pending": False, "fingerprint": fingerprint, "status": status,
+                                     "headers": headers, "chunks": chunks, "created_at": now}
+                while len(self._memory) > self.max_entries:
+                    self._memory.popitem(last=False)
+            return
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO idempotency VALUES (?, ?, ?, ?, ?, ?, ?, 0)", (
+                key, fingerprint, status,
+                json.dumps([(name.decode("latin-1"), value.decode("latin-1")) for name, value in headers]),
+                json.dumps([len(chunk) for chunk in chunks]), b"".join(chunks), now
+            ))
+            db.execute("DELETE FROM idempotency WHERE created_at < ?", (now - self.ttl,))
+            db.execute("DELETE FROM idempotency WHERE key NOT IN (SELECT key FROM idempotency ORDER BY created_at DESC LIMIT ?)",
+                       (self.max_entries,))
+
+# 第一次使用时才打开数据库（get_idempotency_store）
+IDEMPOTENCY_STORE = None
+_idempotency_store_lock = threading.Lock()
+
+def get_idempotency_store() -> IdempotencyStore:
+    global IDEMPOTENCY_STORE
+    with _idempotency_store_lock:
+        if IDEMPOTENCY_STORE is None:
+            IDEMPOTENCY_STORE = IdempotencyStore(IDEMPOTENCY_DB, IDEMPOTENCY_TTL, IDEMPOTENCY_MAX_ENTRIES)
+        return IDEMPOTENCY_STORE
+# 本进程中正在处理的请求：存储 Key -> IdempotencyEntry，重试的请求直接跟随输出
+IDEMPOTENCY_INFLIGHT = {}
+
+class IdempotencyEntry:
+    """正在处理的请求的响应记录，跟随的请求按同样的切分逐块输出"""
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.status = None
+        self.headers = []
+        self.chunks = []
+        self.size = 0
+        self.done = False
+        self.complete = False
+        # 响应超过 IDEMPOTENCY_MAX_RESPONSE_BYTES：不再记录，也不保存
+        self.truncated = False
+        self.changed = asyncio.Condition()
+
+    async def notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+async def replay_response(send, status: int, headers: list, chunks, entry: Optional[IdempotencyEntry] = None):
+    """按原样重放响应（响应体逐字节一致），entry 不为空时一直跟随到原请求结束"""
+    if entry is not None:
+        async with entry.changed:
+            await entry.changed.wait_for(lambda: entry.status is not None or entry.done)
+        status, headers, chunks = entry.status, entry.headers, entry.chunks
+        if status is None:
+            status, headers = 500, [(b"content-type", b"application/json")]
+            chunks = [json.dumps({"error": {"message": "Original request failed", "type": "server_error"}}).encode()]
+        elif entry.truncated:
+            # 响应过大、没有完整记录，无法跟随；原请求结束后重试会重新执行
+            status, headers = 409, [(b"content-type", b"application/json"), (b"retry-after", str(IDEMPOTENCY_RETRY_AFTER).encode())]
+            chunks = [json.dumps({"error": {
+                "message": "The response to this Idempotency-Key is too large to replay, retry after the original request completes",
+                "type": "invalid_request_error", "param": "Idempotency-Key"
+            }}).encode()]
+            entry = None
+    await send({"type": "http.response.start", "status": status, "headers": list(headers) + [(b"idempotent-replayed", b"true")]})
+    index = 0
+    while True:
+        while index < len(chunks):
+            await send({"type": "http.response.body", "body": chunks[index], "more_body": True})
+            index += 1
+        if entry is None:
+            break
+        async with entry.changed:
+            await entry.changed.wait_for(lambda: len(entry.chunks) > index or entry.done or entry.truncated)
+        # 原请求的响应超过记录上限时结束跟随，客户端收到的是不完整的响应
+        if entry.truncated or (entry.done and index >= len(entry.chunks)):
+            break
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+class IdempotencyMiddleware:
+    """
+    ASGI 中间件：支持 Idempotency-Key 请求头
+
+    - 第一个请求正常执行，同时记录原始响应；原请求的客户端断开后仍会执行完，供重试使用
+    - 重试时若原请求还在进行，则跟随其输出；已完成（2xx）的结果按原样重放
+    - 同一个 Key 对应不同请求体时返回 422
+    - 其它 worker 正在处理同一个 Key 时等待其结果，等待超时返回 409，不会重复执行
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in UPSTREAM_PATHS:
+            await self.app(scope, receive, send)
+            return
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        idempotency_key = headers.get("idempotency-key")
+        tenant = identify_tenant(headers) if idempotency_key else None
+        if tenant is None:
+            await self.app(scope, receive, send)
+            return
+
+        body_parts = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body_parts.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body = b"".join(body_parts)
+        store_key = hashlib.sha256(f"{tenant['name']}\n{scope['path']}\n{idempotency_key}".encode()).hexdigest()
+        fingerprint = hashlib.sha256(body).hexdigest()
+
+        async def mismatch():
+            response = JSONResponse(status_code=422, content={"error": {
+                "message": "Idempotency-Key has already been used with a different request body",
+                "type": "invalid_request_error", "param": "Idempotency-Key"
+            }})
+            await response(scope, receive, send)
+
+        # 本进程正在处理同一个 Key：跟随原请求的输出
+        entry = IDEMPOTENCY_INFLIGHT.get(store_key)
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                await mismatch()
+                return
+            logger.info(f"幂等请求跟随进行中的响应: {idempotency_key}")
+            await replay_response(send, None, None, None, entry)
+            return
+
+        entry = IdempotencyEntry(fingerprint)
+        IDEMPOTENCY_INFLIGHT[store_key] = entry
+        try:
+            deadline = time.monotonic() + IDEMPOTENCY_WAIT_TIMEOUT
+            while True:
+                stored = await asyncio.to_thread(get_idempotency_store().get, store_key)
+                # 其它 worker 正在处理：等待其结果
+                while stored and stored["pending"] and stored["fingerprint"] == fingerprint and time.monotonic() < deadline:
+                    await asyncio.sleep(0.2)
+                    stored = await asyncio.to_thread(get_idempotency_store().get, store_key)
+                if stored and stored["fingerprint"] != fingerprint:
+                    await mismatch()
+                    return
+                if stored and stored["pending"]:
+                    # 等待超时而其它 worker 仍未完成：不能重新执行，让客户端稍后重试
+                    logger.warning(f"幂等请求等待其它 worker 的结果超时: {idempotency_key}")
+                    response = JSONResponse(status_code=409, headers={"Retry-After": str(IDEMPOTENCY_RETRY_AFTER)}, content={"error": {
+                        "message": "A request with this Idempotency-Key is still in progress",
+                        "type": "invalid_request_error", "param": "Idempotency-Key"
+                    }})
+                    await response(scope, receive, send)
+                    return
+                if stored:
+                    logger.info(f"幂等请求重放已保存的响应: {idempotency_key}")
+                    entry.status, entry.headers, entry.chunks = stored["status"], stored["headers"], stored["chunks"]
+                    entry.done = entry.complete = True
+                    await entry.notify()
+                    await replay_response(send, stored["status"], stored["headers"], stored["chunks"])
+                    return
+                # 登记失败说明其它 worker 刚刚抢先登记：回到上面等待其结果
+                if await asyncio.to_thread(get_idempotency_store().claim, store_key, fingerprint):
+                    break
+            try:
+                await self._run(scope, body, send, entry)
+            finally:
+                # 只保存成功的完整响应，失败的请求重试时重新执行
+                if entry.complete and 200 <= entry.status < 300 and not entry.truncated:
+                    await asyncio.to_thread(get_idempotency_store().put, store_key, fingerprint, entry.status, entry.headers, entry.chunks)
+                else:
+                    await asyncio.to_thread(get_idempotency_store().release, store_key)
+        finally:
+            entry.done = True
+            await entry.notify()
+            IDEMPOTENCY_INFLIGHT.pop(store_key, None)
+
+    async def _run(self, scope, body: bytes, send, entry: IdempotencyEntry):
+        body_sent = False
+        client_gone = False
+        never = asyncio.Event()
+
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # 不把客户端断开传给应用，保证原请求执行完毕、结果可供重试使用
+            await never.wait()
+
+        async def recording_send(message):
+            nonlocal client_gone
+            if message["type"] == "http.response.start":
+                entry.status = message["status"]
+                entry.headers = list(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                if chunk and not entry.truncated:
+                    entry.size += len(chunk)
+                    if entry.size > IDEMPOTENCY_MAX_RESPONSE_BYTES:
+                        # 超出上限：丢弃已记录的内容，之后只转发给客户端
+                        entry.truncated = True
+                        entry.chunks = []
+                        logger.info(f"幂等请求的响应超过 {IDEMPOTENCY_MAX_RESPONSE_BYTES} 字节，不再记录")
+                    else:
+                        entry.chunks.append(chunk)
+                if not message.get("more_body"):
+                    entry.complete = True
+            await entry.notify()
+            if client_gone:
+                return
+            try:
+                await send(message)
+            except Exception:
+                client_gone = True
+                logger.info("幂等请求的客户端已断开，继续执行以便重试时使用结果")
+
+        await self.app(scope, replay_receive, recording_send)
+
+# 响应压缩：非流式响应体不小于该字节数时按 Accept-Encoding 压缩；0 表示关闭压缩
+COMPRESS_MIN_BYTES = int(os.environ.get("YUANBAO_COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.environ.get("YUANBAO_COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_ZSTD_LEVEL = int(os.environ.get("YUANBAO_COMPRESS_ZSTD_LEVEL", "3"))
+# 是否压缩流式响应（SSE、NDJSON）：每个 chunk 压缩后立即 flush，不会推迟 token 下发
+COMPRESS_STREAMS = os.environ.get("YUANBAO_COMPRESS_STREAMS", "1") != "0"
+COMPRESSIBLE_CONTENT_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+@functools.lru_cache(maxsize=None)
+def get_zstandard():
+    """安装 zstandard 后支持 zstd 压缩；第一次协商编码时才导入，未安装时返回 None"""
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """按 Accept-Encoding（含 q 值）选择压缩算法，权重相同时优先 zstd；都不接受时返回 None"""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        quality = 1.0
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for name in ("zstd", "gzip") if get_zstandard() else ("gzip",):
+        quality = accepted.get(name, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+class StreamCompressor:
+    """
+    增量压缩器：compress() 返回压缩并 flush 后的字节，客户端收到后即可解压出这一段内容，
+    同时保留压缩窗口，后续 chunk 中重复的字段名可以引用前文
+    """
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._compressor = get_zstandard().ZstdCompressor(level=COMPRESS_ZSTD_LEVEL).compressobj()
+        else:
+            # wbits=31 输出带 gzip 头的格式
+            self._compressor = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, final: bool = False) -> bytes:
+        if self.encoding == "zstd":
+            zstandard = get_zstandard()
+            mode = zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            mode = zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH
+        return self._compressor.compress(data) + self._compressor.flush(mode)
+
+class CompressionMiddleware:
+    """
+    ASGI 中间件：按 Accept-Encoding 压缩 JSON/文本响应（gzip，安装 zstandard 后支持 zstd）
+
+    非流式响应（有 Content-Length）小于 COMPRESS_MIN_BYTES 时不压缩；流式响应逐个 chunk 压缩并 flush。
+    位于幂等中间件外层，幂等记录保存的是未压缩的响应，重放时按新请求的 Accept-Encoding 压缩
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        encoding = None
+        if scope["type"] == "http" and COMPRESS_MIN_BYTES > 0:
+            for key, value in scope["headers"]:
+                if key == b"accept-encoding":
+                    encoding = negotiate_encoding(value.decode("latin-1"))
+                    break
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor = None
+        # 有 Content-Length 的响应可能仍被拆成多个 body 消息发送（如经过 BaseHTTPMiddleware），先收齐再整体压缩
+        pending = None
+
+        async def compressing_send(message):
+            nonlocal start_message, compressor, pending
+            if message["type"] == "http.response.start":
+                # 等第一个 body 确定是否压缩后再发送响应头
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is not None:
+                headers = MutableHeaders(scope=start_message)
+                length = headers.get("content-length")
+                # 没有 Content-Length 的是流式响应（SSE、NDJSON）
+                streaming = length is None
+                if (
+                    "content-encoding" not in headers
+                    and start_message["status"] not in (204, 304)
+                    and headers.get("content-type", "").startswith(COMPRESSIBLE_CONTENT_TYPES)
+                    and (COMPRESS_STREAMS if streaming else int(length) >= COMPRESS_MIN_BYTES)
+                ):
+                    compressor = StreamCompressor(encoding)
+                    headers["content-encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if not streaming:
+                        pending = bytearray()
+                if pending is None:
+                    await send(start_message)
+                    start_message = None
+            if pending is not None:
+                pending += body
+                if more_body:
+                    return
+                body = compressor.compress(bytes(pending), final=True)
+                pending = None
+                MutableHeaders(scope=start_message)["content-length"] = str(len(body))
+                await send(start_message)
+                await send({"type": "http.response.body", "body": body})
+                return
+            if compressor is not None:
+                message = {"type": "http.response.body", "body": compressor.compress(body, final=not more_body), "more_body": more_body}
+            await send(message)
+
+        await self.app(scope, receive, compressing_send)
+
+# 事件循环阻塞检测阈值（秒），超过时记录阻塞事件循环的调用栈；0 表示关闭
+LOOP_BLOCK_THRESHOLD = float(os.environ.get("YUANBAO_LOOP_BLOCK_THRESHOLD", "0.2"))
+LOOP_BLOCK_HISTORY = 50
+# CPU 采样单次最长时间（秒）
+PROFILE_MAX_SECONDS = 60
+# 采样时视为空闲等待的函数（线程阻塞在锁、select 等上面），默认不计入结果
+PROFILE_IDLE_FUNCTIONS = {"wait", "select", "poll", "_wait_for_tstate_lock", "accept"}
+
+LOOP_BLOCK_INCIDENTS = collections.deque(maxlen=LOOP_BLOCK_HISTORY)
+_loop_monitor = {"heartbeat": 0.0, "thread_id": None, "task": None, "thread": None}
+_loop_monitor_stop = threading.Event()
+_profile_lock = threading.Lock()
+_memory_baseline = {"snapshot": None}
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample_cpu_profile(seconds: float, interval: float, include_idle: bool = False) -> str:
+    """
+    定时采样所有线程的调用栈，返回 collapsed stack 格式（每行 "线程;外层;...;内层 次数"），
+    可直接用 flamegraph.pl / speedscope 生成火焰图
+    """
+    counts = collections.Counter()
+    own_thread = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            if not include_idle and frame.f_code.co_name in PROFILE_IDLE_FUNCTIONS:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_id, str(thread_id)))
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+async def _loop_heartbeat(interval: float):
+    while True:
+        _loop_monitor["heartbeat"] = time.monotonic()
+        await asyncio.sleep(interval)
+
+def _watch_event_loop(interval: float):
+    incident = None
+    while not _loop_monitor_stop.wait(interval):
+        lag = time.monotonic() - _loop_monitor["heartbeat"] - interval
+        if lag >= LOOP_BLOCK_THRESHOLD:
+            if incident is None:
+                # 只在阻塞开始时抓一次调用栈，就是卡住事件循环的同步调用
+                frame = sys._current_frames().get(_loop_monitor["thread_id"])
+                incident = {
+                    "started_at": time.time() - lag,
+                    "stack": ''.join(traceback.format_stack(frame)) if frame else ""
+                }
+            incident["duration_ms"] = round(lag * 1000, 1)
+        elif incident is not None:
+            LOOP_BLOCK_INCIDENTS.append(incident)
+            logger.warning(f"事件循环被阻塞 {incident['duration_ms']} 毫秒，调用栈:\n{incident['stack']}")
+            incident = None
+
+def start_loop_monitor():
+    """在事件循环中启动心跳任务，并用后台线程检测心跳是否按时到达"""
+    if LOOP_BLOCK_THRESHOLD <= 0 or _loop_monitor["thread"] is not None:
+        return
+    interval = LOOP_BLOCK_THRESHOLD / 4
+    _loop_monitor["heartbeat"] = time.monotonic()
+    _loop_monitor["thread_id"] = threading.get_ident()
+    _loop_monitor["task"] = asyncio.get_running_loop().create_task(_loop_heartbeat(interval))
+    _loop_monitor_stop.clear()
+    _loop_monitor["thread"] = threading.Thread(target=_watch_event_loop, args=(interval,), name="loop-monitor", daemon=True)
+    _loop_monitor["thread"].start()
+
+def stop_loop_monitor():
+    _loop_monitor_stop.set()
+    if _loop_monitor["task"] is not None:
+        _loop_monitor["task"].cancel()
+        _loop_monitor["task"] = None
+    if _loop_monitor["thread"] is not None:
+        _loop_monitor["thread"].join(timeout=5)
+        _loop_monitor["thread"] = None
+
+@router.get("/api/debug/profile/cpu")
+async def profile_cpu(request: Request, seconds: float = 10, interval_ms: float = 5, include_idle: bool = False):
+    """采样 CPU N 秒，返回火焰图可用的 collapsed stack 文本"""
+    require_admin(request)
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    if not _profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Another CPU profile is running")
+    try:
+        collapsed = await asyncio.to_thread(sample_cpu_profile, seconds, max(interval_ms, 1) / 1000, include_idle)
+    finally:
+        _profile_lock.release()
+    return PlainTextResponse(collapsed, headers={"Content-Disposition": 'attachment; filename="cpu.collapsed"'})
+
+@router.post("/api/debug/memory/start")
+async def memory_start(request: Request, frames: int = 10):
+    """开始 tracemalloc 内存追踪"""
+    require_admin(request)
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        _memory_baseline["snapshot"] = None
+    return {"tracing": True, "frames": tracemalloc.get_traceback_limit()}
+
+@router.post("/api/debug/memory/stop")
+async def memory_stop(request: Request):
+    require_admin(request)
+    tracemalloc.stop()
+    _memory_baseline["snapshot"] = None
+    return {"tracing": False}
+
+@router.get("/api/debug/memory/snapshot")
+async def memory_snapshot(request: Request, limit: int = 30, group_by: str = "lineno"):
+    """
+    拍摄内存快照，返回占用最多的位置，以及相对上一次快照的增长（用于定位内存泄漏）
+    """
+    require_admin(request)
+    if not tracemalloc.is_tracing():
+        raise HTTPException(status_code=409, detail="tracemalloc is not running, POST /api/debug/memory/start first")
+    if group_by not in ("lineno", "filename", "traceback"):
+        raise HTTPException(status_code=400, detail="group_by must be lineno, filename or traceback")
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>")
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+    result = {
+        "current_bytes": current,
+        "peak_bytes": peak,
+        "top": [
+            {"location": str(stat.traceback), "size_bytes": stat.size, "count": stat.count}
+            for stat in snapshot.statistics(group_by)[:limit]
+        ],
+        "diff": None
+    }
+    previous = _memory_baseline["snapshot"]
+    if previous is not None:
+        result["diff"] = [
+            {"location": str(stat.traceback), "size_diff_bytes": stat.size_diff, "count_diff": stat.count_diff, "size_bytes": stat.size}
+            for stat in snapshot.compare_to(previous, group_by)[:limit]
+        ]
+    _memory_baseline["snapshot"] = snapshot
+    return result
+
+@router.get("/api/debug/loop_blocks")
+async def loop_blocks(request: Request):
+    """最近的事件循环阻塞事件（异步接口中的同步调用）"""
+    require_admin(request)
+    return {
+        "threshold_ms": LOOP_BLOCK_THRESHOLD * 1000,
+        "incidents": list(reversed(LOOP_BLOCK_INCIDENTS))
+    }
+
+# 记录请求体的请求所占比例（0~1），0 表示不记录请求体
+LOG_BODY_SAMPLE_RATE = float(os.environ.get("YUANBAO_LOG_BODY_SAMPLE_RATE", "1"))
+# 每个请求最多记录的请求体字节数，超出部分只记录总长度
+LOG_BODY_MAX_BYTES = int(os.environ.get("YUANBAO_LOG_BODY_MAX_BYTES", "65536"))
+
+class InstrumentationMiddleware:
+    """
+    ASGI 中间件：记录请求信息、响应状态和耗时
+
+    - 耗时包括首字节时间和总耗时，流式响应在最后一个 chunk 发出后才结束计时，并统计 chunk 数和字节数
+    - 请求体只在被采样时记录：接口读取请求体时顺带复制前 LOG_BODY_MAX_BYTES 字节，不缓存、不延迟转发
+    - 响应原样透传，每个 chunk 只多一次计数；INFO 日志关闭时不格式化任何日志
+    """
+    def __init__(self, app, body_sample_rate: Optional[float] = None, body_max_bytes: Optional[int] = None):
+        self.app = app
+        self.body_sample_rate = LOG_BODY_SAMPLE_RATE if body_sample_rate is None else body_sample_rate
+        self.body_max_bytes = LOG_BODY_MAX_BYTES if body_max_bytes is None else body_max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        verbose = logger.isEnabledFor(logging.INFO)
+        if verbose:
+            headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+            client = scope.get("client")
+            # 记录请求信息
+            logger.info("\n=== 收到请求 ===")
+            logger.info(f"请求方法: {scope['method']}")
+            logger.info(f"请求路径: {scope['path']}")
+            logger.info(f"完整URL: {URL(scope=scope)}")
+            logger.info(f"查询参数: {dict(QueryParams(scope['query_string']))}")
+            logger.info(f"请求头: {headers}")
+            logger.info(f"客户端IP: {client[0] if client else '未知'}")
+            logger.info(f"用户代理: {headers.get('user-agent', '未知')}")
+
+        stats = {"status": None, "first_byte": None, "bytes": 0, "chunks": 0, "complete": False}
+        if verbose and self.body_sample_rate > 0 and (self.body_sample_rate >= 1 or random.random() < self.body_sample_rate):
+            receive = self._peek_body(receive)
+
+        async def send_with_stats(message):
+            if message["type"] == "http.response.start":
+                stats["status"] = message["status"]
+                stats["first_byte"] = time.perf_counter() - start
+                if verbose:
+                    logger.info(f"响应状态: {message['status']}")
+                    logger.info(f"响应头: { {name.decode('latin-1'): value.decode('latin-1') for name, value in message.get('headers', [])} }")
+            elif message["type"] == "http.response.body":
+                stats["bytes"] += len(message.get("body", b""))
+                stats["chunks"] += 1
+                stats["complete"] = not message.get("more_body", False)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            if verbose:
+                elapsed = time.perf_counter() - start
+                first_byte = f"{stats['first_byte']:.2f}秒" if stats["first_byte"] is not None else "无"
+                logger.info(f"处理时间: {elapsed:.2f}秒（首字节 {first_byte}，{stats['chunks']} 块 {stats['bytes']} 字节）")
+                if not stats["complete"]:
+                    logger.info("响应未完整发送（客户端断开或处理出错）")
+                logger.info("=== 请求处理完成 ===")
+
+    def _peek_body(self, receive):
+        """包装 receive：请求体原样返回给接口，同时复制开头部分，读完后写入日志"""
+        captured = bytearray()
+        total = 0
+        max_bytes = self.body_max_bytes
+
+        async def receive_and_peek():
+            nonlocal total
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                total += len(chunk)
+                if len(captured) < max_bytes:
+                    captured.extend(chunk[:max_bytes - len(captured)])
+                if not message.get("more_body", False) and total:
+                    suffix = f"...（共 {total} 字节，已截断）" if total > len(captured) else ""
+                    logger.info(f"原始请求体: {captured.decode('utf-8', errors='replace')}{suffix}")
+            return message
+
+        return receive_and_peek
+
+# DeepSeek 分词器文件（HuggingFace tokenizer.json），需要安装 tokenizers；不可用时按字符估算
+TOKENIZER_PATH = os.environ.get("YUANBAO_TOKENIZER_PATH", "deepseek_tokenizer.json")
+# 增量计数时累积多少字符后在空白或中文标点处切分并编码
+TOKEN_COUNTER_FLUSH_CHARS = 256
+# 一直找不到切分点时最多累积的字符数，超过后整段编码（切分处可能多算一个 token）
+TOKEN_COUNTER_MAX_PENDING_CHARS = 4096
+# 增量计数的切分点：在空白之前切开，在中文标点之后切开
+_TOKEN_CUT_SPACES = frozenset(" \n\t")
+_TOKEN_CUT_PUNCTUATION = frozenset("，。！？；：、）】》」』”’…")
+# token 数缓存的条数；按文本的哈希缓存，不保存文本本身
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+_tokenizer_state = {"loaded": False, "tokenizer": None}
+_tokenizer_lock = threading.Lock()
+
+def get_tokenizer():
+    """首次调用时加载分词器并缓存，加载失败时返回 None（之后不再重试）"""
+    if _tokenizer_state["loaded"]:
+        return _tokenizer_state["tokenizer"]
+    with _tokenizer_lock:
+        if _tokenizer_state["loaded"]:
+            return _tokenizer_state["tokenizer"]
+        tokenizer_path = TOKENIZER_PATH
+        if not os.path.isabs(tokenizer_path):
+            tokenizer_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), tokenizer_path)
+        try:
+            from tokenizers import Tokenizer
+            _tokenizer_state["tokenizer"] = Tokenizer.from_file(tokenizer_path)
+            logger.info(f"已加载分词器: {tokenizer_path}")
+        except ImportError:
+            logger.warning("未安装 tokenizers，token 数按字符估算")
+        except Exception as e:
+            logger.warning(f"加载分词器失败，token 数按字符估算: {str(e)}（下载方法见 README 的“可选：精确 token 计数”）")
+        _tokenizer_state["loaded"] = True
+        # 之前按字符估算的结果作废
+        with _token_count_cache_lock:
+            _token_count_cache.clear()
+        return _tokenizer_state["tokenizer"]
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符约 1 token/字，其它字符约 4 字符/token"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return cjk + (len(text) - cjk + 3) // 4
+
+def _count_tokens_uncached(text: str) -> int:
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return estimate_tokens(text)
+    return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+# 文本哈希 -> token 数（LRU），分词器加载后清空
+_token_count_cache = collections.OrderedDict()
+_token_count_cache_lock = threading.Lock()
+
+def count_tokens(text: str) -> int:
+    """
+    计算 token 数；对话历史每次请求都会重发，结果按文本哈希缓存
+    （缓存只保存 16 字节的哈希，长文本不会常驻内存）
+    """
+    if not text:
+        return 0
+    key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    with _token_count_cache_lock:
+        count = _token_count_cache.get(key)
+        if count is not None:
+            _token_count_cache.move_to_end(key)
+            return count
+    count = _count_tokens_uncached(text)
+    with _token_count_cache_lock:
+        _token_count_cache[key] = count
+        while len(_token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+            _token_count_cache.popitem(last=False)
+    return count
+
+def _token_cut(text: str) -> int:
+    """最后一个切分点的位置，没有时返回 0"""
+    for i in range(len(text) - 1, 0, -1):
+        ch = text[i]
+        if ch in _TOKEN_CUT_SPACES:
+            return i
+        if ch in _TOKEN_CUT_PUNCTUATION:
+            return i + 1
+    return 0
+
+class TokenCounter:
+    """
+    流式输出的增量 token 计数
+
+    分词器可用时把累积的文本在最后一个空白或中文标点处切开，只编码前半部分，
+    避免每个 chunk 都重新编码整段输出；否则按字符类别累加估算。
+    找不到切分点时每再累积 TOKEN_COUNTER_FLUSH_CHARS 个字符才重新查找，
+    超过 TOKEN_COUNTER_MAX_PENDING_CHARS 时整段编码，保证总开销与输出长度成线性
+    """
+    def __init__(self):
+        self.tokenizer = get_tokenizer()
+        self.committed = 0
+        self.pending = []
+        self.pending_chars = 0
+        self.flush_at = TOKEN_COUNTER_FLUSH_CHARS
+        self.cjk = 0
+        self.other = 0
+
+    def feed(self, text: str):
+        if not text:
+            return
+        if self.tokenizer is None:
+            cjk = sum(1 for ch in text if ord(ch) >= 0x2E80)
+            self.cjk += cjk
+            self.other += len(text) - cjk
+            return
+        self.pending.append(text)
+        self.pending_chars += len(text)
+        if self.pending_chars < self.flush_at:
+            return
+        pending = ''.join(self.pending)
+        cut = _token_cut(pending)
+        if cut <= 0:
+            if len(pending) < TOKEN_COUNTER_MAX_PENDING_CHARS:
+                self.pending = [pending]
+                self.flush_at = self.pending_chars + TOKEN_COUNTER_FLUSH_CHARS
+                return
+            cut = len(pending)
+        self.committed += len(self.tokenizer.encode(pending[:cut], add_special_tokens=False).ids)
+        self.pending = [pending[cut:]]
+        self.pending_chars = len(pending) - cut
+        self.flush_at = TOKEN_COUNTER_FLUSH_CHARS
+
+    @property
+    def total(self) -> int:
+        if self.tokenizer is None:
+            return self.cjk + (self.other + 3) // 4
+        if not self.pending_chars:
+            return self.committed
+        return self.committed + len(self.tokenizer.encode(''.join(self.pending), add_special_tokens=False).ids)
+
+def usage_block(prompt_tokens: int, completion_tokens: int) -> dict:
+    """OpenAI 格式的 usage 字段"""
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+
+# 提示词预算（按 token 数），超出时压缩对话历史
+PROMPT_BUDGET_TOKENS = int(os.environ.get("YUANBAO_PROMPT_BUDGET_TOKENS", "32000"))
+# 超出预算时至少保留的最近对话轮数（一轮从一条 user 消息开始）
+PROMPT_KEEP_LAST_TURNS = int(os.environ.get("YUANBAO_PROMPT_KEEP_LAST_TURNS", "6"))
+# 单条工具执行结果的 token 上限，超出时保留头尾
+TOOL_RESULT_MAX_TOKENS = int(os.environ.get("YUANBAO_TOOL_RESULT_MAX_TOKENS", "2000"))
+# 是否用摘要替换被丢弃的早期对话（摘要只生成一次并缓存）
+PROMPT_SUMMARY_ENABLED = os.environ.get("YUANBAO_PROMPT_SUMMARY", "0") == "1"
+PROMPT_SUMMARY_CACHE_SIZE = 256
+# 摘要请求以最低优先级排队获取元宝并发名额，超过该时间（秒）仍未放行则放弃摘要，直接丢弃早期对话
+PROMPT_SUMMARY_QUEUE_TIMEOUT = float(os.environ.get("YUANBAO_PROMPT_SUMMARY_QUEUE_TIMEOUT", "10"))
+
+ROLE_PREFIXES = {
+    "system": "System",
+    "user": "User",
+    "assistant": "Assistant",
+    "tool": "Tool执行结果"
+}
+
+_summary_cache = collections.OrderedDict()
+_summary_cache_lock = threading.Lock()
+
+
+def truncate_middle(text: str, max_tokens: int) -> str:
+    """保留头尾、省略中间部分，使 token 数不超过 max_tokens"""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    # 按比例换算成字符数，头尾各保留一半
+    keep_chars = max(int(len(text) * max_tokens / tokens), 2)
+    head = text[:keep_chars // 2]
+    tail = text[len(text) - keep_chars // 2:]
+    omitted = len(text) - len(head) - len(tail)
+    return f"{head}\n...[已省略 {omitted} 个字符]...\n{tail}"
+
+def _split_turns(entries: List[tuple]) -> List[List[tuple]]:
+    """把非 system 消息按轮切分，每轮从一条 user 消息开始"""
+    turns = []
+    for entry in entries:
+        if entry[0] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(entry)
+    return turns
+
+def _entries_tokens(entries: List[tuple]) -> int:
+    return sum(count_tokens(text) for _, text in entries)
+
+@contextmanager
+def summary_slot():
+    """
+    在线程池中为摘要请求获取元宝并发名额（最低优先级），退出时归还
+
+    调度器属于事件循环，通过 anyio 回到事件循环排队；不在 anyio 工作线程中（没有事件循环，如脚本直接调用）时不排队
+    """
+    priority = PRIORITY_CLASSES[-1]
+
+    async def acquire():
+        await asyncio.wait_for(UPSTREAM_SCHEDULER.acquire("summary", 1.0, priority), PROMPT_SUMMARY_QUEUE_TIMEOUT)
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        # 在事件循环线程中同步请求上游会阻塞所有请求
+        raise RuntimeError("摘要请求必须在线程池中执行")
+    try:
+        anyio.from_thread.run(acquire)
+        scheduled = True
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"等待元宝并发名额超过 {PROMPT_SUMMARY_QUEUE_TIMEOUT} 秒")
+    except RuntimeError:
+        scheduled = False
+    try:
+        yield
+    finally:
+        if scheduled:
+            anyio.from_thread.run_sync(UPSTREAM_SCHEDULER.release, priority)
+
+def summarize_entries(entries: List[tuple], model: str) -> Optional[str]:
+    """为早期对话生成摘要，相同内容只生成一次"""
+    transcript = "\n".join(f"{ROLE_PREFIXES.get(role, role)}: {text}" for role, text in entries)
+    key = hashlib.sha256(f"{model}\n{transcript}".encode("utf-8")).hexdigest()
+    with _summary_cache_lock:
+        if key in _summary_cache:
+            _summary_cache.move_to_end(key)
+            return _summary_cache[key]
+
+    prompt = f"请用简洁的中文总结以下对话的要点，保留关键事实、结论和未完成的任务，不要添加其它内容：\n\n{truncate_middle(transcript, PROMPT_BUDGET_TOKENS // 2)}"
+    try:
+        with summary_slot():
+            # 使用独立的上游对话，不占用也不污染该模型共用的对话，用完即退役
+            conversation_id = take_prewarmed_conversation(model) or create_conversation(model, activate=False)
+            try:
+                summary = send_yuanbao_request(prompt, model=model, conversation_id=conversation_id)
+            finally:
+                retire_conversation(model, conversation_id, "摘要完成")
+    except Exception as e:
+        logger.error(f"生成对话摘要失败: {str(e)}")
+        return None
+    # 去掉思考过程，只保留正文
+    summary = re.sub(r"<think>.*?</think>\s*", "", summary, flags=re.DOTALL).strip()
+
+    with _summary_cache_lock:
+        _summary_cache[key] = summary
+        while len(_summary_cache) > PROMPT_SUMMARY_CACHE_SIZE:
+            _summary_cache.popitem(last=False)
+    return summary
+
+def apply_prompt_budget(entries: List[tuple], model: str) -> List[tuple]:
+    """
+    按提示词预算压缩对话历史
+
+    1. 截断过长的工具执行结果（保留头尾）
+    2. 仍超出预算时保留 system 消息和最近 PROMPT_KEEP_LAST_TURNS 轮，
+       更早的对话丢弃或替换为缓存的摘要
+    3. 仍超出预算时继续丢弃最早的轮次（不再摘要），至少保留最后一轮
+
+    Args:
+        entries: [(role, text)] 列表
+        model: 生成摘要使用的模型
+    """
+    entries = [
+        (role, truncate_middle(text, TOOL_RESULT_MAX_TOKENS) if role == "tool" else text)
+        for role, text in entries
+    ]
+    total = _entries_tokens(entries)
+    if total <= PROMPT_BUDGET_TOKENS:
+        return entries
+
+    system_entries = [entry for entry in entries if entry[0] == "system"]
+    turns = _split_turns([entry for entry in entries if entry[0] != "system"])
+    kept_turns = turns[-PROMPT_KEEP_LAST_TURNS:] if PROMPT_KEEP_LAST_TURNS > 0 else turns[-1:]
+    dropped_turns = turns[:len(turns) - len(kept_turns)]
+
+    summary_entries = []
+    if dropped_turns and PROMPT_SUMMARY_ENABLED:
+        # 从头按固定轮数分块摘要，历史增长时前面的分块不变，摘要可以直接复用缓存
+        block = max(PROMPT_KEEP_LAST_TURNS, 1)
+        complete = len(dropped_turns) // block * block
+        kept_turns = dropped_turns[complete:] + kept_turns
+        for i in range(0, complete, block):
+            summary = summarize_entries([entry for turn in dropped_turns[i:i + block] for entry in turn], model)
+            if summary:
+                summary_entries.append(("system", f"[之前对话摘要]\n{summary}"))
+        dropped_turns = dropped_turns[:complete]
+
+    budget = PROMPT_BUDGET_TOKENS - _entries_tokens(system_entries) - _entries_tokens(summary_entries)
+    while len(kept_turns) > 1 and sum(_entries_tokens(turn) for turn in kept_turns) > budget:
+        dropped_turns.append(kept_turns.pop(0))
+
+    result = system_entries + summary_entries + [entry for turn in kept_turns for entry in turn]
+    logger.info(f"提示词超出预算（{total} > {PROMPT_BUDGET_TOKENS} tokens），丢弃 {len(dropped_turns)} 轮，压缩后约 {_entries_tokens(result)} tokens")
+    return result
+
+def build_chat_prompt(messages: List[Message], model: str) -> tuple:
+    """
+    把 OpenAI 格式的消息列表拼成发给元宝的提示词，返回 (提示词, 是否已有工具执行结果)
+
+    消息只遍历一次；各段文本最后一次性拼接，不产生每条消息的中间字符串
+    """
+    # 构建完整的对话历史
+    entries = []
+    has_tool_result_in_history = False
+    
+    for msg in messages:
+        role = msg.role
+        if role not in ROLE_PREFIXES:
+            continue
+        content = msg.content
+        
+        # 处理不同类型的content
+        if type(content) is str:
+            content_text = content
+        elif isinstance(content, list):
+            # 处理multimodal内容（数组），只保留文本部分
+            content_text = ' '.join([item.get('text', '') for item in content if isinstance(item, dict) and item.get('type') == 'text'])
+        else:
+            # 其他类型转换为字符串
+            content_text = str(content)
+        
+        if content_text:
+            entries.append((role, content_text))
+            if role == 'tool':
+                # tool 角色的消息是工具执行结果
+                has_tool_result_in_history = True
+    
+    # 按提示词预算压缩过长的历史
+    entries = apply_prompt_budget(entries, model)
+    
+    # 确保有用户消息（与原来一样，正文中含 "User:" 的消息也算）
+    if not any(role == 'user' for role, _ in entries) and not any('User:' in text for _, text in entries):
+        raise HTTPException(status_code=400, detail="No user message found")
+    
+    parts = []
+    for role, text in entries:
+        parts += (ROLE_PREFIXES[role], ": ", text, "\n")
+    if has_tool_result_in_history:
+        # 如果已经有 tool 执行结果，告诉 AI 这是执行结果，应该返回普通文本总结（防止死循环）
+        parts.append("\n[System指令: 上面是工具执行的结果。请根据执行结果给用户一个友好的总结回复，不要再次执行相同的命令。]")
+    else:
+        parts.pop()
+    
+    # 构建完整提示
+    return ''.join(parts), has_tool_result_in_history
+
+# 近似重复提示词缓存（默认关闭）：提示词只差空白、时间戳或个别措辞时直接返回之前的回复
+PROMPT_CACHE_ENABLED = os.environ.get("YUANBAO_PROMPT_CACHE", "0") == "1"
+# 判定为近似重复的最低相似度（按字符 shingle 估算的 Jaccard 相似度，1 表示只接受规范化后完全相同的提示词）
+PROMPT_CACHE_THRESHOLD = float(os.environ.get("YUANBAO_PROMPT_CACHE_THRESHOLD", "0.9"))
+PROMPT_CACHE_MAX_ENTRIES = int(os.environ.get("YUANBAO_PROMPT_CACHE_MAX_ENTRIES", "10000"))
+# 缓存占用内存上限（估算值）
+PROMPT_CACHE_MAX_BYTES = int(os.environ.get("YUANBAO_PROMPT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# MinHash 签名分成 bands 段、每段 rows 个值做 LSH 分桶，只要有一段完全相同即成为候选
+PROMPT_CACHE_BANDS = int(os.environ.get("YUANBAO_PROMPT_CACHE_BANDS", "8"))
+PROMPT_CACHE_ROWS = int(os.environ.get("YUANBAO_PROMPT_CACHE_ROWS", "4"))
+PROMPT_CACHE_SHINGLE = 4
+
+# 规范化时替换为占位符的时间戳：日期、时刻、10/13 位 Unix 时间戳
+_PROMPT_TIMESTAMP_RE = re.compile(
+    r"\d{4}[-/年.]\d{1,2}[-/月.]\d{1,2}日?|\d{1,2}:\d{2}(?::\d{2})?(?:\.\d+)?|\b1\d{9}(?:\d{3})?\b"
+)
+_PROMPT_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """规范化提示词：统一全半角和大小写，时间戳替换为占位符，合并空白"""
+    text = unicodedata.normalize("NFKC", prompt).lower()
+    text = _PROMPT_TIMESTAMP_RE.sub("<t>", text)
+    return _PROMPT_SPACE_RE.sub(" ", text).strip()
+
+
+class PromptCache:
+    """
+    近似重复提示词缓存
+
+    规范化后的提示词按字符 shingle 计算 MinHash 签名（单次哈希分桶），签名分段做 LSH：
+    查询时只比较至少有一段签名完全相同的条目，与缓存大小基本无关。
+    候选的估算相似度低于阈值时记为误报（LSH 假阳性）。按作用域（租户、模型）隔离，
+    超出条目数或内存上限时按 LRU 淘汰。
+    """
+
+    # 每个条目除回复文本外的固定开销估算（签名、索引、字典槽位）
+    ENTRY_OVERHEAD = 512
+
+    def __init__(self, threshold: float = 0.9, max_entries: int = 10000, max_bytes: int = 256 * 1024 * 1024,
+                 bands: int = 8, rows: int = 4, shingle: int = 4):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bands = bands
+        self.rows = rows
+        self.shingle = shingle
+        self.slots = bands * rows
+        self._lock = threading.Lock()
+        # 条目ID -> (作用域, 规范化提示词摘要, 签名, 回复, 估算字节数)，按最近使用排序
+        self._entries = collections.OrderedDict()
+        # (作用域, 摘要) -> 条目ID
+        self._exact = {}
+        # LSH 分段哈希 -> 条目ID；绝大多数分段只属于一个条目，有多个时才用列表以节省内存
+        self._buckets = {}
+        self._next_id = 0
+        self.nbytes = 0
+        self._stats = collections.Counter()
+
+    def signature(self, prompt: str) -> tuple:
+        """返回 (规范化提示词摘要, MinHash 签名)"""
+        text = normalize_prompt(prompt)
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        slots = self.slots
+        mins = [None] * slots
+        size = self.shingle
+        shingles = {text[i:i + size] for i in range(max(len(text) - size + 1, 1))}
+        for shingle in shingles:
+            value = hash(shingle) & 0xFFFFFFFFFFFFFFFF
+            slot = value % slots
+            value >>= 32
+            current = mins[slot]
+            if current is None or value < current:
+                mins[slot] = value
+        # 空槽位从右侧最近的非空槽位借值（加上距离偏移），保证短文本的签名仍可比较
+        filled = [i for i, value in enumerate(mins) if value is not None]
+        for i in range(slots):
+            if mins[i] is None:
+                distance, source = min(((j - i) % slots, j) for j in filled)
+                mins[i] = (mins[source] + distance * 0x9E3779B1) & 0xFFFFFFFF
+        return digest, array.array("I", mins).tobytes()
+
+    def _band_keys(self, scope, signature: bytes) -> List[int]:
+        width = self.rows * 4
+        return [hash((scope, band, signature[band * width:(band + 1) * width])) for band in range(self.bands)]
+
+    def similarity(self, a: bytes, b: bytes) -> float:
+        """两个签名相同槽位所占比例，即 Jaccard 相似度的估计"""
+        return sum(x == y for x, y in zip(memoryview(a).cast("I"), memoryview(b).cast("I"))) / self.slots
+
+    def lookup(self, scope, digest: bytes, signature: bytes) -> Optional[str]:
+        with self._lock:
+            self._stats["lookups"] += 1
+            entry_id = self._exact.get((scope, digest))
+            if entry_id is not None:
+                self._stats["exact_hits"] += 1
+                self._entries.move_to_end(entry_id)
+                return self._entries[entry_id][3]
+            best_id, best_similarity = None, self.threshold
+            seen = set()
+            for key in self._band_keys(scope, signature):
+                bucket = self._buckets.get(key, ())
+                for candidate in (bucket,) if isinstance(bucket, int) else bucket:
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+                    entry = self._entries[candidate]
+                    if entry[0] != scope:
+                        continue
+                    self._stats["candidates"] += 1
+                    similarity = self.similarity(signature, entry[2])
+                    if similarity < self.threshold:
+                        self._stats["false_positives"] += 1
+                    elif similarity >= best_similarity:
+                        best_id, best_similarity = candidate, similarity
+            if best_id is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["near_hits"] += 1
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][3]
+
+    def insert(self, scope, digest: bytes, signature: bytes, response: str):
+        size = sys.getsizeof(response) + len(signature) + self.ENTRY_OVERHEAD + self.bands * 80
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old_id = self._exact.get((scope, digest))
+            if old_id is not None:
+                self._remove(old_id)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (scope, digest, signature, response, size)
+            self._exact[(scope, digest)] = entry_id
+            for key in self._band_keys(scope, signature):
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    self._buckets[key] = entry_id
+                elif isinstance(bucket, int):
+                    self._buckets[key] = [bucket, entry_id]
+                else:
+                    bucket.append(entry_id)
+            self.nbytes += size
+            while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def _remove(self, entry_id: int):
+        scope, digest, signature, _, size = self._entries.pop(entry_id)
+        self._exact.pop((scope, digest), None)
+        for key in self._band_keys(scope, signature):
+            bucket = self._buckets.get(key)
+            if bucket == entry_id:
+                del self._buckets[key]
+            elif isinstance(bucket, list):
+                bucket.remove(entry_id)
+                if len(bucket) == 1:
+                    self._buckets[key] = bucket[0]
+        self.nbytes -= size
+
+    def get(self, scope, prompt: str) -> Optional[str]:
+        return self.lookup(scope, *self.signature(prompt))
+
+    def put(self, scope, prompt: str, response: str):
+        self.insert(scope, *self.signature(prompt), response)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._exact.clear()
+            self._buckets.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            entries = len(self._entries)
+        hits = stats.get("exact_hits", 0) + stats.get("near_hits", 0)
+        lookups = stats.get("lookups", 0)
+        candidates = stats.get("candidates", 0)
+        return {
+            "entries": entries,
+            "bytes": self.nbytes,
+            "threshold": self.threshold,
+            "lookups": lookups,
+            "hits": hits,
+            "exact_hits": stats.get("exact_hits", 0),
+            "near_hits": stats.get("near_hits", 0),
+            "misses": stats.get("misses", 0),
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "candidates": candidates,
+            "false_positives": stats.get("false_positives", 0),
+            "false_positive_rate": round(stats.get("false_positives", 0) / candidates, 4) if candidates else 0.0,
+            "evictions": stats.get("evictions", 0)
+        }
+
+
+PROMPT_CACHE = PromptCache(PROMPT_CACHE_THRESHOLD, PROMPT_CACHE_MAX_ENTRIES, PROMPT_CACHE_MAX_BYTES,
+                           PROMPT_CACHE_BANDS, PROMPT_CACHE_ROWS, PROMPT_CACHE_SHINGLE)
+
+
+def prompt_cache_scope(model: str, tenant: Optional[dict] = None) -> Optional[tuple]:
+    """近似缓存的作用域：按租户和模型隔离，避免把一个租户的回复返回给另一个租户；未启用时返回 None"""
+    if not PROMPT_CACHE_ENABLED:
+        return None
+    tenant = tenant or CURRENT_TENANT.get()
+    return (tenant["name"] if tenant else None, model)
+
+
+def iter_cached_completion(response_text: str, detect_tool_calls: bool, counter: Optional[TokenCounter] = None) -> Generator[tuple, None, None]:
+    """把缓存的完整回复按 iter_chat_completion 的事件格式输出"""
+    if counter:
+        counter.feed(response_text)
+    tool_calls = parse_tool_calls(response_text, not detect_tool_calls)
+    if tool_calls:
+        yield "tool_calls", tool_calls, response_text
+        yield "finish", "tool_calls"
+        return
+    yield "delta", response_text
+    yield "finish", "stop"
+
+
+def iter_chat_completion(prompt: str, model: str, detect_tool_calls: bool, counter: Optional[TokenCounter] = None, cache_scope: Optional[tuple] = None, media: Optional[List[dict]] = None) -> Generator[tuple, None, None]:
+    """
+    流式对话的公共部分（SSE 和 WebSocket 共用），依次产出：
+
+    - ("delta", 内容)：正文增量
+    - ("tool_calls", tool call 列表, 完整回复)：检测到 tool call 时代替所有正文增量
+    - ("finish", finish_reason)
+
+    需要检测 tool call 时要等回复结束才能确定，期间只缓存原始文本（StreamBuffer）；
+    超出缓存上限后放弃检测，发出已缓存的内容并改为直接透传。counter 不为空时对全部输出计数。
+    cache_scope 不为空时先查近似重复提示词缓存，正常结束的回复写入缓存；media 为随提示词发送的图片/文件
+    """
+    if cache_scope is not None:
+        signature = PROMPT_CACHE.signature(prompt)
+        cached = PROMPT_CACHE.lookup(cache_scope, *signature)
+        if cached is not None:
+            logger.info(f"命中提示词缓存: {cache_scope}")
+            yield from iter_cached_completion(cached, detect_tool_calls, counter)
+            return
+        parts = []
+        for event in iter_chat_completion(prompt, model, detect_tool_calls, counter, media=media):
+            if event[0] == "delta":
+                parts.append(event[1])
+            elif event[0] == "tool_calls":
+                parts = [event[2]]
+            yield event
+        if parts:
+            PROMPT_CACHE.insert(cache_scope, *signature, "".join(parts))
+        return
+
+    # 边接收边扫描 tool call，结束时无需再整体解析一遍
+    scanner = ToolCallScanner() if detect_tool_calls else None
+    # 不检测 tool call 时无需缓存，直接透传
+    buffer = StreamBuffer(STREAM_BUFFER_MAX_BYTES) if scanner else None
+    
+    events = send_yuanbao_request(prompt, stream=True, model=model, events=True, media=media)
+    for content in iter_stream_deltas(events):
+        if counter:
+            counter.feed(content)
+        if buffer is None:
+            yield "delta", content
+            continue
+        scanner.feed(content)
+        if not buffer.append(content):
+            logger.warning(f"流式响应超过缓存上限 {STREAM_BUFFER_MAX_BYTES} 字节，不再检测 tool call")
+            for cached in buffer.deltas():
+                yield "delta", cached
+            yield "delta", content
+            buffer = scanner = None
+    
+    # 检查是否是 tool call
+    tool_calls = []
+    if scanner:
+        scanner.finish()
+        tool_calls = [_normalize_tool_call(data) for data in scanner.tool_calls]
+    
+    if tool_calls:
+        logger.info(f"流式响应检测到 {len(tool_calls)} 个 tool call: {tool_calls}")
+        full_response_text = buffer.getvalue()
+        buffer.clear()
+        yield "tool_calls", tool_calls, full_response_text
+        yield "finish", "tool_calls"
+        return
+    
+    if buffer is not None:
+        # 普通文本响应，按原来的增量逐个输出缓存的内容
+        logger.info(f"普通流式响应，输出 {len(buffer)} 个缓存增量（{buffer.nbytes} 字节）")
+        for cached in buffer.deltas():
+            yield "delta", cached
+        buffer.clear()
+    yield "finish", "stop"
+
+_JSON_ERROR_POSITION_RE = re.compile(r"line (\d+) column (\d+)")
+
+def decode_chat_request(body: bytes) -> ChatCompletionRequest:
+    """
+    解析 /v1/chat/completions 的请求体
+
+    由 pydantic 按模型结构直接从字节解析并校验（一遍完成，不先生成中间的 dict）；
+    校验错误的格式与 FastAPI 自动解析时相同（422）
+    """
+    if not body:
+        raise RequestValidationError([{"type": "missing", "loc": ("body",), "msg": "Field required", "input": None}])
+    try:
+        return ChatCompletionRequest.model_validate_json(body)
+    except ValidationError as e:
+        errors = []
+        for error in e.errors(include_url=False):
+            if error["type"] == "json_invalid":
+                # 与 FastAPI 相同：loc 为出错位置的偏移量
+                detail = error.get("ctx", {}).get("error", "")
+                match = _JSON_ERROR_POSITION_RE.search(detail)
+                position = 0
+                if match:
+                    line, column = int(match.group(1)), int(match.group(2))
+                    position = sum(len(item) + 1 for item in body.split(b"\n", line - 1)[:line - 1]) + (column if detail.startswith("EOF") else max(column - 1, 0))
+                errors.append({"type": "json_invalid", "loc": ("body", position), "msg": "JSON decode error",
+                               "input": {}, "ctx": {"error": detail}})
+            elif error["type"] == "model_type" and not error["loc"]:
+                # 请求体不是 JSON 对象
+                errors.append({"type": "model_attributes_type", "loc": ("body",), "input": error["input"],
+                               "msg": "Input should be a valid dictionary or object to extract fields from"})
+            else:
+                errors.append(dict(error, loc=("body", *error["loc"])))
+        raise RequestValidationError(errors)
+
+# 接口自行读取请求体，文档中的请求体格式需要单独声明（Message 已由其它接口注册到 components）
+_CHAT_REQUEST_SCHEMA = ChatCompletionRequest.model_json_schema(ref_template="#/components/schemas/{model}")
+_CHAT_REQUEST_SCHEMA.pop("$defs", None)
+
+@router.post("/v1/chat/completions", openapi_extra={"requestBody": {
+    "required": True,
+    "content": {"application/json": {"schema": _CHAT_REQUEST_SCHEMA}}
+}})
+async def openai_chat_completion_endpoint(http_request: Request):
+    """OpenAI 兼容的对话接口，请求体经 decode_chat_request 解析"""
+    return await openai_chat_completion(decode_chat_request(await http_request.body()))
+
+async def openai_chat_completion(request: ChatCompletionRequest):
+    try:
+        logger.info("\n=== 收到OpenAI兼容请求 ===")
+        # 请求体可能有 MB 级，INFO 只记录摘要，完整内容在 DEBUG 级别输出
+        logger.info(f"请求摘要: model={request.model}，stream={request.stream}，消息 {len(request.messages)} 条")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"完整请求内容: {request.model_dump_json(indent=2)}")
+        
+        # 压缩历史时可能同步请求上游生成摘要，放到线程池中执行
+        user_message, has_tool_result_in_history = await run_in_threadpool(build_chat_prompt, request.messages, request.model)
+        # 解码、计算哈希（以及下载图片链接）在线程池中进行，避免阻塞事件循环；纯文本消息无需提取
+        media = await run_in_threadpool(extract_media, request.messages) if has_content_parts(request.messages) else []
+        cache_scope = prompt_cache_scope(request.model)
+        if cache_scope and media:
+            # 提示词相同但图片/文件不同时不能共用缓存
+            cache_scope += (tuple(part["digest"] for part in media),)
+
+        # 如果是流式请求
+        if request.stream:
+            # 同步生成器由 StreamingResponse 在线程池中迭代，不会阻塞事件循环
+            def stream_with_tool_call():
+                chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+                # stream_options.include_usage：结束前额外发送一个带 usage 的 chunk
+                include_usage = bool((request.stream_options or {}).get("include_usage"))
+                completion_counter = TokenCounter() if include_usage else None
+                first = True
+                
+                # 有 tool 执行结果时不检测 tool call，防止死循环
+                for event in iter_chat_completion(user_message, request.model, not has_tool_result_in_history, completion_counter, cache_scope, media):
+                    if event[0] == "delta":
+                        delta = {"role": "assistant", "content": event[1]} if first else {"content": event[1]}
+                        first = False
+                        yield format_stream_chunk(chunk_id, request.model, delta)
+                    elif event[0] == "tool_calls":
+                        # 是 tool call，返回单个包含 tool_calls 的 chunk
+                        yield format_stream_chunk(chunk_id, request.model, {
+                            "role": "assistant",
+                            "tool_calls": build_tool_calls(event[1], event[2], stream=True)
+                        })
+                    else:
+                        yield format_stream_end(chunk_id, request.model, event[1])
+                        if include_usage:
+                            yield format_stream_chunk(chunk_id, request.model, {}, None, choices=[],
+                                                      usage=usage_block(count_tokens(user_message), completion_counter.total))
+                        yield "data: [DONE]\n\n"
+            
+            return StreamingResponse(
+                stream_with_tool_call(),
+                media_type="text/event-stream"
+            )
+        
+        # 非流式请求
+        cached = PROMPT_CACHE.get(cache_scope, user_message) if cache_scope else None
+        if cached is not None:
+            logger.info(f"命中提示词缓存: {cache_scope}")
+            response_text = cached
+        else:
+            try:
+                response_text = send_yuanbao_request(user_message, model=request.model, media=media)
+                if cache_scope and response_text:
+                    PROMPT_CACHE.put(cache_scope, user_message, response_text)
+            except Exception as e:
+                # 将错误信息作为正常响应返回
+                response_text = str(e)
+        
+        # 检查是否是 tool call（传入 has_tool_result_in_history 防止死循环）
+        tool_calls = parse_tool_calls(response_text, has_tool_result_in_history)
+        
+        if tool_calls:
+            # 是 tool call，构造 tool_calls 格式的响应
+            logger.info(f"检测到 {len(tool_calls)} 个 tool call: {tool_calls}")
+            
+            response_data = {
+                "id": f"chatcmpl-{str(hash(response_text))}",
+                "object": "chat.completion",
+                "created": int(time.time()),
                 "model": request.model,
                 "choices": [
                     {
@@ -1064,25 +4403,12 @@ async def openai_chat_completion(request: ChatCompletionRequest):
                         "message": {
                             "role": "assistant",
                             "content": None,
-                            "tool_calls": [
-                                {
-                                    "id": tool_call_id,
-                                    "type": "function",
-                                    "function": {
-                                        "name": tool_call_data.get('tool', 'exec'),
-                                        "arguments": json.dumps(function_args, ensure_ascii=False)
-                                    }
-                                }
-                            ]
+                            "tool_calls": build_tool_calls(tool_calls, response_text)
                         },
                         "finish_reason": "tool_calls"
                     }
                 ],
-                "usage": {
-                    "prompt_tokens": len(user_message),
-                    "completion_tokens": len(response_text),
-                    "total_tokens": len(user_message) + len(response_text)
-                }
+                "usage": usage_block(count_tokens(user_message), count_tokens(response_text))
             }
         else:
             # 普通文本响应
@@ -1101,15 +4427,14 @@ async def openai_chat_completion(request: ChatCompletionRequest):
                         "finish_reason": "stop"
                     }
                 ],
-                "usage": {
-                    "prompt_tokens": len(user_message),
-                    "completion_tokens": len(response_text),
-                    "total_tokens": len(user_message) + len(response_text)
-                }
+                "usage": usage_block(count_tokens(user_message), count_tokens(response_text))
             }
 
         return JSONResponse(content=response_data)
 
+    except HTTPException:
+        # 请求本身有误（如图片过大），按 HTTP 状态码返回
+        raise
     except Exception as e:
         logger.error(f"处理请求时发生错误: {str(e)}")
         logger.error(f"错误类型: {type(e)}")
@@ -1131,93 +4456,976 @@ async def openai_chat_completion(request: ChatCompletionRequest):
                     "finish_reason": "stop"
                 }
             ],
-            "usage": {
-                "prompt_tokens": len(user_message) if user_message else 0,
-                "completion_tokens": len(str(e)),
-                "total_tokens": (len(user_message) if user_message else 0) + len(str(e))
-            }
+            "usage": usage_block(count_tokens(user_message if isinstance(user_message, str) else ""), count_tokens(str(e)))
         }
         return JSONResponse(content=response_data)
 
-@app.post("/v1/responses")
-async def openai_responses(request: ChatCompletionRequest):
+# 单个 WebSocket 连接上同时进行的对话请求数上限
+WS_MAX_CONCURRENT_REQUESTS = int(os.environ.get("YUANBAO_WS_MAX_CONCURRENT", "8"))
+
+@router.websocket("/v1/ws")
+async def websocket_chat(websocket: WebSocket):
+    """
+    长连接对话接口：一个连接上可以同时进行多个对话，按请求 ID 区分，帧均为 JSON 文本
+
+    客户端 -> 服务端：
+        {"type": "chat", "id": "r1", "model": "deepseek_r1", "messages": [...], "priority": "interactive"}
+        {"type": "cancel", "id": "r1"}
+        {"type": "ping"}
+    服务端 -> 客户端：
+        {"id": "r1", "d": "正文增量"}
+        {"id": "r1", "tool_calls": [...]}
+        {"id": "r1", "done": "stop|tool_calls|cancelled", "usage": {...}, "trace_id": "..."}
+        {"id": "r1", "error": "错误信息", "code": 429}
+        {"type": "pong"}
+    """
+    tenant = identify_tenant({key.lower(): value for key, value in websocket.headers.items()})
+    if tenant is None:
+        await websocket.close(code=1008, reason="Invalid API key")
+        return
+    await websocket.accept()
+    logger.info(f"WebSocket 连接建立: {tenant['name']}")
+    send_lock = asyncio.Lock()
+    tasks = {}
+
+    async def send_frame(frame: dict):
+        async with send_lock:
+            await websocket.send_text(json.dumps(frame, ensure_ascii=False, separators=(',', ':')))
+
+    async def run_chat(request_id: str, frame: dict, size: int):
+        trace = RequestTrace("WS", "/v1/ws")
+        CURRENT_TRACE.set(trace)
+        with _server_state_lock:
+            SERVER_STATE["in_flight"] += 1
+        generator = None
+        # 取消时线程池中可能仍在等待上游的下一行，关闭生成器必须等这一步结束
+        step_lock = threading.Lock()
+
+        def step():
+            with step_lock:
+                return next(generator, None)
+
+        def close():
+            with step_lock:
+                generator.close()
+
+        try:
+            request = ChatCompletionRequest(**{key: value for key, value in frame.items() if key not in ("type", "id", "priority")})
+            prompt, has_tool_result = await run_in_threadpool(build_chat_prompt, request.messages, request.model)
+            async with admitted(tenant, size // 3, frame.get("priority", "")):
+                counter = TokenCounter()
+                # 与 /v1/chat/completions 的流式请求共用同一套流程（对话租用、tool call 检测、缓存上限）
+                media = await run_in_threadpool(extract_media, request.messages) if has_content_parts(request.messages) else []
+                scope = prompt_cache_scope(request.model, tenant)
+                if scope and media:
+                    scope += (tuple(part["digest"] for part in media),)
+                generator = iter_chat_completion(prompt, request.model, not has_tool_result, counter, scope, media)
+                while True:
+                    event = await run_in_threadpool(step)
+                    if event is None:
+                        break
+                    if event[0] == "delta":
+                        await send_frame({"id": request_id, "d": event[1]})
+                    elif event[0] == "tool_calls":
+                        await send_frame({"id": request_id, "tool_calls": build_tool_calls(event[1], event[2], stream=True)})
+                    else:
+                        trace.status_code = 200
+                        await send_frame({"id": request_id, "done": event[1], "trace_id": trace.request_id,
+                                          "usage": usage_block(count_tokens(prompt), counter.total)})
+        except asyncio.CancelledError:
+            trace.status_code = 499
+            try:
+                await send_frame({"id": request_id, "done": "cancelled", "trace_id": trace.request_id})
+            except Exception:
+                pass
+        except (ValidationError, HTTPException, AdmissionRejected) as e:
+            trace.status_code = 429 if isinstance(e, AdmissionRejected) else getattr(e, "status_code", 400)
+            message = e.detail if isinstance(e, HTTPException) else str(e)
+            await send_frame({"id": request_id, "error": message, "code": trace.status_code})
+        except Exception as e:
+            trace.status_code = 500
+            logger.error(f"WebSocket 对话请求失败: {str(e)}")
+            try:
+                await send_frame({"id": request_id, "error": str(e), "code": 500})
+            except Exception:
+                pass
+        finally:
+            try:
+                if generator is not None:
+                    # 关闭生成器会结束本轮对话并断开上游连接
+                    await asyncio.shield(run_in_threadpool(close))
+            finally:
+                with _server_state_lock:
+                    SERVER_STATE["in_flight"] -= 1
+                finish_trace(trace)
+
     try:
-        logger.info("\n=== 收到OpenAI兼容responses请求 ===")
-        logger.info(f"完整请求内容: {request.model_dump_json(indent=2)}")
-        
-        # 获取用户消息
-        user_message = request.messages[-1].content if request.messages else None
-        if not user_message:
-            raise HTTPException(status_code=400, detail="No user message found")
+        while True:
+            message = await websocket.receive_text()
+            try:
+                frame = json.loads(message)
+                if not isinstance(frame, dict):
+                    raise ValueError("frame must be a JSON object")
+            except ValueError as e:
+                await send_frame({"error": f"Invalid frame: {str(e)}", "code": 400})
+                continue
+            frame_type = frame.get("type", "chat")
+            request_id = str(frame.get("id", ""))
+            if frame_type == "ping":
+                await send_frame({"type": "pong"})
+            elif frame_type == "cancel":
+                task = tasks.get(request_id)
+                if task is not None:
+                    task.cancel()
+            elif frame_type == "chat":
+                if not request_id or request_id in tasks:
+                    await send_frame({"id": request_id, "error": "Missing or duplicate request id", "code": 400})
+                elif len(tasks) >= WS_MAX_CONCURRENT_REQUESTS:
+                    await send_frame({"id": request_id, "error": "Too many concurrent requests on this connection", "code": 429})
+                elif SERVER_STATE["reject_new"]:
+                    await send_frame({"id": request_id, "error": "服务正在重启，请稍后重试", "code": 503})
+                else:
+                    task = asyncio.create_task(run_chat(request_id, frame, len(message)))
+                    tasks[request_id] = task
+                    task.add_done_callback(lambda _, request_id=request_id: tasks.pop(request_id, None))
+            else:
+                await send_frame({"id": request_id, "error": f"Unknown frame type: {frame_type}", "code": 400})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # 连接断开时取消该连接上所有进行中的对话
+        for task in list(tasks.values()):
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+        logger.info(f"WebSocket 连接关闭: {tenant['name']}")
 
-        # 如果是流式请求
-        if request.stream:
-            return StreamingResponse(
-                send_yuanbao_request(user_message, stream=True, model=request.model),
-                media_type="text/event-stream"
-            )
-        
-        # 非流式请求
+# /v1/responses 存储：响应ID -> {conversation_id, model, created_at}，按 LRU + TTL 淘汰
+RESPONSES_STORE_SIZE = int(os.environ.get("YUANBAO_RESPONSES_STORE_SIZE", "1000"))
+RESPONSES_STORE_TTL = float(os.environ.get("YUANBAO_RESPONSES_STORE_TTL", "3600"))
+RESPONSES_STORE = collections.OrderedDict()
+_responses_store_lock = threading.Lock()
+
+def _evict_responses_locked(now: float) -> List[tuple]:
+    """淘汰过期或超出容量的响应，返回不再被引用的 (模型, 对话ID)"""
+    evicted = []
+    while RESPONSES_STORE:
+        response_id, entry = next(iter(RESPONSES_STORE.items()))
+        if len(RESPONSES_STORE) <= RESPONSES_STORE_SIZE and now - entry["created_at"] < RESPONSES_STORE_TTL:
+            break
+        RESPONSES_STORE.popitem(last=False)
+        evicted.append((entry["model"], entry["conversation_id"]))
+    in_use = {entry["conversation_id"] for entry in RESPONSES_STORE.values()}
+    return [(model, cid) for model, cid in evicted if cid not in in_use]
+
+def store_response(response_id: str, conversation_id: str, model: str):
+    """保存响应与上游对话的对应关系，后续请求可通过 previous_response_id 续接"""
+    with _responses_store_lock:
+        RESPONSES_STORE[response_id] = {"conversation_id": conversation_id, "model": model, "created_at": time.time()}
+        released = _evict_responses_locked(time.time())
+    for model_name, cid in released:
+        PINNED_CONVERSATIONS.discard(cid)
+        retire_conversation(model_name, cid, "响应存储淘汰")
+
+def release_unstored_conversation(conversation_id: Optional[str], model: str):
+    """请求失败时，若对话未被任何已存储的响应引用，则退役该对话"""
+    if not conversation_id:
+        return
+    with _responses_store_lock:
+        in_use = any(entry["conversation_id"] == conversation_id for entry in RESPONSES_STORE.values())
+    if not in_use:
+        PINNED_CONVERSATIONS.discard(conversation_id)
+        retire_conversation(model, conversation_id, "responses 请求失败")
+
+def get_stored_response(response_id: str) -> Optional[dict]:
+    with _responses_store_lock:
+        entry = RESPONSES_STORE.get(response_id)
+        if entry is None or time.time() - entry["created_at"] >= RESPONSES_STORE_TTL:
+            return None
+        RESPONSES_STORE.move_to_end(response_id)
+        return entry
+
+def _response_content_text(content) -> str:
+    """提取 Responses API 输入项 content 中的文本"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return ' '.join(
+            part.get('text', '') for part in content
+            if isinstance(part, dict) and part.get('type') in ('input_text', 'output_text', 'text')
+        )
+    return str(content) if content is not None else ''
+
+def responses_input_entries(request: ResponsesRequest) -> List[tuple]:
+    """把 instructions/input（或旧的 messages）转换为 [(role, text)]"""
+    entries = []
+    if request.instructions:
+        entries.append(("system", request.instructions))
+    if request.input is None and request.messages:
+        items = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+    elif isinstance(request.input, str):
+        items = [{"role": "user", "content": request.input}]
+    else:
+        items = request.input or []
+
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        item_type = item.get('type', 'message')
+        if item_type == 'message':
+            role = 'system' if item.get('role') == 'developer' else item.get('role', 'user')
+            text = _response_content_text(item.get('content'))
+            if text and role in ROLE_PREFIXES:
+                entries.append((role, text))
+        elif item_type == 'function_call_output':
+            entries.append(("tool", _response_content_text(item.get('output'))))
+        elif item_type == 'function_call':
+            entries.append(("assistant", json.dumps({"tool_calls": [{"name": item.get('name'), "arguments": item.get('arguments')}]}, ensure_ascii=False)))
+    return entries
+
+def build_response_object(response_id: str, request: ResponsesRequest, status: str, reasoning: str = "", text: str = "", prompt: str = "") -> dict:
+    """构造 Responses API 的 response 对象"""
+    output = []
+    if reasoning:
+        output.append({
+            "type": "reasoning",
+            "id": f"rs_{response_id[5:]}",
+            "summary": [],
+            "content": [{"type": "reasoning_text", "text": reasoning}]
+        })
+    if text or status == "completed":
+        output.append({
+            "type": "message",
+            "id": f"msg_{response_id[5:]}",
+            "status": status,
+            "role": "assistant",
+            "content": [{"type": "output_text", "text": text, "annotations": []}]
+        })
+    input_tokens = count_tokens(prompt)
+    output_tokens = count_tokens(reasoning) + count_tokens(text)
+    return {
+        "id": response_id,
+        "object": "response",
+        "created_at": int(time.time()),
+        "status": status,
+        "model": request.model,
+        "output": output,
+        "output_text": text,
+        "previous_response_id": request.previous_response_id,
+        "store": bool(request.store),
+        "usage": {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens
+        } if status == "completed" else None
+    }
+
+def responses_event_stream(response_id: str, request: ResponsesRequest, prompt: str, conversation_id: Optional[str]) -> Generator[str, None, None]:
+    """以 Responses API 事件格式增量输出"""
+    sequence = itertools.count()
+
+    def event(event_type: str, **data) -> str:
+        data = {"type": event_type, "sequence_number": next(sequence), **data}
+        return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    reasoning_parts = []
+    text_parts = []
+    reasoning_id = f"rs_{response_id[5:]}"
+    message_id = f"msg_{response_id[5:]}"
+    # 当前打开的输出项：None / reasoning / message
+    current_item = None
+
+    def close_reasoning():
+        reasoning = ''.join(reasoning_parts)
+        yield event("response.reasoning_text.done", item_id=reasoning_id, output_index=0, content_index=0, text=reasoning)
+        yield event("response.output_item.done", output_index=0, item={
+            "type": "reasoning", "id": reasoning_id, "summary": [],
+            "content": [{"type": "reasoning_text", "text": reasoning}]
+        })
+
+    def open_message(output_index: int):
+        # 没有正文时也要输出完整的 output_item / content_part 事件序列
+        yield event("response.output_item.added", output_index=output_index, item={
+            "type": "message", "id": message_id, "status": "in_progress", "role": "assistant", "content": []
+        })
+        yield event("response.content_part.added", item_id=message_id, output_index=output_index, content_index=0,
+                    part={"type": "output_text", "text": "", "annotations": []})
+
+    yield event("response.created", response=build_response_object(response_id, request, "in_progress"))
+    yield event("response.in_progress", response=build_response_object(response_id, request, "in_progress"))
+    try:
+        for kind, content in send_yuanbao_request(prompt, stream=True, model=request.model, events=True, conversation_id=conversation_id):
+            if kind == 'think':
+                if current_item is None:
+                    current_item = 'reasoning'
+                    yield event("response.output_item.added", output_index=0, item={"type": "reasoning", "id": reasoning_id, "summary": [], "content": []})
+                if current_item == 'reasoning':
+                    reasoning_parts.append(content)
+                    yield event("response.reasoning_text.delta", item_id=reasoning_id, output_index=0, content_index=0, delta=content)
+            elif kind == 'text':
+                if current_item != 'message':
+                    if current_item == 'reasoning':
+                        yield from close_reasoning()
+                    current_item = 'message'
+                    output_index = 1 if reasoning_parts else 0
+                    yield from open_message(output_index)
+                text_parts.append(content)
+                yield event("response.output_text.delta", item_id=message_id, output_index=output_index, content_index=0, delta=content)
+    except Exception as e:
+        logger.error(f"Responses 流式请求失败: {str(e)}")
+        failed = build_response_object(response_id, request, "failed", ''.join(reasoning_parts), ''.join(text_parts), prompt)
+        failed["error"] = {"code": "server_error", "message": str(e)}
+        release_unstored_conversation(conversation_id, request.model)
+        yield event("response.failed", response=failed)
+        return
+
+    if current_item == 'reasoning':
+        yield from close_reasoning()
+    text = ''.join(text_parts)
+    output_index = 1 if reasoning_parts else 0
+    if current_item != 'message':
+        yield from open_message(output_index)
+    yield event("response.output_text.done", item_id=message_id, output_index=output_index, content_index=0, text=text)
+    yield event("response.content_part.done", item_id=message_id, output_index=output_index, content_index=0,
+                part={"type": "output_text", "text": text, "annotations": []})
+    yield event("response.output_item.done", output_index=output_index, item={
+        "type": "message", "id": message_id, "status": "completed", "role": "assistant",
+        "content": [{"type": "output_text", "text": text, "annotations": []}]
+    })
+    if conversation_id and request.store:
+        store_response(response_id, conversation_id, request.model)
+    yield event("response.completed", response=build_response_object(response_id, request, "completed", ''.join(reasoning_parts), text, prompt))
+
+def split_think(response_text: str) -> tuple:
+    """把 <think>...</think> 包裹的思考过程与正文分开"""
+    match = re.match(r"\s*<think>\n?(.*?)\n?</think>\s*", response_text, re.DOTALL)
+    if not match:
+        return "", response_text
+    return match.group(1), response_text[match.end():]
+
+@router.post("/v1/responses")
+async def openai_responses(request: ResponsesRequest):
+    logger.info("\n=== 收到OpenAI兼容responses请求 ===")
+    logger.info(f"完整请求内容: {request.model_dump_json(indent=2)}")
+    response_id = f"resp_{uuid.uuid4().hex}"
+
+    # 续接之前的响应：直接发送到同一个上游对话，无需重发历史
+    conversation_id = None
+    if request.previous_response_id:
+        previous = get_stored_response(request.previous_response_id)
+        if previous is None:
+            return JSONResponse(status_code=404, content={"error": {
+                "message": f"Previous response with id '{request.previous_response_id}' not found.",
+                "type": "invalid_request_error",
+                "param": "previous_response_id"
+            }})
+        conversation_id = previous["conversation_id"]
+
+    entries = responses_input_entries(request)
+    if not any(role in ("user", "tool") for role, _ in entries):
+        return JSONResponse(status_code=400, content={"error": {"message": "No user input found", "type": "invalid_request_error", "param": "input"}})
+    entries = await run_in_threadpool(apply_prompt_budget, entries, request.model)
+    prompt = '\n'.join(f"{ROLE_PREFIXES[role]}: {text}" for role, text in entries)
+
+    # 需要存储的新响应使用独立的上游对话，方便后续续接
+    if conversation_id is None and request.store:
         try:
-            response_text = send_yuanbao_request(user_message, model=request.model)
+            conversation_id = take_prewarmed_conversation(request.model) or create_conversation(request.model, activate=False)
+            PINNED_CONVERSATIONS.add(conversation_id)
         except Exception as e:
-            # 将错误信息作为正常响应返回
-            response_text = str(e)
-        
-        response_data = {
-            "id": f"resp-{str(hash(response_text))}",
-            "object": "response",
-            "created": int(time.time()),
-            "model": request.model,
-            "choices": [
-                {
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": response_text
-                    },
-                    "finish_reason": "stop"
-                }
-            ],
-            "usage": {
-                "prompt_tokens": len(user_message),
-                "completion_tokens": len(response_text),
-                "total_tokens": len(user_message) + len(response_text)
-            }
-        }
+            logger.error(f"创建 responses 对话失败: {str(e)}")
+            return JSONResponse(status_code=502, content={"error": {"message": str(e), "type": "server_error"}})
 
-        return JSONResponse(content=response_data)
+    if request.stream:
+        return StreamingResponse(
+            responses_event_stream(response_id, request, prompt, conversation_id),
+            media_type="text/event-stream"
+        )
 
+    try:
+        response_text = send_yuanbao_request(prompt, model=request.model, conversation_id=conversation_id)
     except Exception as e:
         logger.error(f"处理responses请求时发生错误: {str(e)}")
-        logger.error(f"错误类型: {type(e)}")
-        logger.error(f"错误详情: {str(e)}")
-        # 将错误信息作为正常响应返回
-        user_message = request.messages[-1].content if request.messages else None
-        response_data = {
-            "id": f"resp-{str(hash(str(e)))}",
-            "object": "response",
-            "created": int(time.time()),
-            "model": request.model,
-            "choices": [
-                {
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": str(e)
-                    },
-                    "finish_reason": "stop"
-                }
-            ],
-            "usage": {
-                "prompt_tokens": len(user_message) if user_message else 0,
-                "completion_tokens": len(str(e)),
-                "total_tokens": (len(user_message) if user_message else 0) + len(str(e))
+        failed = build_response_object(response_id, request, "failed", prompt=prompt)
+        failed["error"] = {"code": "server_error", "message": str(e)}
+        release_unstored_conversation(conversation_id, request.model)
+        return JSONResponse(status_code=500, content=failed)
+
+    if conversation_id and request.store:
+        store_response(response_id, conversation_id, request.model)
+    reasoning, text = split_think(response_text)
+    return JSONResponse(content=build_response_object(response_id, request, "completed", reasoning, text, prompt))
+
+def create_app(config: Optional[Dict[str, Any]] = None, log_file: Optional[str] = None) -> FastAPI:
+    """
+    创建 FastAPI 应用
+
+    Args:
+        config: 覆盖模块级配置，键为配置常量名（如 {"UPSTREAM_MAX_CONCURRENCY": 4, "IDEMPOTENCY_DB": ""}），
+            优先于 YUANBAO_* 环境变量；配置和状态是进程级的，同一进程中创建多个应用时以最后一次为准
+        log_file: 日志文件，默认 LOG_FILE，为空字符串时只输出到控制台
+    """
+    global API_KEYS, UPSTREAM_SCHEDULER, IDEMPOTENCY_STORE, UPLOAD_CACHE, PROMPT_CACHE, UPSTREAM_HOST, UPSTREAM_BASE_URL
+    config = config or {}
+    for name, value in config.items():
+        if not name.isupper() or name not in globals():
+            raise ValueError(f"未知的配置项: {name}")
+        globals()[name] = value
+    # 上游域名和地址只配置其中一个时，另一个随之变化（DNS 缓存、预热按域名进行）
+    if "UPSTREAM_BASE_URL" in config and "UPSTREAM_HOST" not in config:
+        UPSTREAM_HOST = urllib.parse.urlparse(UPSTREAM_BASE_URL).hostname or UPSTREAM_HOST
+    elif "UPSTREAM_HOST" in config and "UPSTREAM_BASE_URL" not in config:
+        UPSTREAM_BASE_URL = f"https://{UPSTREAM_HOST}"
+    setup_logging(log_file)
+
+    # 依赖配置的组件按当前配置重新创建；分词器、幂等存储等在第一次使用时才加载
+    reload_sessions("启动")
+    API_KEYS = load_api_keys()
+    UPSTREAM_SCHEDULER = FairScheduler(UPSTREAM_MAX_CONCURRENCY, PRIORITY_MODE, PRIORITY_WEIGHTS, PRIORITY_RESERVED_SLOTS)
+    UPLOAD_CACHE = UploadCache(UPLOAD_CACHE_MAX_ENTRIES, UPLOAD_CACHE_TTL)
+    PROMPT_CACHE = PromptCache(PROMPT_CACHE_THRESHOLD, PROMPT_CACHE_MAX_ENTRIES, PROMPT_CACHE_MAX_BYTES,
+                               PROMPT_CACHE_BANDS, PROMPT_CACHE_ROWS, PROMPT_CACHE_SHINGLE)
+    with _idempotency_store_lock:
+        IDEMPOTENCY_STORE = None
+    UPSTREAM_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_POOL_SIZE))
+    install_dns_cache()
+
+    app = FastAPI(lifespan=lifespan)
+    app.add_exception_handler(RequestValidationError, validation_exception_handler)
+    app.add_middleware(InstrumentationMiddleware)
+    app.add_middleware(AdmissionMiddleware)
+    app.add_middleware(TracingMiddleware)
+    app.add_middleware(IdempotencyMiddleware)
+    app.add_middleware(CompressionMiddleware)
+    app.add_middleware(DrainMiddleware)
+    # 添加CORS中间件：最后添加的在最外层，预检请求不经过鉴权，401/429/503 响应也带 CORS 头
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # 允许所有来源
+        allow_credentials=True,
+        allow_methods=["*"],  # 允许所有方法
+        allow_headers=["*"],  # 允许所有头部
+    )
+    router.register(app)
+    return app
+
+_default_app = None
+_default_app_lock = threading.Lock()
+
+def get_app() -> FastAPI:
+    """按默认配置（环境变量）创建的应用，第一次访问时创建"""
+    global _default_app
+    with _default_app_lock:
+        if _default_app is None:
+            _default_app = create_app()
+        return _default_app
+
+def __getattr__(name: str):
+    # 兼容 "yuanbao_openai_api:app" 和 yuanbao_openai_api.app：访问时才创建应用
+    if name == "app":
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+@functools.lru_cache(maxsize=None)
+def get_draining_server_class():
+    """uvicorn 只在启动服务时才导入"""
+    import uvicorn
+
+    class DrainingServer(uvicorn.Server):
+        """
+        收到 SIGTERM 时先排空再退出的 uvicorn Server
+
+        - 独立运行：继续监听端口，新请求返回 503，/health 返回 draining，等负载均衡器切走流量
+        - 由 supervisor 启动（共享监听 socket）：立即停止 accept，新连接由新进程接管
+        再次收到信号则立即退出。
+        """
+        def __init__(self, config, handoff: bool = False):
+            super().__init__(config)
+            self.handoff = handoff
+            self._loop = None
+
+        async def startup(self, sockets=None):
+            self._loop = asyncio.get_running_loop()
+            await super().startup(sockets=sockets)
+
+        def _close_listeners(self):
+            for server in getattr(self, "servers", []):
+                server.close()
+            logger.info("已停止接受新连接")
+
+        def handle_exit(self, sig, frame):
+            if sig != signal.SIGTERM or SERVER_STATE["draining"]:
+                return super().handle_exit(sig, frame)
+
+            begin_drain(reject_new=not self.handoff)
+            if self.handoff and self._loop is not None:
+                self._loop.call_soon_threadsafe(self._close_listeners)
+
+            def drain_then_exit():
+                wait_for_drain(min_wait=0 if self.handoff else DRAIN_GRACE_PERIOD)
+                super(DrainingServer, self).handle_exit(sig, frame)
+
+            threading.Thread(target=drain_then_exit, name="drain", daemon=True).start()
+
+    return DrainingServer
+
+def notify_supervisor_ready():
+    """通知 supervisor 当前工作进程已就绪，可以接管流量"""
+    ready_fd = os.environ.pop("YUANBAO_READY_FD", None)
+    if not ready_fd:
+        return
+    try:
+        os.write(int(ready_fd), b"1")
+        os.close(int(ready_fd))
+    except OSError as e:
+        logger.error(f"通知 supervisor 失败: {str(e)}")
+
+def run_server(host: str = "0.0.0.0", port: int = 9999, fd: Optional[int] = None, app: Optional[FastAPI] = None):
+    """运行单个服务进程，app 默认为 get_app()"""
+    import uvicorn
+    app = app or get_app()
+    if fd is not None:
+        config = uvicorn.Config(app, fd=fd, timeout_graceful_shutdown=5)
+    else:
+        config = uvicorn.Config(app, host=host, port=port, timeout_graceful_shutdown=5)
+    get_draining_server_class()(config, handoff=fd is not None).run()
+
+def _spawn_worker(sock: socket.socket):
+    """启动一个共享监听 socket 的工作进程，返回 (进程, 就绪管道读端)"""
+    ready_r, ready_w = os.pipe()
+    env = os.environ.copy()
+    env["YUANBAO_READY_FD"] = str(ready_w)
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--fd", str(sock.fileno())],
+        pass_fds=(sock.fileno(), ready_w),
+        env=env
+    )
+    os.close(ready_w)
+    logger.info(f"已启动工作进程 PID: {proc.pid}")
+    return proc, ready_r
+
+def _wait_worker_ready(proc, ready_r: int, timeout: float = 60) -> bool:
+    try:
+        readable, _, _ = select.select([ready_r], [], [], timeout)
+        return bool(readable) and os.read(ready_r, 1) == b"1" and proc.poll() is None
+    finally:
+        os.close(ready_r)
+
+def run_supervisor(host: str = "0.0.0.0", port: int = 9999):
+    """
+    监督模式：由主进程持有监听 socket，工作进程共享该 socket
+
+    - SIGHUP：启动新工作进程，就绪后让旧进程排空退出，端口始终有进程在 accept
+    - SIGTERM/SIGINT：让当前工作进程排空后退出
+    - 工作进程意外退出时自动拉起
+
+    仅支持 POSIX 系统（依赖继承监听 socket 和 SIGHUP）；Windows 上改为直接运行，重启只能用 restart.bat 强制重启
+    """
+    if os.name != "posix":
+        logger.error("监督模式仅支持 POSIX 系统，改为直接运行（不支持无中断重启）")
+        run_server(host, port)
+        return
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    pid_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "yuanbao_supervisor.pid")
+    with open(pid_file, "w") as f:
+        f.write(str(os.getpid()))
+
+    restart_requested = threading.Event()
+    stop_requested = threading.Event()
+    signal.signal(signal.SIGHUP, lambda sig, frame: restart_requested.set())
+    signal.signal(signal.SIGTERM, lambda sig, frame: stop_requested.set())
+    signal.signal(signal.SIGINT, lambda sig, frame: stop_requested.set())
+
+    logger.info(f"监督模式已启动，PID: {os.getpid()}，发送 SIGHUP 可无中断重启")
+    worker, ready_r = _spawn_worker(sock)
+    if not _wait_worker_ready(worker, ready_r):
+        logger.error("工作进程启动失败")
+    retiring = []
+
+    try:
+        while not stop_requested.wait(0.5):
+            retiring = [proc for proc in retiring if proc.poll() is None]
+
+            if restart_requested.is_set():
+                restart_requested.clear()
+                logger.info("收到重启信号，启动新工作进程...")
+                new_worker, ready_r = _spawn_worker(sock)
+                if _wait_worker_ready(new_worker, ready_r):
+                    logger.info(f"新工作进程已就绪，旧进程 {worker.pid} 开始排空")
+                    worker.send_signal(signal.SIGTERM)
+                    retiring.append(worker)
+                    worker = new_worker
+                else:
+                    logger.error("新工作进程未能就绪，保留旧进程")
+                    new_worker.kill()
+                continue
+
+            if worker.poll() is not None:
+                logger.error(f"工作进程 {worker.pid} 意外退出（退出码 {worker.returncode}），重新启动")
+                worker, ready_r = _spawn_worker(sock)
+                _wait_worker_ready(worker, ready_r)
+    finally:
+        logger.info("监督进程退出，等待工作进程排空...")
+        for proc in [worker] + retiring:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+        for proc in [worker] + retiring:
+            try:
+                proc.wait(timeout=DRAIN_TIMEOUT + 10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        sock.close()
+        if os.path.exists(pid_file):
+            os.remove(pid_file)
+
+# ---------------------------------------------------------------------------
+# 网关模式：多个实例前的一致性哈希路由，同一会话/API Key 固定到同一实例，
+# 使其上游对话（MODEL_CONVERSATION_IDS 等进程内状态）保持可复用
+# ---------------------------------------------------------------------------
+
+# 后端实例地址，逗号分隔，如 http://10.0.0.1:9999,http://10.0.0.2:9999
+GATEWAY_BACKENDS = os.environ.get("YUANBAO_GATEWAY_BACKENDS", "")
+# 后端列表文件（每行一个地址，# 开头为注释），修改后自动生效；设置后优先于 GATEWAY_BACKENDS
+GATEWAY_BACKENDS_FILE = os.environ.get("YUANBAO_GATEWAY_BACKENDS_FILE", "")
+# 路由键：优先使用该请求头，其次 API Key，最后客户端 IP
+GATEWAY_SESSION_HEADER = os.environ.get("YUANBAO_GATEWAY_SESSION_HEADER", "x-session-id")
+# 每个实例在哈希环上的虚拟节点数，越多分布越均匀
+GATEWAY_VNODES = int(os.environ.get("YUANBAO_GATEWAY_VNODES", "160"))
+# 有界负载：单个实例进行中的请求数不超过平均值的该倍数，超出时顺延到环上的下一个实例
+GATEWAY_LOAD_FACTOR = float(os.environ.get("YUANBAO_GATEWAY_LOAD_FACTOR", "1.25"))
+GATEWAY_HEALTH_PATH = os.environ.get("YUANBAO_GATEWAY_HEALTH_PATH", "/health/ready")
+GATEWAY_HEALTH_INTERVAL = float(os.environ.get("YUANBAO_GATEWAY_HEALTH_INTERVAL", "5"))
+# 连续失败多少次后移出哈希环（成功一次即恢复）
+GATEWAY_UNHEALTHY_AFTER = int(os.environ.get("YUANBAO_GATEWAY_UNHEALTHY_AFTER", "2"))
+GATEWAY_CONNECT_TIMEOUT = float(os.environ.get("YUANBAO_GATEWAY_CONNECT_TIMEOUT", "3"))
+GATEWAY_READ_TIMEOUT = float(os.environ.get("YUANBAO_GATEWAY_READ_TIMEOUT", "600"))
+
+# 逐跳头部，不转发
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade", "host", "content-length"
+}
+
+
+def _ring_hash(key: str) -> int:
+    """跨进程稳定的 64 位哈希，多个网关实例对同一个键得到相同的结果"""
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    带虚拟节点的一致性哈希环，支持有界负载（Consistent Hashing with Bounded Loads）
+
+    增删实例时只有落在该实例虚拟节点上的键需要迁移；
+    负载超过上限或不健康的实例被跳过，键顺延到环上的下一个实例
+    """
+
+    def __init__(self, nodes: List[str] = (), vnodes: int = 160, load_factor: float = 1.25):
+        self.vnodes = vnodes
+        self.load_factor = load_factor
+        self._lock = threading.Lock()
+        self._points = []
+        self._owners = []
+        self.nodes = {}
+        self.set_nodes(nodes)
+
+    def set_nodes(self, nodes: List[str]) -> tuple:
+        """替换成员列表，保留已有实例的健康状态和负载，返回 (新增, 移除)"""
+        with self._lock:
+            added = [node for node in nodes if node not in self.nodes]
+            removed = [node for node in self.nodes if node not in nodes]
+            self.nodes = {
+                node: self.nodes.get(node) or {"healthy": True, "failures": 0, "in_flight": 0, "requests": 0, "checked_at": None, "error": None}
+                for node in nodes
             }
-        }
-        return JSONResponse(content=response_data)
+            ring = sorted((_ring_hash(f"{node}#{i}"), node) for node in nodes for i in range(self.vnodes))
+            self._points = [point for point, _ in ring]
+            self._owners = [node for _, node in ring]
+        return added, removed
+
+    def candidates(self, key: str) -> Generator[str, None, None]:
+        """从键在环上的位置顺时针依次给出不同的实例"""
+        points, owners = self._points, self._owners
+        if not points:
+            return
+        start = bisect.bisect(points, _ring_hash(key))
+        seen = set()
+        for i in range(len(points)):
+            node = owners[(start + i) % len(points)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
+
+    def owner(self, key: str) -> Optional[str]:
+        """不考虑健康和负载时键所属的实例"""
+        return next(self.candidates(key), None)
+
+    def acquire(self, key: str, exclude: tuple = ()) -> Optional[str]:
+        """选择实例并计入一个进行中的请求；没有可用实例时返回 None"""
+        with self._lock:
+            healthy = [node for node, state in self.nodes.items() if state["healthy"] and node not in exclude]
+            if not healthy:
+                return None
+            total = sum(self.nodes[node]["in_flight"] for node in healthy)
+            # 上限为 ceil(负载系数 × 平均负载)，计入本次请求
+            capacity = max(1, math.ceil(self.load_factor * (total + 1) / len(healthy)))
+            chosen = None
+            for node in self.candidates(key):
+                if node not in healthy:
+                    continue
+                chosen = chosen or node
+                if self.nodes[node]["in_flight"] < capacity:
+                    chosen = node
+                    break
+            state = self.nodes[chosen]
+            state["in_flight"] += 1
+            state["requests"] += 1
+            return chosen
+
+    def release(self, node: str):
+        with self._lock:
+            if node in self.nodes:
+                self.nodes[node]["in_flight"] -= 1
+
+    def mark(self, node: str, ok: bool, error: Optional[str] = None, threshold: int = 1) -> Optional[bool]:
+        """记录健康检查或转发结果，健康状态变化时返回新状态"""
+        with self._lock:
+            state = self.nodes.get(node)
+            if state is None:
+                return None
+            previous = state["healthy"]
+            state["checked_at"] = time.time()
+            state["error"] = error
+            state["failures"] = 0 if ok else state["failures"] + 1
+            state["healthy"] = ok or (previous and state["failures"] < threshold)
+            return state["healthy"] if state["healthy"] != previous else None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {node: dict(state) for node, state in self.nodes.items()}
+
+
+def load_gateway_backends(backends: Optional[str] = None) -> List[str]:
+    """读取后端列表：文件优先，其次参数/环境变量"""
+    text = backends if backends is not None else GATEWAY_BACKENDS
+    if GATEWAY_BACKENDS_FILE:
+        try:
+            with open(GATEWAY_BACKENDS_FILE, "r", encoding="utf-8") as f:
+                text = ",".join(line.split("#", 1)[0] for line in f)
+        except OSError as e:
+            logger.error(f"读取后端列表失败: {str(e)}")
+    nodes = []
+    for item in text.replace("\n", ",").split(","):
+        item = item.strip().rstrip("/")
+        if item and item not in nodes:
+            nodes.append(item if "://" in item else f"http://{item}")
+    return nodes
+
+
+def gateway_route_key(headers, client_host: Optional[str]) -> str:
+    """路由键：会话头 > API Key > 客户端 IP"""
+    session = headers.get(GATEWAY_SESSION_HEADER)
+    if session:
+        return f"session:{session}"
+    auth = headers.get("authorization", "")
+    api_key = auth[7:].strip() if auth.lower().startswith("bearer ") else headers.get("x-api-key")
+    if api_key:
+        return f"key:{api_key}"
+    return f"ip:{client_host or ''}"
+
+
+def can_retry_forward(method: str, headers: dict, error: requests.exceptions.ConnectionError) -> bool:
+    """
+    转发失败后能否换实例重试
+
+    只有连接没有建立（连接被拒绝、连接超时）时请求才一定没有到达后端；"Connection aborted" 等错误
+    可能发生在请求体发出之后，对话请求重试会在另一个实例上重复生成，
+    此时只有幂等的方法或带 Idempotency-Key 的请求（后端按 Key 去重）才重试
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    if isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError)):
+        return True
+    return method in ("GET", "HEAD", "OPTIONS") or "idempotency-key" in headers
+
+
+class Gateway:
+    """网关状态：哈希环、到后端的连接池和健康检查线程"""
+
+    def __init__(self, backends: Optional[str] = None):
+        self.backends = backends
+        self.ring = HashRing(load_gateway_backends(backends), GATEWAY_VNODES, GATEWAY_LOAD_FACTOR)
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=256))
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=256))
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _set_health(self, node: str, ok: bool, error: Optional[str] = None):
+        changed = self.ring.mark(node, ok, error, GATEWAY_UNHEALTHY_AFTER)
+        if changed is True:
+            logger.info(f"后端恢复，加入哈希环: {node}")
+        elif changed is False:
+            logger.warning(f"后端不可用，移出哈希环: {node}，原因: {error}")
+
+    def check_health(self):
+        """同步成员列表并检查所有后端"""
+        added, removed = self.ring.set_nodes(load_gateway_backends(self.backends))
+        if added or removed:
+            logger.info(f"后端列表变化: 新增 {added}，移除 {removed}")
+        nodes = list(self.ring.nodes)
+        if not nodes:
+            return
+
+        def check(node):
+            try:
+                response = self.session.get(f"{node}{GATEWAY_HEALTH_PATH}", timeout=GATEWAY_CONNECT_TIMEOUT)
+                response.close()
+                self._set_health(node, response.status_code == 200, None if response.status_code == 200 else f"HTTP {response.status_code}")
+            except requests.exceptions.RequestException as e:
+                self._set_health(node, False, type(e).__name__)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(nodes), 16)) as pool:
+            list(pool.map(check, nodes))
+
+    def _run_health_checker(self):
+        while not self._stop.wait(GATEWAY_HEALTH_INTERVAL):
+            try:
+                self.check_health()
+            except Exception as e:
+                logger.error(f"后端健康检查出错: {str(e)}")
+
+    def start(self):
+        self.check_health()
+        if GATEWAY_HEALTH_INTERVAL > 0:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run_health_checker, name="gateway-health", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=GATEWAY_CONNECT_TIMEOUT + 1)
+            self._thread = None
+
+    def forward(self, key: str, method: str, url_path: str, headers: dict, body: bytes):
+        """
+        转发请求，返回 (后端, 响应)；未能建立连接时换下一个实例重试，响应开始后不再重试。
+        调用方读完响应后需调用 ring.release(后端) 和 response.close()
+        """
+        tried = ()
+        while True:
+            node = self.ring.acquire(key, exclude=tried)
+            if node is None:
+                raise HTTPException(status_code=503, detail="没有可用的后端实例")
+            try:
+                response = self.session.request(
+                    method, f"{node}{url_path}", headers=headers, data=body, stream=True,
+                    allow_redirects=False, timeout=(GATEWAY_CONNECT_TIMEOUT, GATEWAY_READ_TIMEOUT)
+                )
+                return node, response
+            except requests.exceptions.ConnectionError as e:
+                self.ring.release(node)
+                self._set_health(node, False, type(e).__name__)
+                if not can_retry_forward(method, headers, e):
+                    raise
+                tried += (node,)
+            except Exception:
+                self.ring.release(node)
+                raise
+
+
+def create_gateway_app(backends: Optional[str] = None, log_file: Optional[str] = None) -> FastAPI:
+    """
+    创建网关应用：按会话头/API Key 一致性哈希转发到后端实例，后端为本程序的普通实例
+
+    网关自身的状态接口为 /gateway/status 和 /gateway/health，其余 HTTP 请求全部转发（不支持 WebSocket）
+    """
+    setup_logging(log_file)
+    gateway = Gateway(backends)
+
+    @asynccontextmanager
+    async def gateway_lifespan(app: FastAPI):
+        await run_in_threadpool(gateway.start)
+        logger.info(f"网关已启动，后端: {list(gateway.ring.nodes)}")
+        yield
+        gateway.stop()
+
+    app = FastAPI(lifespan=gateway_lifespan)
+    app.state.gateway = gateway
+
+    @app.get("/gateway/status")
+    async def gateway_status():
+        return {"nodes": gateway.ring.snapshot(), "vnodes": GATEWAY_VNODES, "load_factor": GATEWAY_LOAD_FACTOR}
+
+    @app.get("/gateway/health")
+    async def gateway_health():
+        healthy = [node for node, state in gateway.ring.snapshot().items() if state["healthy"]]
+        return JSONResponse(status_code=200 if healthy else 503, content={"status": "ok" if healthy else "unavailable", "healthy": healthy})
+
+    @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"])
+    async def proxy(request: Request, path: str):
+        headers = {name: value for name, value in request.headers.items() if name not in HOP_BY_HOP_HEADERS}
+        client_host = request.client.host if request.client else None
+        if client_host:
+            forwarded = request.headers.get("x-forwarded-for")
+            headers["x-forwarded-for"] = f"{forwarded}, {client_host}" if forwarded else client_host
+        url_path = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+        key = gateway_route_key(request.headers, client_host)
+        body = await request.body()
+        try:
+            node, response = await run_in_threadpool(gateway.forward, key, request.method, url_path, headers, body)
+        except HTTPException as e:
+            return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+        except requests.exceptions.RequestException as e:
+            return JSONResponse(status_code=502, content={"detail": f"转发失败: {type(e).__name__}"})
+
+        def relay():
+            # 原样转发字节（不解压），流式响应随后端逐块输出
+            try:
+                yield from response.raw.stream(65536, decode_content=False)
+            finally:
+                response.close()
+                gateway.ring.release(node)
+
+        response_headers = {name: value for name, value in response.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+        response_headers["x-gateway-node"] = node
+        if "content-length" in response.headers:
+            response_headers["content-length"] = response.headers["content-length"]
+        return StreamingResponse(relay(), status_code=response.status_code, headers=response_headers)
+
+    return app
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Yuanbao API Server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--supervised", action="store_true", help="监督模式，支持 SIGHUP 无中断重启")
+    parser.add_argument("--fd", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--gateway", nargs="?", const="", default=None, metavar="BACKENDS",
+                        help="网关模式：按会话/API Key 一致性哈希转发到后端实例，BACKENDS 为逗号分隔的地址，默认读取 YUANBAO_GATEWAY_BACKENDS")
+    args = parser.parse_args()
+    setup_logging()
+
+    if args.gateway is not None:
+        run_server(args.host, args.port, app=create_gateway_app(args.gateway or None))
+        sys.exit(0)
+
+    if args.fd is not None:
+        # 由 supervisor 启动的工作进程
+        run_server(fd=args.fd)
+        sys.exit(0)
+
     ip = get_ip()
     logger.info(f"服务器IP地址: {ip}")
     logger.info("服务即将启动...")
@@ -1225,13 +5433,16 @@ if __name__ == "__main__":
     logger.info("\n=== Yuanbao API Server ===")
     logger.info(f"Local IP address: {ip}")
     logger.info(f"Server will be available at:")
-    logger.info(f"- Local: http://127.0.0.1:9999")
-    logger.info(f"- Network: http://{ip}:9999")
-    logger.info(f"- Docker: http://host.docker.internal:9999")
+    logger.info(f"- Local: http://127.0.0.1:{args.port}")
+    logger.info(f"- Network: http://{ip}:{args.port}")
+    logger.info(f"- Docker: http://host.docker.internal:{args.port}")
     logger.info("\nFor Dify in Docker, use either Network or Docker address")
     logger.info("You can test the server using:")
-    logger.info(f"curl http://{ip}:9999/health")
+    logger.info(f"curl http://{ip}:{args.port}/health")
     logger.info("===============================\n")
     
     logger.info("服务已启动，等待请求...")
-    uvicorn.run(app, host="0.0.0.0", port=9999) 
\ No newline at end of file
+    if args.supervised:
+        run_supervisor(args.host, args.port)
+    else:
+        run_server(args.host, args.port)